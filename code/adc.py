@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# Pluggable drivers for the MCP3008 ADC the keypad is wired to.
+#   bitbang - the original software SPI over four GPIO pins (SPICLK/SPIMOSI/SPIMISO/SPICS)
+#   spidev  - the Pi's hardware SPI (/dev/spidev0.0): one full-duplex transfer per sample.
+#             Needs the ADC moved to the SPI0 pins (SCLK 11, MOSI 10, MISO 9, CE0 8), and
+#             HOOK moved off GPIO 8, which is CE0.
+#   sim     - no hardware; returns values from a function or a scripted sequence
+# Every driver has read(channel) and read_many(channel, n), which returns an array('H').
+#
+# Benchmark (samples/sec per backend):  python3 adc.py bench [backend ...] [-n SAMPLES]
+
+import sys, time, argparse
+from array import array
+
+#------------------------------------------ DRIVERS ------------------------------------------
+
+class BitBangAdc:
+	def __init__(self, gpio, clockpin, mosipin, misopin, cspin):
+		self.gpio = gpio
+		self.clockpin = clockpin
+		self.mosipin = mosipin
+		self.misopin = misopin
+		self.cspin = cspin
+		gpio.setup(mosipin, gpio.OUT)
+		gpio.setup(misopin, gpio.IN)
+		gpio.setup(clockpin, gpio.OUT)
+		gpio.setup(cspin, gpio.OUT)
+
+	# read SPI data from MCP3008 chip, 8 possible adc's (0 thru 7)
+	def read(self, adcnum):
+		if ((adcnum > 7) or (adcnum < 0)):
+			return -1
+		# Bind the GPIO calls locally; this loop makes ~40 of them per sample
+		output = self.gpio.output
+		input = self.gpio.input
+		clockpin = self.clockpin
+		mosipin = self.mosipin
+		misopin = self.misopin
+
+		output(self.cspin, True)
+
+		output(clockpin, False)  # start clock low
+		output(self.cspin, False)     # bring CS low
+
+		commandout = adcnum
+		commandout |= 0x18  # start bit + single-ended bit
+		commandout <<= 3    # we only need to send 5 bits here
+		for i in range(5):
+			output(mosipin, bool(commandout & 0x80))
+			commandout <<= 1
+			output(clockpin, True)
+			output(clockpin, False)
+
+		adcout = 0
+		# read in one empty bit, one null bit and 10 ADC bits
+		for i in range(12):
+			output(clockpin, True)
+			output(clockpin, False)
+			adcout <<= 1
+			if (input(misopin)):
+				adcout |= 0x1
+
+		output(self.cspin, True)
+
+		adcout >>= 1       # first bit is 'null' so drop it
+		return adcout
+
+	def read_many(self, channel, n):
+		read = self.read
+		samples = array('H', bytes(2 * n))
+		for i in range(n):
+			samples[i] = read(channel)
+		return samples
+
+	def close(self):
+		pass
+
+class SpiDevAdc:
+	def __init__(self, bus=0, device=0, max_speed_hz=1350000):
+		import spidev
+		self.spi = spidev.SpiDev()
+		self.spi.open(bus, device)
+		self.spi.max_speed_hz = max_speed_hz
+
+	# read: start bit, single-ended + channel, then clock out the 10-bit result
+	def read(self, adcnum):
+		if ((adcnum > 7) or (adcnum < 0)):
+			return -1
+		r = self.spi.xfer2([1, (8 + adcnum) << 4, 0])
+		return ((r[1] & 3) << 8) | r[2]
+
+	# read_many: the MCP3008 needs CS raised between conversions, so this is one
+	# transfer per sample, but with the command built once and no per-bit Python
+	def read_many(self, channel, n):
+		xfer = self.spi.xfer2
+		command = [1, (8 + channel) << 4, 0]
+		samples = array('H', bytes(2 * n))
+		for i in range(n):
+			r = xfer(command)
+			samples[i] = ((r[1] & 3) << 8) | r[2]
+		return samples
+
+	def close(self):
+		self.spi.close()
+
+class SimulatedAdc:
+	# source: a function (channel -> value), a sequence replayed in a loop, or a constant
+	def __init__(self, source=0):
+		self.set_source(source)
+
+	def set_source(self, source):
+		if callable(source):
+			self.source = source
+		elif isinstance(source, int):
+			self.source = lambda channel: source
+		else:
+			values = list(source)
+			position = [0]
+			def replay(channel):
+				value = values[position[0] % len(values)]
+				position[0] += 1
+				return value
+			self.source = replay
+
+	def read(self, adcnum):
+		if ((adcnum > 7) or (adcnum < 0)):
+			return -1
+		return self.source(adcnum)
+
+	def read_many(self, channel, n):
+		source = self.source
+		return array('H', [source(channel) for i in range(n)])
+
+	def close(self):
+		pass
+
+# open_adc: build a driver from a backend name: "bitbang", "spidev[:bus.device]" or "sim"
+def open_adc(backend, gpio=None, pins=None):
+	kind, _, arg = backend.partition(":")
+	if kind == "bitbang":
+		return BitBangAdc(gpio, *pins)
+	if kind == "spidev":
+		bus, _, device = (arg or "0.0").partition(".")
+		return SpiDevAdc(int(bus), int(device or 0))
+	if kind == "sim":
+		return SimulatedAdc(int(arg) if arg else 0)
+	raise ValueError("Unknown ADC backend: " + backend)
+
+# pins the bitbang driver uses on the Wonderphone (see payphone.py)
+DEFAULT_PINS = (18, 24, 23, 25)	# SPICLK, SPIMOSI, SPIMISO, SPICS
+
+# open_standalone: open a driver outside the phone scripts (benchmarks, calibration)
+def open_standalone(backend):
+	gpio = None
+	if backend.startswith("bitbang"):
+		import RPi.GPIO as gpio
+		gpio.setmode(gpio.BCM)
+		gpio.setwarnings(False)
+	return open_adc(backend, gpio, DEFAULT_PINS)
+
+#------------------------------------------ BENCHMARK ------------------------------------------
+
+def bench(backend, n):
+	driver = open_standalone(backend)
+	try:
+		results = {}
+		start = time.perf_counter()
+		for i in range(n):
+			driver.read(0)
+		results["read"] = n / (time.perf_counter() - start)
+		start = time.perf_counter()
+		driver.read_many(0, n)
+		results["read_many"] = n / (time.perf_counter() - start)
+		return results
+	finally:
+		driver.close()
+
+def main():
+	parser = argparse.ArgumentParser(description="Wonderphone ADC driver tools")
+	sub = parser.add_subparsers(dest="command")
+	b = sub.add_parser("bench", help="report samples/sec for each backend")
+	b.add_argument("backends", nargs="*", default=["bitbang", "spidev", "sim"])
+	b.add_argument("-n", "--samples", type=int, default=2000)
+	args = parser.parse_args()
+	if args.command != "bench":
+		parser.print_help()
+		return 1
+
+	for backend in args.backends:
+		try:
+			results = bench(backend, args.samples)
+		except (ImportError, OSError) as e:
+			print("%-8s skipped (%s)" % (backend, e))
+			continue
+		print("%-8s read: %10.0f samples/s   read_many: %10.0f samples/s" % (backend, results["read"], results["read_many"]))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+# Offline build of the Wonderphone's prompts and stories in the output device's format.
+# The prompts on the USB stick are 44.1 kHz stereo (katies_phone_prompts) or mono
+# (prompts/en, prompts/es), so every play used to be remixed or resampled on the Pi.
+# The build converts everything under the content root once, in parallel, into a
+# mirror tree (<root>/.device/...), and records checksums in <root>/.device/manifest.json
+# so a rebuild only converts what changed. Files already in device format are noted
+# in the manifest and not copied.
+# At runtime PrebuiltAssets.resolve() swaps a prompt path for its converted copy when
+# the manifest says the copy matches the current source.
+#
+#   python3 assets.py build [--root /media/pi/WONDERPHONE] [-j WORKERS] [--force]
+#   python3 assets.py verify [--root ...]      (re-hash the converted files against the manifest)
+
+import os, sys, json, wave, time, hashlib, argparse, logging
+from concurrent.futures import ProcessPoolExecutor
+import audio
+
+logger = logging.getLogger('logwonderphone')
+
+CONTENT_ROOT 	= "/media/pi/WONDERPHONE"
+SOURCE_DIRS 	= ["katies_phone_prompts", "prompts", "stories"]
+BUILD_DIR 		= ".device"
+MANIFEST_NAME 	= "manifest.json"
+TEMP_SUFFIX 	= ".part"
+HASH_BLOCK 		= 1024 * 1024
+
+def device_format(channels=audio.CHANNELS, rate=audio.RATE):
+	return "%d/%d/%d" % (rate, channels, 8 * audio.SAMPLE_WIDTH)
+
+def file_sha256(path):
+	h = hashlib.sha256()
+	with open(path, "rb") as f:
+		while True:
+			block = f.read(HASH_BLOCK)
+			if not block:
+				return h.hexdigest()
+			h.update(block)
+
+def load_manifest(build_dir):
+	try:
+		with open(os.path.join(build_dir, MANIFEST_NAME)) as f:
+			return json.load(f)
+	except FileNotFoundError:
+		return {"format": None, "assets": {}}
+
+def save_manifest(build_dir, manifest):
+	path = os.path.join(build_dir, MANIFEST_NAME)
+	with open(path + TEMP_SUFFIX, "w") as f:
+		json.dump(manifest, f, indent=1, sort_keys=True)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(path + TEMP_SUFFIX, path)
+
+# build_one: convert one source file; runs in a worker process
+def build_one(source, output, channels, rate):
+	w = wave.open(source, 'rb')
+	try:
+		params = (w.getnchannels(), w.getsampwidth(), w.getframerate())
+	finally:
+		w.close()
+	entry = {"source_sha256": file_sha256(source)}
+	if params == (channels, audio.SAMPLE_WIDTH, rate):
+		entry["native"] = True
+		return entry
+	os.makedirs(os.path.dirname(output), exist_ok=True)
+	w = wave.open(output + TEMP_SUFFIX, 'wb')
+	try:
+		w.setnchannels(channels)
+		w.setsampwidth(audio.SAMPLE_WIDTH)
+		w.setframerate(rate)
+		for chunk in audio.stream_wav(source, channels, rate):
+			w.writeframes(chunk)
+	finally:
+		w.close()
+	os.replace(output + TEMP_SUFFIX, output)
+	entry["native"] = False
+	entry["output_sha256"] = file_sha256(output)
+	return entry
+
+# sources: relative paths of every wav under the source directories
+def sources(root, source_dirs=SOURCE_DIRS):
+	found = []
+	for top in source_dirs:
+		for dirpath, dirnames, filenames in os.walk(os.path.join(root, top)):
+			dirnames.sort()
+			for name in sorted(filenames):
+				if name.lower().endswith(".wav") and not name.startswith("."):
+					found.append(os.path.relpath(os.path.join(dirpath, name), root))
+	return found
+
+def build(root=CONTENT_ROOT, workers=None, force=False, channels=audio.CHANNELS, rate=audio.RATE):
+	build_dir = os.path.join(root, BUILD_DIR)
+	os.makedirs(build_dir, exist_ok=True)
+	manifest = load_manifest(build_dir)
+	fmt = device_format(channels, rate)
+	if manifest.get("format") != fmt:
+		manifest = {"format": fmt, "assets": {}}		# device format changed: everything is stale
+	assets = manifest["assets"]
+	stats = {"converted": 0, "native": 0, "unchanged": 0, "removed": 0, "failed": 0}
+	start = time.perf_counter()
+
+	todo = []
+	present = sources(root)
+	for rel in present:
+		source = os.path.join(root, rel)
+		output = os.path.join(build_dir, rel)
+		st = os.stat(source)
+		entry = assets.get(rel)
+		if entry is not None and not force and (entry["native"] or os.path.exists(output)):
+			if (entry["size"], entry["mtime_ns"]) == (st.st_size, st.st_mtime_ns):
+				stats["unchanged"] += 1
+				continue
+			# touched but maybe not changed (copied back onto the stick): compare contents
+			if file_sha256(source) == entry["source_sha256"]:
+				entry["size"], entry["mtime_ns"] = st.st_size, st.st_mtime_ns
+				stats["unchanged"] += 1
+				continue
+		todo.append((rel, source, output, st))
+
+	with ProcessPoolExecutor(workers) as pool:
+		futures = [(rel, st, pool.submit(build_one, source, output, channels, rate)) for rel, source, output, st in todo]
+		for rel, st, future in futures:
+			try:
+				entry = future.result()
+			except (OSError, EOFError, wave.Error, ValueError) as e:
+				print("failed: %s (%s)" % (rel, e))
+				assets.pop(rel, None)
+				stats["failed"] += 1
+				continue
+			entry["size"], entry["mtime_ns"] = st.st_size, st.st_mtime_ns
+			assets[rel] = entry
+			stats["native" if entry["native"] else "converted"] += 1
+
+	# sources that are gone take their converted copies with them
+	for rel in set(assets) - set(present):
+		output = os.path.join(build_dir, rel)
+		if os.path.exists(output):
+			os.remove(output)
+		del assets[rel]
+		stats["removed"] += 1
+
+	save_manifest(build_dir, manifest)
+	stats["seconds"] = round(time.perf_counter() - start, 2)
+	return stats
+
+# verify: converted files whose contents no longer match the manifest
+def verify(root=CONTENT_ROOT):
+	build_dir = os.path.join(root, BUILD_DIR)
+	bad = []
+	for rel, entry in sorted(load_manifest(build_dir)["assets"].items()):
+		if entry["native"]:
+			continue
+		output = os.path.join(build_dir, rel)
+		if not os.path.exists(output) or file_sha256(output) != entry["output_sha256"]:
+			bad.append(rel)
+	return bad
+
+#------------------------------------------ RUNTIME ------------------------------------------
+
+class PrebuiltAssets:
+	def __init__(self, root=CONTENT_ROOT, channels=audio.CHANNELS, rate=audio.RATE):
+		self.root = os.path.join(os.path.abspath(root), "")
+		self.build_dir = os.path.join(self.root, BUILD_DIR)
+		manifest = load_manifest(self.build_dir)
+		self.assets = manifest["assets"]
+		if self.assets and manifest.get("format") != device_format(channels, rate):
+			logger.debug("prebuilt assets: built for %s, not %s; ignoring them", manifest.get("format"), device_format(channels, rate))
+			self.assets = {}
+		self.hits = 0
+		self.misses = 0
+
+	# resolve: the converted copy of a prompt if there is an up-to-date one, otherwise the prompt itself
+	def resolve(self, path):
+		path = os.path.abspath(path)
+		if not path.startswith(self.root):
+			return path
+		rel = path[len(self.root):]
+		entry = self.assets.get(rel)
+		if entry is None or entry["native"]:
+			return path
+		output = os.path.join(self.build_dir, rel)
+		try:
+			st = os.stat(path)
+			fresh = (entry["size"], entry["mtime_ns"]) == (st.st_size, st.st_mtime_ns) and os.path.exists(output)
+		except OSError:
+			fresh = False
+		if not fresh:
+			self.misses += 1
+			return path
+		self.hits += 1
+		return output
+
+	def stats(self):
+		return {"assets": len(self.assets), "hits": self.hits, "misses": self.misses}
+
+def main():
+	parser = argparse.ArgumentParser(description="Build Wonderphone prompts in the output device's format")
+	sub = parser.add_subparsers(dest="command")
+	b = sub.add_parser("build", help="convert new and changed prompts and stories")
+	b.add_argument("--root", default=CONTENT_ROOT)
+	b.add_argument("-j", "--workers", type=int, default=None)
+	b.add_argument("--force", action="store_true", help="convert everything, ignoring the manifest")
+	v = sub.add_parser("verify", help="check converted files against their manifest checksums")
+	v.add_argument("--root", default=CONTENT_ROOT)
+	args = parser.parse_args()
+
+	if args.command == "build":
+		stats = build(args.root, args.workers, args.force)
+		print("%(converted)d converted, %(native)d already native, %(unchanged)d unchanged, "
+			"%(removed)d removed, %(failed)d failed in %(seconds).1f s" % stats)
+		return 1 if stats["failed"] else 0
+	if args.command == "verify":
+		bad = verify(args.root)
+		for rel in bad:
+			print("mismatch: " + rel)
+		print("ok" if not bad else "%d mismatched; run build --force" % len(bad))
+		return 1 if bad else 0
+	parser.print_help()
+	return 1
+
+if __name__ == "__main__":
+	sys.exit(main())
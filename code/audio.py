@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+
+# Persistent audio output engine for the Wonderphone.
+# The sound device is opened once at startup and fed period-sized buffers from
+# a queue by a single worker thread, so starting a prompt no longer forks a new
+# aplay process, reopens ALSA and re-parses the WAV header every time.
+
+import threading, queue, wave, time, signal, logging
+from collections import deque
+import numpy as np
+import tracing
+
+logger = logging.getLogger('logwonderphone')
+
+# output device settings; plughw still converts anything we don't handle here
+DEVICE 			= "plughw:1"
+RATE 			= 44100
+CHANNELS 		= 2
+SAMPLE_WIDTH 	= 2		# bytes per sample, signed 16-bit little endian
+PERIOD_FRAMES 	= 1024	# frames handed to the sink per write
+CHUNK_FRAMES 	= 4096	# frames read from disk at a time when streaming a file
+READ_AHEAD_CHUNKS = 8	# chunks buffered ahead of the output while streaming
+
+#------------------------------------------ FORMAT HELPERS ------------------------------------------
+
+# read_wav: return (params, raw pcm bytes) for a wav file
+def read_wav(wav_filename):
+	w = wave.open(wav_filename, 'rb')
+	try:
+		params = (w.getnchannels(), w.getsampwidth(), w.getframerate())
+		data = w.readframes(w.getnframes())
+	finally:
+		w.close()
+	return params, data
+
+# ChunkConverter: converts pcm to the device format one chunk at a time.
+# Resampling carries the last input frame and the fractional read position
+# across chunks, so a file converted in pieces joins up without clicks.
+class ChunkConverter:
+	def __init__(self, params, channels=CHANNELS, rate=RATE):
+		self.src_channels, self.src_width, self.src_rate = params
+		self.channels = channels
+		self.rate = rate
+		self.passthrough = (params == (channels, SAMPLE_WIDTH, rate))
+		self.step = self.src_rate / rate
+		self.pos = 0.0
+		self.prev = None
+
+	def convert(self, data):
+		if self.passthrough:
+			return data
+		if self.src_width == 1:
+			samples = (np.frombuffer(data, dtype=np.uint8).astype(np.int16) - 128) << 8
+		elif self.src_width == 2:
+			samples = np.frombuffer(data, dtype='<i2')
+		elif self.src_width == 4:
+			samples = (np.frombuffer(data, dtype='<i4') >> 16).astype(np.int16)
+		else:
+			raise ValueError("Unsupported sample width: %d" % self.src_width)
+		frames = samples.reshape(-1, self.src_channels)
+
+		if self.src_rate != self.rate and len(frames):
+			if self.prev is not None:
+				frames = np.concatenate((self.prev, frames))
+			last = len(frames) - 1
+			src_pos = np.arange(self.pos, last, self.step)
+			idx = np.arange(len(frames))
+			out = np.empty((len(src_pos), self.src_channels))
+			for c in range(self.src_channels):
+				out[:, c] = np.interp(src_pos, idx, frames[:, c])
+			self.pos = (src_pos[-1] + self.step - last) if len(src_pos) else (self.pos - last)
+			self.prev = frames[-1:]
+			frames = out
+
+		if self.src_channels == 1 and self.channels > 1:
+			frames = np.repeat(frames, self.channels, axis=1)
+		elif self.src_channels != self.channels:
+			frames = frames.mean(axis=1, keepdims=True).repeat(self.channels, axis=1)
+
+		return np.ascontiguousarray(frames, dtype='<i2').tobytes()
+
+# to_device_format: convert a whole buffer of raw pcm in the given (channels, width, rate)
+def to_device_format(data, params, channels=CHANNELS, rate=RATE):
+	return ChunkConverter(params, channels, rate).convert(data)
+
+# stream_wav: yield a wav file as device-format chunks of at most chunk_frames source frames
+def stream_wav(wav_filename, channels=CHANNELS, rate=RATE, chunk_frames=CHUNK_FRAMES):
+	w = wave.open(wav_filename, 'rb')
+	try:
+		converter = ChunkConverter((w.getnchannels(), w.getsampwidth(), w.getframerate()), channels, rate)
+		while True:
+			data = w.readframes(chunk_frames)
+			if not data:
+				break
+			yield converter.convert(data)
+	finally:
+		w.close()
+
+# read_ahead: run a chunk generator on a helper thread, keeping up to depth chunks ready.
+# The consumer can start on the first chunk while later ones (and later files) are still
+# being read; closing the returned generator stops the helper thread.
+def read_ahead(chunks, depth=READ_AHEAD_CHUNKS):
+	q = queue.Queue(depth)
+	stopped = threading.Event()
+
+	def put(item):
+		while not stopped.is_set():
+			try:
+				q.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				pass
+		return False
+
+	def fill():
+		try:
+			for chunk in chunks:
+				if not put(chunk):
+					return
+		except Exception as e:
+			put(e)
+			return
+		finally:
+			close = getattr(chunks, "close", None)
+			if close is not None:
+				close()
+		put(_END_OF_STREAM)
+
+	threading.Thread(target=fill, name="audio-read-ahead", daemon=True).start()
+	try:
+		while True:
+			item = q.get()
+			if item is _END_OF_STREAM:
+				return
+			if isinstance(item, Exception):
+				raise item
+			yield item
+	finally:
+		stopped.set()
+
+_END_OF_STREAM = object()
+
+#------------------------------------------ SINKS ------------------------------------------
+
+# AlsaSink: the real sound card, kept open for the life of the program
+class AlsaSink:
+	def __init__(self, device=DEVICE, rate=RATE, channels=CHANNELS, period_frames=PERIOD_FRAMES):
+		import alsaaudio
+		self.rate = rate
+		self.channels = channels
+		self.pcm = alsaaudio.PCM(
+			alsaaudio.PCM_PLAYBACK,
+			device = device,
+			channels = channels,
+			rate = rate,
+			format = alsaaudio.PCM_FORMAT_S16_LE,
+			periodsize = period_frames
+		)
+
+	def write(self, data):
+		self.pcm.write(data)
+
+	# drop: discard anything still queued in the driver (barge-in / stop)
+	def drop(self):
+		self.pcm.drop()
+
+	def close(self):
+		self.pcm.close()
+
+# NullSink: swallows audio, optionally at real-time pace so wait() behaves like the device
+class NullSink:
+	def __init__(self, rate=RATE, channels=CHANNELS, realtime=True):
+		self.rate = rate
+		self.channels = channels
+		self.realtime = realtime
+		self.frames_written = 0
+
+	def write(self, data):
+		frames = len(data) // (self.channels * SAMPLE_WIDTH)
+		self.frames_written += frames
+		if self.realtime:
+			time.sleep(frames / self.rate)
+
+	def drop(self):
+		pass
+
+	def close(self):
+		pass
+
+# FileSink: writes everything that would have been played into a wav file
+class FileSink:
+	def __init__(self, filename, rate=RATE, channels=CHANNELS):
+		self.rate = rate
+		self.channels = channels
+		self.w = wave.open(filename, 'wb')
+		self.w.setnchannels(channels)
+		self.w.setsampwidth(SAMPLE_WIDTH)
+		self.w.setframerate(rate)
+
+	def write(self, data):
+		self.w.writeframes(data)
+
+	def drop(self):
+		pass
+
+	def close(self):
+		self.w.close()
+
+# open_sink: build a sink from a spec string: "alsa", "null", "null:fast" or "file:/path/out.wav"
+def open_sink(spec):
+	kind, _, arg = spec.partition(":")
+	if kind == "alsa":
+		return AlsaSink(device = arg or DEVICE)
+	if kind == "null":
+		return NullSink(realtime = (arg != "fast"))
+	if kind == "file":
+		return FileSink(arg)
+	raise ValueError("Unknown audio sink: " + spec)
+
+#------------------------------------------ ENGINE ------------------------------------------
+
+# PlaybackHandle: what play() returns; stands in for the old aplay Popen object
+class PlaybackHandle:
+	def __init__(self, buffers, name=""):
+		self.buffers = buffers
+		self.name = name
+		self.returncode = None
+		self.created = time.monotonic()
+		self.first_write = None		# when the first period reached the sink
+		self.stop_time = None
+		self.started = threading.Event()
+		self.done = threading.Event()
+		self.stop_requested = threading.Event()
+		self.callbacks = []
+		self.lock = threading.Lock()
+
+	# poll: None while queued or playing, like Popen.poll()
+	def poll(self):
+		return self.returncode
+
+	# wait: block until the audio has finished or was stopped
+	def wait(self, timeout=None):
+		self.done.wait(timeout)
+		return self.returncode
+
+	# stop: end playback at the next period boundary
+	def stop(self):
+		if self.stop_time is None:
+			self.stop_time = time.monotonic()
+		self.stop_requested.set()
+
+	kill = stop
+
+	# add_done_callback: call fn(handle) once the handle is done, from the engine thread (right away if it already is)
+	def add_done_callback(self, fn):
+		with self.lock:
+			if not self.done.is_set():
+				self.callbacks.append(fn)
+				return
+		fn(self)
+
+	def _set_done(self):
+		with self.lock:
+			self.done.set()
+			callbacks, self.callbacks = self.callbacks, []
+		for fn in callbacks:
+			fn(self)
+
+class AudioEngine:
+	def __init__(self, sink, period_frames=PERIOD_FRAMES, cache=None, assets=None):
+		self.sink = sink
+		self.cache = cache
+		self.assets = assets		# prebuilt device-format copies of prompts (assets.PrebuiltAssets)
+		self.period_bytes = period_frames * sink.channels * SAMPLE_WIDTH
+		self.queue = queue.Queue()
+		self.current = None
+		self.cancel_latencies = deque(maxlen=256)	# seconds from stop() to the device going quiet
+		self.on_start = None		# called with a handle once its first period has reached the sink, e.g. by sim.py
+		self.thread = threading.Thread(target=self._run, name="audio-engine", daemon=True)
+		self.thread.start()
+
+	# play: queue a playlist of wav files (or raw pcm buffers) and return a handle.
+	# Files are streamed in chunks on a read-ahead thread and joined without gaps.
+	def play(self, wav_filenames):
+		handle = PlaybackHandle(read_ahead(self._playlist(wav_filenames)), ", ".join(map(str, wav_filenames)))
+		self.queue.put(handle)
+		return handle
+
+	# stop_all: stop whatever is playing and anything still queued
+	def stop_all(self):
+		self.cancel(None)
+
+	# cancel: stop the current and queued handles that were created before the given
+	# monotonic time (default: now), so a barge-in never cuts off the prompt queued in response
+	def cancel(self, since=None):
+		if since is None:
+			since = time.monotonic()
+		with self.queue.mutex:
+			pending = [h for h in self.queue.queue if h is not None]
+		for handle in pending:
+			if handle.created <= since:
+				handle.stop()
+		current = self.current
+		if current is not None and current.created <= since:
+			current.stop()
+
+	# cancel_stats: cancel-to-silence latency over the recent stops, in milliseconds
+	def cancel_stats(self):
+		latencies = list(self.cancel_latencies)
+		if not latencies:
+			return {"count": 0}
+		return {
+			"count": len(latencies),
+			"last_ms": round(latencies[-1] * 1000, 2),
+			"mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+			"max_ms": round(max(latencies) * 1000, 2),
+		}
+
+	def close(self):
+		self.stop_all()
+		self.queue.put(None)
+		self.thread.join()
+		self.sink.close()
+
+	def _playlist(self, wav_filenames):
+		for f in wav_filenames:
+			if isinstance(f, (bytes, bytearray, memoryview)):
+				yield f
+			elif self.cache is not None and self.cache.covers(f):
+				yield self.cache.get(f)
+			else:
+				if self.assets is not None:
+					f = self.assets.resolve(f)
+				yield from stream_wav(f, self.sink.channels, self.sink.rate)
+
+	def _run(self):
+		while True:
+			handle = self.queue.get()
+			if handle is None:
+				break
+			if handle.stop_requested.is_set():
+				self._finish(handle)
+				continue
+			self.current = handle
+			handle.started.set()
+			try:
+				self._play(handle)
+			except Exception:
+				logger.exception("audio engine: playback of %s failed", handle.name)
+				handle.returncode = 1
+			self.current = None
+			self._finish(handle)
+
+	# _play: re-block the stream into whole periods so adjacent files join without a short write
+	def _play(self, handle):
+		step = self.period_bytes
+		pending = bytearray()
+		try:
+			for buf in handle.buffers:
+				view = memoryview(buf).cast('B')
+				i = 0
+				if pending:
+					i = step - len(pending)
+					pending += view[:i]
+					if len(pending) < step:
+						continue
+					if not self._write(handle, pending):
+						return
+					pending = bytearray()
+				end = len(view) - (len(view) - i) % step
+				for j in range(i, end, step):
+					if not self._write(handle, view[j:j + step]):
+						return
+				pending += view[end:]
+			if pending and not self._write(handle, pending):
+				return
+			handle.returncode = 0
+		finally:
+			close = getattr(handle.buffers, "close", None)
+			if close is not None:
+				close()
+
+	def _write(self, handle, data):
+		if handle.stop_requested.is_set():
+			self.sink.drop()
+			latency = time.monotonic() - handle.stop_time
+			self.cancel_latencies.append(latency)
+			if tracing.ENABLED:
+				tracing.record("audio.stop", latency)
+			logger.debug("audio engine: stopped %s, silent after %.1f ms", handle.name, latency * 1000)
+			return False
+		self.sink.write(data)
+		if handle.first_write is None:
+			handle.first_write = time.monotonic()
+			if tracing.ENABLED:
+				tracing.record("audio.start", handle.first_write - handle.created)
+			if self.on_start is not None:
+				self.on_start(handle)
+		return True
+
+	def _finish(self, handle):
+		if handle.returncode is None:
+			handle.returncode = -signal.SIGKILL
+		handle._set_done()
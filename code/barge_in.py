@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# Barge-in for the Wonderphone: a keypress or hang-up silences the current prompt
+# within one audio period, without waiting for the menu code to notice.
+# The GPIO edge callbacks call key_pressed() / hung_up() first thing, before they
+# wait on the keypad sampler for the key, and the prompt is cancelled in the audio
+# engine right there. Keypresses only count while the menu has armed barge-in around
+# a prompt that may be interrupted, so a bounce or noise on the PRESSED line at any
+# other time cuts nothing off. Edge callbacks only post events to the control core (core.py),
+# so nothing is queued ahead of them on RPi.GPIO's callback thread.
+
+import threading, logging
+
+logger = logging.getLogger('logwonderphone')
+
+class BargeIn:
+	# read_pressed: optional callable returning the current level of the PRESSED pin, for a key already down when armed
+	def __init__(self, engine, read_pressed=None):
+		self.engine = engine
+		self.read_pressed = read_pressed
+		self.keys_armed = threading.Event()
+		self.reason = None
+		self.fire_count = {"key": 0, "hook": 0}
+
+	# arm: let keypresses cut off audio while an interruptible prompt plays (hang-ups always do); disarm after it
+	def arm(self):
+		self.reason = None
+		self.keys_armed.set()
+		if self.read_pressed is not None and self.read_pressed():
+			self._fire("key")
+
+	def disarm(self):
+		self.keys_armed.clear()
+
+	# key_pressed: from the PRESSED edge callback
+	def key_pressed(self):
+		if self.keys_armed.is_set():
+			self._fire("key")
+
+	# hung_up: from the HOOK edge callback, when the handset is down
+	def hung_up(self):
+		self._fire("hook")
+
+	def close(self):
+		self.disarm()
+
+	def _fire(self, reason):
+		self.reason = reason
+		self.fire_count[reason] += 1
+		self.engine.cancel()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+# asyncio control core for the Wonderphone.
+# One event loop, on its own thread, owns the menu. GPIO edges and sampler events
+# arrive on other threads and are only posted to it (post()); the loop dispatches
+# them one at a time, so the menu state and the p/r globals are only ever touched
+# from one thread, and each event is a fresh pass through a flat loop: the stack
+# is as deep after a thousand keypresses as after one.
+# Playback handles and recordings become awaitables (finished(), until_key()). A
+# hang-up cancels the transition in progress, which stops whatever it was playing
+# or recording, before the hook event itself is dispatched.
+#
+# Soak test:  python3 core.py soak [--menu katies] [-n EVENTS]
+# drives a menu with random keys and hang-ups against a real AudioEngine on a null
+# sink, and fails unless stack depth and memory stay flat.
+
+import sys, time, random, asyncio, threading, argparse, tracemalloc, logging
+import audio, menu
+
+logger = logging.getLogger('logwonderphone')
+
+HOOK = "hook"
+_STOP = object()
+
+class PhoneCore:
+	# speed: phone seconds per real second (sim.py runs the phone on a faster virtual clock)
+	def __init__(self, menu, before=None, speed=1.0):
+		self.menu = menu
+		self.before = before				# called with each event before it is dispatched
+		self.speed = speed
+		self.loop = None
+		self.events = None
+		self.task = None					# the transition in progress
+		self.ready = threading.Event()
+		self.thread = None
+		self.handled = 0
+		self.cancelled = 0
+
+	def start(self):
+		self.thread = threading.Thread(target=self._main, name="phone-core", daemon=True)
+		self.thread.start()
+		self.ready.wait()
+
+	# post: hand an event (a key or "hook") to the loop; safe from any thread
+	def post(self, event):
+		self.loop.call_soon_threadsafe(self._post, event)
+
+	def close(self):
+		if self.thread is None:
+			return
+		self.post(_STOP)
+		self.thread.join()
+		self.thread = None
+
+	def stats(self):
+		return {"handled": self.handled, "cancelled": self.cancelled, "queued": self.events.qsize() if self.events else 0}
+
+	#------------------------------ awaitables for menu steps ------------------------------
+
+	# finished: wait for a playback handle or recording to end; stops it if we are cancelled
+	async def finished(self, handle):
+		if not handle.done.is_set():
+			try:
+				await self.when(handle.add_done_callback)
+			except asyncio.CancelledError:
+				handle.stop()
+				raise
+		return handle.returncode
+
+	# when: wait until another thread calls back, e.g. when(SAMPLER.add_release_callback).
+	# add_callback(fn) must call fn (with any arguments) once, from whichever thread; no
+	# thread is parked on the wait, and a cancelled wait just leaves a callback that does nothing.
+	async def when(self, add_callback):
+		future = self.loop.create_future()
+		add_callback(lambda *args: self._call_soon(self._resolve, future))
+		await future
+
+	# next_key: the next key posted, or None after timeout seconds
+	async def next_key(self, timeout=None):
+		try:
+			return await asyncio.wait_for(self.events.get(), timeout)
+		except asyncio.TimeoutError:
+			return None
+
+	# until_key: wait for a handle to end; a key posted first stops it and is returned
+	async def until_key(self, handle, timeout=None):
+		done = asyncio.ensure_future(self.finished(handle))
+		key = asyncio.ensure_future(self.events.get())
+		try:
+			await asyncio.wait([done, key], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+		finally:
+			if not key.done():
+				key.cancel()
+			if not done.done():
+				handle.stop()
+		if key.done() and not key.cancelled():
+			await done
+			return key.result()
+		return None
+
+	# sleep: wait for a number of phone seconds
+	async def sleep(self, seconds):
+		await asyncio.sleep(seconds / self.speed)
+
+	# drop_keys: forget keys pressed before now (a prompt is about to start)
+	def drop_keys(self):
+		while not self.events.empty():
+			self.events.get_nowait()
+
+	# _call_soon: call_soon_threadsafe that does nothing once the loop is closed
+	def _call_soon(self, function, *args):
+		try:
+			self.loop.call_soon_threadsafe(function, *args)
+		except RuntimeError:
+			pass
+
+	@staticmethod
+	def _resolve(future):
+		if not future.done():
+			future.set_result(None)
+
+	#------------------------------ loop ------------------------------
+
+	def _main(self):
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+		self.events = asyncio.Queue()
+		self.ready.set()
+		try:
+			self.loop.run_until_complete(self._run())
+		finally:
+			self.loop.close()
+
+	def _post(self, event):
+		if event == HOOK or event is _STOP:
+			self.drop_keys()
+			if self.task is not None:
+				self.task.cancel()
+		self.events.put_nowait(event)
+
+	async def _run(self):
+		while True:
+			event = await self.events.get()
+			if event is _STOP:
+				return
+			self.handled += 1
+			if self.before is not None:
+				self.before(event)
+			self.task = asyncio.ensure_future(self.menu.dispatch_async(event))
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				self.cancelled += 1
+				logger.debug("core: %s cancelled in %s", event, self.menu.current)
+			except Exception:
+				logger.exception("core: %s failed in %s", event, self.menu.current)
+			finally:
+				self.task = None
+
+#------------------------------------------ SOAK TEST ------------------------------------------
+
+# stack_depth: frames below the caller
+def stack_depth():
+	depth = 0
+	frame = sys._getframe(1)
+	while frame is not None:
+		depth += 1
+		frame = frame.f_back
+	return depth
+
+# soak: random keys and hang-ups through a menu for count events; returns the measurements
+def soak(definition, count, seed=1, prompt_seconds=0.002):
+	engine = audio.AudioEngine(audio.NullSink(realtime=True))
+	silence = bytes(int(audio.RATE * prompt_seconds) * audio.CHANNELS * audio.SAMPLE_WIDTH)
+	state = {"p": engine.play([b""]), "depths": []}
+	core = None
+
+	def play(*files):
+		state["p"] = engine.play([silence])
+
+	async def wait():
+		state["depths"].append(stack_depth())
+		await core.finished(state["p"])
+
+	async def listen():
+		state["depths"].append(stack_depth())
+		return await core.until_key(state["p"])
+
+	async def record(*args):
+		state["p"] = engine.play([silence])
+		await core.until_key(state["p"])
+
+	actions = dict((name, lambda *args: None) for name in menu.action_names(definition))
+	actions.update({"play": play, "wait": wait, "listen": listen, "record": record})
+	m = menu.build(definition, actions)
+	core = PhoneCore(m, before=lambda event: state["p"].stop())
+	core.start()
+
+	rng = random.Random(seed)
+	samples = []
+	tracemalloc.start()
+	try:
+		for i in range(count):
+			core.post(HOOK if rng.random() < 0.02 else rng.choice(menu.KEYS))
+			time.sleep(rng.random() * prompt_seconds * 2)
+			if i % max(1, count // 20) == 0:
+				samples.append((i, tracemalloc.get_traced_memory()[0], max(state["depths"] or [0]), len(state["depths"])))
+				state["depths"] = []
+		# let the queue drain
+		while core.stats()["queued"]:
+			time.sleep(0.01)
+		time.sleep(0.1)
+		samples.append((count, tracemalloc.get_traced_memory()[0], max(state["depths"] or [0]), len(state["depths"])))
+	finally:
+		tracemalloc.stop()
+		core.close()
+		engine.close()
+	return {"samples": samples, "dispatched": m.dispatched, "stats": core.stats()}
+
+def main():
+	import menus
+	parser = argparse.ArgumentParser(description="Wonderphone control core tools")
+	sub = parser.add_subparsers(dest="command")
+	s = sub.add_parser("soak", help="drive a menu with random events and check stack depth and memory stay flat")
+	s.add_argument("--menu", choices=sorted(menus.MENUS), default="katies")
+	s.add_argument("-n", "--events", type=int, default=20000)
+	s.add_argument("--memory-slack", type=int, default=256, help="KB of growth allowed after warm-up")
+	args = parser.parse_args()
+	if args.command != "soak":
+		parser.print_help()
+		return 1
+
+	r = soak(menus.MENUS[args.menu], args.events)
+	print("%8s %12s %10s %8s" % ("events", "memory KB", "max depth", "steps"))
+	for i, memory, depth, steps in r["samples"]:
+		print("%8d %12.1f %10d %8d" % (i, memory / 1024.0, depth, steps))
+	print("transitions: %d, %s" % (r["dispatched"], r["stats"]))
+
+	samples = r["samples"][2:]		# after warm-up
+	depths = [d for i, m, d, n in samples if n]
+	growth = (samples[-1][1] - samples[0][1]) / 1024.0
+	ok = len(set(depths)) <= 1 and growth < args.memory_slack
+	print("stack depth %s, memory growth %.1f KB: %s" % (sorted(set(depths)), growth, "ok" if ok else "FAILED"))
+	return 0 if ok else 1
+
+if __name__ == "__main__":
+	sys.exit(main())
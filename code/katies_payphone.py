@@ -4,54 +4,39 @@
 # Edited and repurposed by Gavin Pham
 # Updated May 13, 2018
 
-import time, os, sys, subprocess, signal, logging, math
-import RPi.GPIO as GPIO
-from os import listdir, remove
-from os.path import isfile, join
+import time, os, re, sys, logging
+import audio, assets, prompt_cache, barge_in, adc, sampler, keypad, keyfilter, recordings, manifest, recorder, transcode, trim, rewrite, menu, menus, prefetch, core, sim, tracing, logwriter, usage
+from menus import ROOT
+
+# BACKGROUND WORKERS
+# Saved takes are trimmed and old recordings transcoded in process pools (trim.py, transcode.py). Their
+# workers are forked here, before any of this script's threads run, so none can inherit a held lock (rewrite.py)
+TRIM_POOL = rewrite.pool(trim.WORKERS)
+TRANSCODE_POOL = rewrite.pool(transcode.WORKERS)
+
+# SIMULATOR: with WONDERPHONE_SIM=trace.json the GPIO pins, ADC, speaker and microphone are
+# simulated and the trace is replayed against them on a faster virtual clock (sim.py)
+SIM = sim.from_environment()
+if SIM is None:
+	import RPi.GPIO as GPIO
+else:
+	GPIO = SIM.gpio
 
 GPIO.setmode(GPIO.BCM)
 
 logger = logging.getLogger('logwonderphone')
-handler = logging.FileHandler('/home/pi/Desktop/wonderphone.log')
+# Lines are queued and written in batches by a background thread, rotated by size and age
+# and capped on disk; under back-pressure debug lines are dropped rather than waited for (logwriter.py)
+handler = logwriter.BatchedFileHandler(os.environ.get('WONDERPHONE_LOG', '/home/pi/Desktop/wonderphone.log'))
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 
 # read SPI data from MCP3008 chip, 8 possible adc's (0 thru 7)
+# The pins are kept in the signature for the existing call sites; the ADC driver (adc.py) owns them.
 def readadc(adcnum, clockpin, mosipin, misopin, cspin):
-	if ((adcnum > 7) or (adcnum < 0)):
-		return -1
-	GPIO.output(cspin, True)
-	
-	GPIO.output(clockpin, False)  # start clock low
-	GPIO.output(cspin, False)     # bring CS low
-	
-	commandout = adcnum
-	commandout |= 0x18  # start bit + single-ended bit
-	commandout <<= 3    # we only need to send 5 bits here
-	for i in range(5):
-		if (commandout & 0x80):
-			GPIO.output(mosipin, True)
-		else:
-			GPIO.output(mosipin, False)
-		commandout <<= 1
-		GPIO.output(clockpin, True)
-		GPIO.output(clockpin, False)
-	
-	adcout = 0
-	# read in one empty bit, one null bit and 10 ADC bits
-	for i in range(12):
-		GPIO.output(clockpin, True)
-		GPIO.output(clockpin, False)
-		adcout <<= 1
-		if (GPIO.input(misopin)):
-			adcout |= 0x1
-	
-	GPIO.output(cspin, True)
-	
-	adcout >>= 1       # first bit is 'null' so drop it
-	return adcout
+	return ADC.read(adcnum)
 
 # pins connected from the SPI port on the ADC to the Cobbler
 SPICLK 	= 18
@@ -59,10 +44,9 @@ SPIMISO = 23
 SPIMOSI = 24
 SPICS 	= 25
 GPIO.setwarnings(False)
-GPIO.setup(SPIMOSI, GPIO.OUT)
-GPIO.setup(SPIMISO, GPIO.IN)
-GPIO.setup(SPICLK, GPIO.OUT)
-GPIO.setup(SPICS, GPIO.OUT)
+# ADC driver: "bitbang" (the pins above), "spidev" (hardware SPI0, see adc.py) or "sim"
+ADC_BACKEND = os.environ.get("WONDERPHONE_ADC", "bitbang")
+ADC = adc.open_adc(ADC_BACKEND, GPIO, (SPICLK, SPIMOSI, SPIMISO, SPICS)) if SIM is None else SIM.adc
 
 
 # pins connected from various I/O to the Cobbler
@@ -83,12 +67,74 @@ DEBUG_RECORDING = 0
 
 # STATIC CONSTANTS
 MIN_ADC_VAL_KEYPRESS_VAL = 390	# 390 is the minimum adc value that registers as input (not just noise)
+KEY_EVENT_TIMEOUT = 0.1			# seconds to wait for the sampler to confirm a press after the PRESSED edge
+
+# KEYPAD DECODING: 1024-entry ADC value -> key table, from keypad_calibration.json if present
+KEYPAD = keypad.load()
+# A key is only accepted once a burst of KEY_FILTER_WINDOW samples agrees on it (keyfilter.py)
+KEY_FILTER_WINDOW = 5
+KEY_FILTER = keyfilter.KeyFilter(KEYPAD, window = KEY_FILTER_WINDOW, method = "vote")
+
+# KEYPAD SAMPLER
+# One background thread owns the ADC and turns its samples into debounced press/release events
+SAMPLER = sampler.KeypadSampler(ADC, threshold = MIN_ADC_VAL_KEYPRESS_VAL, key_filter = KEY_FILTER)
+
+# AUDIO OUTPUT
+# The engine keeps the sound device open; set WONDERPHONE_AUDIO_SINK to "null" or "file:/path/out.wav" to run without a sound card
+AUDIO_SINK = os.environ.get("WONDERPHONE_AUDIO_SINK", "alsa")
+# Prompts are preloaded into RAM at startup (in device format) so playback never waits on the USB stick
+PROMPT_CACHE_BYTES = 24 * 1024 * 1024
+# Prompts converted ahead of time by "python3 assets.py build" are used in place of the originals when up to date
+ASSETS = assets.PrebuiltAssets(ROOT)
+PROMPT_CACHE = prompt_cache.PromptCache([ROOT + "katies_phone_prompts"], budget_bytes = PROMPT_CACHE_BYTES, assets = ASSETS)
+ENGINE = audio.AudioEngine(audio.open_sink(AUDIO_SINK) if SIM is None else SIM.sink, cache = PROMPT_CACHE, assets = ASSETS)
+
+# RECORDINGS
+# Loaded from katies_recordings.manifest.jsonl at startup, then kept current by our own writes/deletes
+# and a directory watcher that also checks the manifest against the disk (recordings.py, manifest.py).
+# Set up before the recorder, which hands over takes a previous run left in the staging area as soon as it starts
+RECORDINGS_DIR = ROOT + "katies_recordings/"
+RECORDINGS = recordings.RecordingsIndex(RECORDINGS_DIR, manifest = manifest.Manifest(RECORDINGS_DIR))
+
+# USAGE
+# Pickups, call lengths, menu choices and recordings are counted in memory and snapshotted
+# once a minute, one small file per day (usage.py); "python3 usage.py weekly" rolls them up
+USAGE_DIR = os.environ.get("WONDERPHONE_USAGE", usage.DIRECTORY)
+USAGE = usage.Usage(USAGE_DIR, "katies")
+
+# AUDIO INPUT
+# Recordings are captured in-process; set WONDERPHONE_AUDIO_SOURCE to "silence" or "file:/path/in.wav" to run without a microphone
+AUDIO_SOURCE = os.environ.get("WONDERPHONE_AUDIO_SOURCE", "alsa")
+# Capture format: mono 16 kHz is plenty for a handset and a fifth of the bytes of cd quality
+CAPTURE_RATE = 16000
+CAPTURE_CHANNELS = 1
+MAX_RECORDING_SECONDS = 60
+# Takes are staged in RAM during the call and only written to the USB stick by a background writer once saved with #
+RECORDING_STAGING_DIR = recorder.STAGING_DIR
+RECORDING_STAGING_BYTES = 32 * 1024 * 1024
+# Saved takes have their leading and trailing silence trimmed in the background (trim.py); near-silent ones are flagged empty
+def recording_saved(path):
+	RECORDINGS.add(path)
+	TRIMMER.submit(path)
+def recording_trimmed(result):
+	RECORDINGS.refresh(result["path"])
+	if result["empty"]:
+		RECORDINGS.flag(result["path"], empty = True)
+		USAGE.count("recordings_empty")
+TRIMMER = trim.Trimmer(on_done = recording_trimmed, pool = TRIM_POOL)
+RECORDER = recorder.Recorder(recorder.open_source(AUDIO_SOURCE, CAPTURE_RATE, CAPTURE_CHANNELS) if SIM is None else SIM.source(CAPTURE_RATE, CAPTURE_CHANNELS),
+	rate = CAPTURE_RATE, channels = CAPTURE_CHANNELS, staging_dir = RECORDING_STAGING_DIR,
+	staging_budget = RECORDING_STAGING_BYTES, on_saved = recording_saved)
+# Older recordings are converted to the capture format by a background process pool (transcode.py)
+TRANSCODER = transcode.Transcoder(CAPTURE_RATE, CAPTURE_CHANNELS, on_done = lambda path: RECORDINGS.refresh(path), pool = TRANSCODE_POOL)
+# Keypresses (while armed) and hang-ups cut the current prompt off within one audio period,
+# straight from the edge callbacks (button_handler, restart), before the key is even read
+BARGE_IN = barge_in.BargeIn(ENGINE, lambda: GPIO.input(PRESSED))
 
 # GLOBAL VARS
-MENU = []
 PLAYBACK_INDEX = 0
+IS_FIRST_PLAYBACK = True
 SHOULD_PLAY_GREETINGS = True
-ALLOW_CALLBACK_INTERRUPTS = True
 
 #------------------------------------------ UTILITY FUNCTIONS ------------------------------------------
 
@@ -96,197 +142,77 @@ ALLOW_CALLBACK_INTERRUPTS = True
 def phoneIsOffHook():
 	return GPIO.input(HOOK) == 1
 
-# Play wav file on the attached system sound device
+# discard_recording: Throw away the take that hasn't been saved yet; returns False if there was none.
+def discard_recording():
+	try:
+		discarded = r.discard()
+	except NameError:
+		print("r doesn't exist")
+		return False
+	if discarded:
+		USAGE.count("recordings_discarded")
+	return discarded
+
+# Play wav file on the attached system sound device (through the persistent audio engine)
 def play_wav(wav_filename):
 	global p
 	msg = "playing " + ", ".join(wav_filename)
 	logger.debug(msg)
-	p = subprocess.Popen(
-		['aplay','-i','-D','plughw:1'] + wav_filename,
-		stdin = subprocess.PIPE,
-		stdout = subprocess.PIPE,
-		stderr = subprocess.STDOUT,
-		shell = False
-	)
-
-# record wav file on the attached system sound device
+	PREFETCH.played(wav_filename)
+	p = ENGINE.play(wav_filename)
+
+# record wav file on the attached system sound device (in-process, see recorder.py)
+# The take stays in a temp file until it is saved with r.save() or thrown away with r.discard()
 def record_wav(wav_filename):
 	global r
-	r = subprocess.Popen(
-		['arecord','-f','cd','-t','wav','-D','plughw:1',wav_filename],
-		stdin = subprocess.PIPE,
-		stdout = subprocess.PIPE,
-		stderr = subprocess.STDOUT,
-		shell = False
-	)
-
-def handle_recording():
-	global r
-	global p
+	r = RECORDER.record(wav_filename, max_seconds = MAX_RECORDING_SECONDS)
 
-	is_recording = False
-	should_continue_recording = True
-	button_released = False
-	btnval = 0
-	message_length_in_seconds = 0
+#------------------------------------------ MENU ------------------------------------------
+# The menu itself (states, keys and prompts) is data in menus.py, compiled into a
+# transition table by menu.py; these are the steps its transitions run.
+# A step returns a key (or "hook", "reset") to move the menu on, or nothing to carry on.
+# Steps run on the control core's event loop (core.py): the ones that wait for a prompt
+# or a recording are coroutines, and a hang-up cancels them where they are.
 
+# listen: wait for the current prompt to end; hand back the key that cut it off, or "hook" on a hang-up
+async def listen():
 	# Wait for the user to release any depressed buttons
-	while not button_released:
-		if readadc(0, SPICLK, SPIMOSI, SPIMISO, SPICS) == 0:
-			button_released = True
-		else: 
-			# Sleep 5 ms
-			time.sleep(0.05)
-
-	# If a subprocess is recording audio, loop should be started.
+	await CORE.when(SAMPLER.add_release_callback)
+	CORE.drop_keys()
+
+	# A keypress or hang-up stops the prompt in the audio engine straight away (barge-in);
+	# the key itself arrives from button_handler a moment later.
+	if DEBUG_AUDIO_OUT and p.poll() == None:
+		print("Playing audio...")
+	BARGE_IN.arm()
 	try:
-		if r.poll() == None:
-			is_recording = True
-			if DEBUG_RECORDING:
-				print("Recording...")
-		else:
-			if DEBUG_VERBOSE_OUTPUT:
-				print("Something went wrong")
-				play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/something_went_wrong.wav"])
-				p.wait()
-			raise ValueError("Recording process is non-active, but blocking. Recording through this can accidentally delete files, which is pretty bad.")
-	except NameError:
-		print ("r doesn't exist")
-
-	while is_recording and should_continue_recording and message_length_in_seconds < 60:
-		# If subprocess is done recording, stop looping.
-		try:
-			if r.poll() != None:
-				is_recording = False
-				break
-		except NameError:
-			print ("r doesn't exist")
-
-		# If the phone is hung up, end playback, delete current file, and restart.
-		if not phoneIsOffHook():
-			time.sleep(2)
-			print("Interruting audio via hook. Restarting.")
-			should_continue_recording = False
-			rid = r.pid
-			os.kill(rid, signal.SIGINT)
-			if not r.poll():
-				print("Recording stopped early.")
-
-			recordings_list = os.listdir("/media/pi/WONDERPHONE/katies_recordings/")
-			recordings_list.sort(reverse=True) #Sorts for reverse chronological order (most recent first, FILO)
-			if os.path.isfile("/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[0]):
-				os.remove("/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[0])
-			else:
-				print("Error: %s file not found" % myfile)
-			return -1
-
-		# Read keypad input
-		# Give output file time to be created
-		if message_length_in_seconds == 0:
-			time.sleep(2)
-			message_length_in_seconds += 2
-		btnval = readadc(0, SPICLK, SPIMOSI, SPIMISO, SPICS)
-
-		# If a key was pressed, stop audio and interrupt
-		if btnval > MIN_ADC_VAL_KEYPRESS_VAL:
-			should_continue_recording = False
-			button_released = False
-			break
-
-		# Sleep 5 ms
-		message_length_in_seconds += 0.05
-		time.sleep(0.05)
-
-	# Wait for the user to release any depressed buttons
-	while not button_released:
-		if readadc(0, SPICLK, SPIMOSI, SPIMISO, SPICS) == 0:
-			button_released = True
-		else: 
-			# Sleep 5 ms
-			time.sleep(0.05)
-
-	print("Interrupt Value:", btnval)
-	return btnval
-
-def handle_playback():
-	global p
-
-	is_playing_audio = False
-	should_continue_playing_audio = True
-	button_released = False
-	btnval = 0
-
-	# Wait for the user to release any depressed buttons
-	while not button_released:
-		if readadc(0, SPICLK, SPIMOSI, SPIMISO, SPICS) == 0:
-			button_released = True
-		else: 
-			# Sleep 5 ms
-			time.sleep(0.05)
-
-	# If a subprocess is playing audio, loop should be started.
-	try:
-		if p.poll() == None:
-			is_playing_audio = True
-			if DEBUG_AUDIO_OUT:
-				print("Playing audio...")
-	except NameError:
-		print ("p doesn't exist")
-
-	while is_playing_audio and should_continue_playing_audio:
-		# If subprocess is done playing audio, stop looping.
-		try:
-			if p.poll() != None:
-				is_playing_audio = False
-				break
-		except NameError:
-			print ("p doesn't exist")
-
-		# If the phone is hung up, end playback and restart.
-		if not phoneIsOffHook():
-			print("Interruting audio via hook. Restarting.")
-			should_continue_playing_audio = False
-			return -1
-
-		# Read keypad input
-		btnval = readadc(0, SPICLK, SPIMOSI, SPIMISO, SPICS)
-
-		# If a key was pressed, stop audio and interrupt
-		if btnval > MIN_ADC_VAL_KEYPRESS_VAL:
-			should_continue_playing_audio = False
-			button_released = False
-			break
-
-		# Sleep 5 ms
-		time.sleep(0.05)
-
-	# Wait for the user to release any depressed buttons
-	while not button_released:
-		if readadc(0, SPICLK, SPIMOSI, SPIMISO, SPICS) == 0:
-			button_released = True
-		else: 
-			# Sleep 5 ms
-			time.sleep(0.05)
-
-	print("Interrupt Value:", btnval)
-	return btnval
-
-#soft_reset: return to the main menu
-def soft_reset(): 
-	global MENU
+		key = await CORE.until_key(p)
+	finally:
+		BARGE_IN.disarm()
+	if key is None and BARGE_IN.reason == "key":
+		key = await CORE.next_key(timeout = KEY_EVENT_TIMEOUT * 3)
+		if DEBUG_AUDIO_OUT:
+			print("Barge-in:", ENGINE.cancel_stats())
+
+	# If the phone is hung up, end playback and restart.
+	if not phoneIsOffHook():
+		print("Interruting audio via hook. Restarting.")
+		return "hook"
+	print("Interrupt Value:", key)
+	return key
+
+async def wait_for_playback():
+	await CORE.finished(p)
+
+# reset: forget the call so far (the take that wasn't saved with # is thrown away); stop if the phone is on the hook
+def reset():
 	global PLAYBACK_INDEX
-	global SHOULD_PLAY_GREETINGS
 	global IS_FIRST_PLAYBACK
-	global p
-	global r
-	
-	# Reset global vars
-	MENU = []
+
 	PLAYBACK_INDEX = 0
 	IS_FIRST_PLAYBACK = True
 
 	hookval = GPIO.input(HOOK) # check value of hook switch
-
 	if DEBUG_HOOK:
 		print("Hookval", hookval)
 	if DEBUG_PRESSED:
@@ -294,383 +220,243 @@ def soft_reset():
 
 	try:
 		if p.poll() == None:
-			p.kill()
+			p.stop()
 			print("MEF: ending current playback; returning to main menu")
 	except NameError:
 		print("MEF: error; p does not exist")
 
-	try:
-		if r.poll() == None:
-			r.kill()
-	except NameError:
-		print("r doesn't exist")
+	discard_recording()
+	if not phoneIsOffHook():
+		return menu.STOP
 
-	if phoneIsOffHook():
-		if SHOULD_PLAY_GREETINGS:
-			if DEBUG_VERBOSE_OUTPUT:
-				print("Hello and welcome to the Wonderphone!")
-			play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/greetings_message.wav"])
-			p.wait()
-			SHOULD_PLAY_GREETINGS = False
-		if DEBUG_VERBOSE_OUTPUT:
-			print("Main Menu. Press 1 to record a new message. Press 2 to playback messages.")
-		play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/main_menu.wav"])
-		interrupt_value = handle_playback()
-		if interrupt_value > MIN_ADC_VAL_KEYPRESS_VAL:
-			raw_adc_handler(interrupt_value)
-			return
-		elif interrupt_value < 0:
-			try:
-				if p.poll() == None:
-					p.kill()
-					print("MEF: ending current playback; returning to main menu")
-			except NameError:
-				print("MEF: error; p does not exist")
-			try:
-				if r.poll() == None:
-					r.kill()
-			except NameError:
-				print("r doesn't exist")
-			return
-
-# restart: only triggered on full hang-up to refresh greeting message
-def restart(channel):
+# restart_greeting: a full hang-up plays the greeting again on the next pick-up
+def restart_greeting():
 	global SHOULD_PLAY_GREETINGS
 	SHOULD_PLAY_GREETINGS = True
-	soft_reset()
 
-def navigate_menu(key_that_was_pressed):
-	global MENU
-	global PLAYBACK_INDEX
+async def greeting():
+	global SHOULD_PLAY_GREETINGS
+	if SHOULD_PLAY_GREETINGS:
+		if DEBUG_VERBOSE_OUTPUT:
+			print("Hello and welcome to the Wonderphone!")
+		play_wav([ROOT + "katies_phone_prompts/greetings_message.wav"])
+		await CORE.finished(p)
+		SHOULD_PLAY_GREETINGS = False
+	if DEBUG_VERBOSE_OUTPUT:
+		print("Main Menu. Press 1 to record a new message. Press 2 to playback messages.")
+
+# next_savename: one past the highest take number in use, on disk or handed out this run
+# (takes still being written out, discarded ones); gaps from deletions are never refilled
+LAST_FILE_ID = 0
+def next_savename():
+	global LAST_FILE_ID
+	highest = LAST_FILE_ID
+	for name in reversed(RECORDINGS.names):
+		match = re.match(r"recording_#_(\d+)", name)
+		if match:
+			highest = max(highest, int(match.group(1)))
+			break			# names sort by number: the last one that matches is the highest
+	file_id = highest + 1
+	while os.path.exists(RECORDINGS_DIR + "recording_#_%08d.wav" % file_id):
+		file_id += 1
+	LAST_FILE_ID = file_id
+	return RECORDINGS_DIR + "recording_#_%08d.wav" % file_id
+
+# record_message: record until a keypress or the time limit; a hang-up cancels it and the take is thrown away
+async def record_message():
+	# RaspPi's w/o wifi cannot timestamp correctly, hence this file naming schema.
+	savename = next_savename()
+	print("Recording Started.")
+	await CORE.finished(p)
+	record_wav(savename)
+	if DEBUG_RECORDING:
+		print("Recording...")
+
+	# Wait for the user to release any depressed buttons, and give the take two seconds
+	# before a keypress can end it
+	await CORE.when(SAMPLER.add_release_callback)
+	await CORE.sleep(2)
+	CORE.drop_keys()
+
+	key = await CORE.until_key(r) # the recorder ends the take by itself at the 60 second limit; either way it has ended here
+	if key is not None:
+		print("Recording stopped early.")
+	await CORE.when(SAMPLER.add_release_callback)
+	if DEBUG_VERBOSE_OUTPUT:
+		print("Recording Ended.")
+		print("To re-record your message, press 1. To review your message, press 2. To save your message, press #. To discard your message and return to the main menu, press 0.")
+
+# discard_take: throw away the take and record again
+def discard_take():
+	discard_recording()
+
+async def discard_message():
+	if discard_recording():
+		if DEBUG_VERBOSE_OUTPUT:
+			print("Message discarded.")
+			play_wav([ROOT + "katies_phone_prompts/message_discarded.wav"])
+			await CORE.finished(p)
+
+def save_message():
+	r.save() # written out to the USB stick in the background, then added to RECORDINGS
+	USAGE.count("recordings_saved")
+	if DEBUG_VERBOSE_OUTPUT:
+		print("Message saved. Returning to Main Menu.")
+
+def play_take():
+	print("playing: " + r.playable_path())
+	play_wav([r.playable_path()])
+
+# check_messages: with nothing to play back, say so and go back to the main menu
+async def check_messages():
+	if len(RECORDINGS) == 0:
+		if DEBUG_VERBOSE_OUTPUT:
+			print("There are no saved messages. Try and make one of your own!")
+		play_wav([ROOT + "katies_phone_prompts/no_messages.wav"])
+		await CORE.finished(p)
+		return "reset"
+
+async def introduction():
 	global IS_FIRST_PLAYBACK
-	global ALLOW_CALLBACK_INTERRUPTS
-	global p
-	global r
+	if IS_FIRST_PLAYBACK:
+		if DEBUG_VERBOSE_OUTPUT:
+			print("Playback messages.")
+		play_wav([ROOT + "katies_phone_prompts/playback_introduction.wav"])
+		IS_FIRST_PLAYBACK = False
+		return await listen()
+
+async def last_message_notice():
+	print("Playback index: ")
+	print(PLAYBACK_INDEX)
+	if len(RECORDINGS) - 1 == PLAYBACK_INDEX:
+		if DEBUG_VERBOSE_OUTPUT:
+			print("Last message.")
+		play_wav([ROOT + "katies_phone_prompts/last_message.wav"])
+		await CORE.finished(p)
+
+def play_message():
+	play_wav([RECORDINGS.path(RECORDINGS.at(PLAYBACK_INDEX))])
+	USAGE.count("messages_played")
 
+def playback_instructions():
+	if len(RECORDINGS) - 1 == PLAYBACK_INDEX:
+		if DEBUG_VERBOSE_OUTPUT:
+			print("Press 1 to replay the message. Press 0 to return to return to the main menu.")
+		play_wav([ROOT + "katies_phone_prompts/playback_last_message_instructions.wav"])
+	else:
+		if DEBUG_VERBOSE_OUTPUT:
+			print("Press 1 to replay the message. Press 2 to continue to the next message. Press 0 to return to the main menu.")
+		play_wav([ROOT + "katies_phone_prompts/playback_instructions.wav"])
+
+async def next_message():
+	global PLAYBACK_INDEX
+	PLAYBACK_INDEX += 1
+	if PLAYBACK_INDEX >= len(RECORDINGS): 
+		if DEBUG_VERBOSE_OUTPUT:
+			print("No messages left.")
+		play_wav([ROOT + "katies_phone_prompts/no_messages_left.wav"])
+		await CORE.finished(p)
+		return "reset"
+	if DEBUG_VERBOSE_OUTPUT:
+		print("Next message.")
+	play_wav([ROOT + "katies_phone_prompts/next_message.wav"])
+	await CORE.finished(p)
+
+def menu_transition(state, key, transition):
+	print("------------------------------------------") # Separator for output
+	if DEBUG_PRESSED:
+		print("Key pressed: " + key)
+	print("Menu: %s -> %s" % (state, MENU.names[transition.target]), transition.label or "")
+
+MENU = menu.build(menus.KATIES_PHONE, {
+	"play": lambda *wav_filenames: play_wav(list(wav_filenames)),
+	"wait": wait_for_playback,
+	"listen": listen,
+	"record": record_message,
+	"discard": discard_take,
+	"discard_message": discard_message,
+	"save": save_message,
+	"play_take": play_take,
+	"greeting": greeting,
+	"reset": reset,
+	"restart": restart_greeting,
+	"check_messages": check_messages,
+	"introduction": introduction,
+	"last_message_notice": last_message_notice,
+	"play_message": play_message,
+	"playback_instructions": playback_instructions,
+	"next_message": next_message,
+}, on_transition = menu_transition)
+
+# predict_recordings: recordings the menu may play next, which its table can't know about
+def predict_recordings(state):
+	count = len(RECORDINGS)
+	if state == "main" and count > 0:
+		return [RECORDINGS.path(RECORDINGS.at(0))]
+	if state == "playback" and PLAYBACK_INDEX + 1 < count:
+		return [RECORDINGS.path(RECORDINGS.at(PLAYBACK_INDEX + 1))]
+	return []
+
+# While a prompt plays, the audio behind the keys most often pressed next is read ahead (prefetch.py)
+PREFETCH = prefetch.Prefetcher(MENU, PROMPT_CACHE, ASSETS, predict = predict_recordings)
+if SIM is not None:
+	SIM.attach(MENU, [RECORDINGS], ENGINE)
+USAGE.attach(MENU)
+
+# navigate_menu: runs on the core before each event is dispatched
+def navigate_menu(event):
 	# End any current running audio, if any.
 	try:
-		if p.poll() == None:
-			p.kill()
+		if event != "hook" and p.poll() == None:
+			p.stop()
 	except NameError:
 		print("p doesn't exist")
 
-	MENU.append(key_that_was_pressed)
-	print("------------------------------------------") # Separator for output
-	if DEBUG_PRESSED:
-		print("Key pressed: " + key_that_was_pressed)
-
-	recordings_list = os.listdir("/media/pi/WONDERPHONE/katies_recordings/")
-	recordings_list.sort(reverse=True) #Sorts for chronological order
-	print("recordings_list: ", recordings_list)
-
-	unresolved_input = True
-	ALLOW_CALLBACK_INTERRUPTS = True
-	while (unresolved_input):
-		print("Current menu stack:", MENU)
-		if MENU == ["1"]:
-			if DEBUG_VERBOSE_OUTPUT:
-				print("Record a message.")
-			play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/new_recording_instructions.wav"])
-			ALLOW_CALLBACK_INTERRUPTS = False
-			# RaspPi's w/o wifi cannot timestamp correctly, hence this file naming schema.
-			recordings_list = os.listdir("/media/pi/WONDERPHONE/katies_recordings/")
-			recordings_list.sort(reverse=True) #Sorts for chronological order
-			file_id = str(len(recordings_list) + 1)
-			while len(file_id) < 8:
-				file_id = "0" + file_id 
-			savename = "/media/pi/WONDERPHONE/katies_recordings/recording_#_" + file_id + ".wav"
-			print("Recording Started.")
-			p.wait()
-			record_wav(savename)
-			interrupt_value = handle_recording()
-			if interrupt_value > MIN_ADC_VAL_KEYPRESS_VAL:
-				rid = r.pid
-				os.kill(rid, signal.SIGINT)
-				if not r.poll():
-					print("Recording stopped early.")
-			elif interrupt_value < 0:
-				restart(HOOK)
-				return
-			if DEBUG_VERBOSE_OUTPUT:
-				print("Recording Ended.")
-			play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/recording_ended.wav"])
-			p.wait()
-			if DEBUG_VERBOSE_OUTPUT:	
-				print("To re-record your message, press 1. To review your message, press 2. To save your message, press #. To discard your message and return to the main menu, press 0.")
-			play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/post_recording_instructions.wav"])
-			unresolved_input = False
-			interrupt_value = handle_playback()
-			if interrupt_value > MIN_ADC_VAL_KEYPRESS_VAL:
-				raw_adc_handler(interrupt_value)
-				return
-			elif interrupt_value < 0:
-				recordings_list = os.listdir("/media/pi/WONDERPHONE/katies_recordings/")
-				recordings_list.sort(reverse=True) #Sorts for reverse chronological order (most recent first, FILO)
-				if os.path.isfile("/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[0]):
-					os.remove("/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[0])
-				else:
-					print("Error: %s file not found" % myfile)
-				restart(HOOK)
-				return
-			ALLOW_CALLBACK_INTERRUPTS = True
-		elif MENU == ["1", "1"]:
-			MENU.pop()
-			# Delete the newest recorded file
-			if os.path.isfile("/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[0]):
-				os.remove("/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[0])
-			else:
-				print("Error: %s file not found" % myfile)
-		elif MENU == ["1","2"]:
-			MENU.pop()
-			play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/replay_message.wav"])
-			p.wait()
-			print("playing: " + recordings_list[0])
-			play_wav(["/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[0]])
-			interrupt_value = handle_playback()
-			if interrupt_value > MIN_ADC_VAL_KEYPRESS_VAL:
-				raw_adc_handler(interrupt_value)
-				return
-			elif interrupt_value < 0:
-				recordings_list = os.listdir("/media/pi/WONDERPHONE/katies_recordings/")
-				recordings_list.sort(reverse=True) #Sorts for reverse chronological order (most recent first, FILO)
-				if os.path.isfile("/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[0]):
-					os.remove("/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[0])
-				else:
-					print("Error: %s file not found" % myfile)
-				restart(HOOK)
-				return
-			if DEBUG_VERBOSE_OUTPUT:
-				print("To re-record your message, press 1. To review your message, press 2. To save your message, press #. To discard your message and return to the main menu, press 0.")
-			play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/post_recording_instructions.wav"])
-			interrupt_value = handle_playback()
-			if interrupt_value > MIN_ADC_VAL_KEYPRESS_VAL:
-				raw_adc_handler(interrupt_value)
-				return
-			elif interrupt_value < 0:
-				recordings_list = os.listdir("/media/pi/WONDERPHONE/katies_recordings/")
-				recordings_list.sort(reverse=True) #Sorts for reverse chronological order (most recent first, FILO)
-				if os.path.isfile("/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[0]):
-					os.remove("/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[0])
-				else:
-					print("Error: %s file not found" % myfile)
-				restart(HOOK)
-				return
-			unresolved_input = False
-		elif MENU == ["1","0"]:
-			# Delete the newest recorded file
-			if os.path.isfile("/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[0]):
-				os.remove("/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[0])
-				if DEBUG_VERBOSE_OUTPUT:
-					print("Message discarded.")
-					play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/message_discarded.wav"])
-					p.wait()
-			else:
-				print("Error: %s file not found" % myfile)
-			unresolved_input = False
-			soft_reset()
-			return
-		elif MENU == ["1","#"]:
-			if DEBUG_VERBOSE_OUTPUT:
-				print("Message saved. Returning to Main Menu.")
-			play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/recording_saved.wav"])
-			p.wait()
-			unresolved_input = False
-			soft_reset()
-			return
-		elif MENU == ["2"]:
-			if len(recordings_list) == 0:
-				if DEBUG_VERBOSE_OUTPUT:
-					print("There are no saved messages. Try and make one of your own!")
-				play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/no_messages.wav"])
-				p.wait()
-				unresolved_input = False
-				soft_reset()
-				return
-			else: 
-				if IS_FIRST_PLAYBACK:
-					if DEBUG_VERBOSE_OUTPUT:
-						print("Playback messages.")
-					play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/playback_introduction.wav"])
-					IS_FIRST_PLAYBACK = False
-					interrupt_value = handle_playback()
-					if interrupt_value > MIN_ADC_VAL_KEYPRESS_VAL:
-						raw_adc_handler(interrupt_value)
-						return
-					elif interrupt_value < 0:
-						restart(HOOK)
-						return
-				print("Playback index: ")
-				print(PLAYBACK_INDEX)
-				if len(recordings_list) - 1 == PLAYBACK_INDEX:
-					if DEBUG_VERBOSE_OUTPUT:
-						print("Last message.")
-					play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/last_message.wav"])
-					p.wait()
-				play_wav(["/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[PLAYBACK_INDEX]])
-				interrupt_value = handle_playback()
-				if interrupt_value > MIN_ADC_VAL_KEYPRESS_VAL:
-					raw_adc_handler(interrupt_value)
-					return
-				elif interrupt_value < 0:
-					restart(HOOK)
-					return
-				if len(recordings_list) - 1 == PLAYBACK_INDEX:
-					if DEBUG_VERBOSE_OUTPUT:
-						print("Press 1 to replay the message. Press 0 to return to return to the main menu.")
-					play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/playback_last_message_instructions.wav"])
-					interrupt_value = handle_playback()
-					if interrupt_value > MIN_ADC_VAL_KEYPRESS_VAL:
-						raw_adc_handler(interrupt_value)
-						return
-					elif interrupt_value < 0:
-						restart(HOOK)
-						return
-				else:
-					if DEBUG_VERBOSE_OUTPUT:
-						print("Press 1 to replay the message. Press 2 to continue to the next message. Press 0 to return to the main menu.")
-					play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/playback_instructions.wav"])
-					interrupt_value = handle_playback()
-					if interrupt_value > MIN_ADC_VAL_KEYPRESS_VAL:
-						raw_adc_handler(interrupt_value)
-						return
-					elif interrupt_value < 0:
-						restart(HOOK)
-						return
-			unresolved_input = False
-		elif MENU == ["2","1"]:
-			MENU.pop()
-			if DEBUG_VERBOSE_OUTPUT:
-				print("Replay message.")
-			play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/replay_message.wav"])
-			interrupt_value = handle_playback()
-			if interrupt_value > MIN_ADC_VAL_KEYPRESS_VAL:
-				raw_adc_handler(interrupt_value)
-				return
-			elif interrupt_value < 0:
-				restart(HOOK)
-				return
-		elif MENU == ["2", "2"]:
-			MENU.pop()
-			PLAYBACK_INDEX += 1
-			if PLAYBACK_INDEX >= len(recordings_list): 
-				if DEBUG_VERBOSE_OUTPUT:
-					print("No messages left.")
-				play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/no_messages_left.wav"])
-				p.wait()
-				unresolved_input = False
-				soft_reset()
-				return
-			else:
-				if DEBUG_VERBOSE_OUTPUT:
-					print("Next message.")
-				play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/next_message.wav"])
-				p.wait()
-		elif MENU == ["2", "0"]:
-			unresolved_input = False
-			soft_reset()
-			return
-		elif len(MENU) > 1 and MENU[0] == "1":
-			MENU.pop()
-			if DEBUG_VERBOSE_OUTPUT:
-				print("To re-record your message, press 1. To review your message, press 2. To save your message, press #. To discard your message and return to the main menu, press 0.")
-			play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/post_recording_instructions.wav"])
-			interrupt_value = handle_playback()
-			if interrupt_value > MIN_ADC_VAL_KEYPRESS_VAL:
-				raw_adc_handler(interrupt_value)
-				return
-			elif interrupt_value < 0:
-				recordings_list = os.listdir("/media/pi/WONDERPHONE/katies_recordings/")
-				recordings_list.sort(reverse=True) #Sorts for reverse chronological order (most recent first, FILO)
-				if os.path.isfile("/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[0]):
-					os.remove("/media/pi/WONDERPHONE/katies_recordings/" + recordings_list[0])
-				else:
-					print("Error: %s file not found" % myfile)
-				restart(HOOK)
-				return
-			unresolved_input = False
-		elif len(MENU) > 1 and MENU[0] == "2":
-			MENU.pop()
-			if len(recordings_list) - 1 == PLAYBACK_INDEX:
-				if DEBUG_VERBOSE_OUTPUT:
-					print("Press 1 to replay the message. Press 0 to return to return to the main menu.")
-				play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/playback_last_message_instructions.wav"])
-				interrupt_value = handle_playback()
-				if interrupt_value > MIN_ADC_VAL_KEYPRESS_VAL:
-					raw_adc_handler(interrupt_value)
-					return
-				elif interrupt_value < 0:
-					restart(HOOK)
-					return
-			else:
-				if DEBUG_VERBOSE_OUTPUT:
-					print("Press 1 to replay the message. Press 2 to continue to the next message. Press 0 to return to the main menu.")
-				play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/playback_instructions.wav"])
-				interrupt_value = handle_playback()
-				if interrupt_value > MIN_ADC_VAL_KEYPRESS_VAL:
-					raw_adc_handler(interrupt_value)
-					return
-				elif interrupt_value < 0:
-					restart(HOOK)
-					return
-			unresolved_input = False
-		else:
-			MENU.pop()
-			if DEBUG_VERBOSE_OUTPUT:
-				print("Main Menu. Press 1 to record a new message. Press 2 to playback messages.")
-			play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/main_menu.wav"])
-			interrupt_value = handle_playback()
-			if interrupt_value > MIN_ADC_VAL_KEYPRESS_VAL:
-				raw_adc_handler(interrupt_value)
-				return
-			elif interrupt_value < 0:
-				restart(HOOK)
-				return
-			unresolved_input = False
+	print("recordings: %d, newest: %s" % (len(RECORDINGS), RECORDINGS.newest()))
+
+# CONTROL CORE
+# GPIO callbacks only post events; one asyncio loop runs the menu (core.py)
+CORE = core.PhoneCore(MENU, before = navigate_menu, speed = SIM.speed if SIM else 1.0)
+
+# restart: only triggered on full hang-up to refresh greeting message
+def restart(channel):
+	if not phoneIsOffHook():
+		BARGE_IN.hung_up()
+	USAGE.hook(phoneIsOffHook())
+	CORE.post("hook")
 
 #------------------------------------------ KEYPAD ------------------------------------------
 def raw_adc_handler(btnval):
-	# Associate numeric press with ADC value
-	# These are not perfect, imperfections due to connecting wires may be unstable and unreliable.
+	# Associate numeric press with ADC value through the calibrated lookup table (keypad.py)
+	# Wiring imperfections make the bands drift; recalibrate with "python3 keypad.py calibrate".
 	if DEBUG_RAWADC:
 		print ("[Raw ADC Handler] btnval:", btnval)
 
-	if btnval != 0:
-		if btnval > 960: # 1
-			navigate_menu("1")
-		elif btnval > 870 and btnval < 910: # 2
-			navigate_menu("2")
-		elif btnval > 760 and btnval < 810: # 3
-			navigate_menu("3")
-		elif btnval > 700 and btnval < 750: # 4
-			navigate_menu("4")
-		elif btnval > 650 and btnval < 670: # 5
-			navigate_menu("5")
-		elif btnval > 580 and btnval < 610: # 6
-			navigate_menu("6")
-		elif btnval > 540 and btnval < 570: # 7
-			navigate_menu("7")
-		elif btnval > 500 and btnval < 525: # 8
-			navigate_menu("8")
-		elif btnval > 470 and btnval < 490: # 9	
-			navigate_menu("9")
-		elif btnval > 420 and btnval < 440: # 0
-			navigate_menu("0")
-		elif btnval > 445 and btnval < 470: # star
-			navigate_menu("*")
-		elif btnval > 390 and btnval < 420: # pound
-			navigate_menu("#")
+	key = KEYPAD.decode(btnval)
+	if key is not None:
+		CORE.post(key)
 
 
 # determine what to do when a button is pressed
 def button_handler(channel):
-	if phoneIsOffHook() and ALLOW_CALLBACK_INTERRUPTS:
-		btnval = readadc(0, SPICLK, SPIMOSI, SPIMISO, SPICS) # check raw value of ADC
+	if phoneIsOffHook():
+		BARGE_IN.key_pressed()
+		# take the debounced press that raised this edge from the sampler
+		event = SAMPLER.next_press(timeout = KEY_EVENT_TIMEOUT, since = time.monotonic() - KEY_EVENT_TIMEOUT)
+		btnval = event.value if event is not None else SAMPLER.latest()
 		if DEBUG_RAWADC:
 			print ("[Button Handler] btnval:", btnval)
 		raw_adc_handler(btnval)
 
 def main():
 	try:
+		SAMPLER.start()
+		RECORDINGS.start_watching()
+		TRANSCODER.submit_backlog(RECORDINGS)
+		PROMPT_CACHE.preload() # read every prompt off the USB stick once, before the first call
+		CORE.start()
+		USAGE.start()
+		tracing.start() # latency histograms of the hot paths, with WONDERPHONE_TRACE=/path/trace.json (tracing.py)
 		restart(HOOK) # When the phone is picked up:
 		logger.debug("---------PROGRAM START---------")
 		print("Waiting for action...")
@@ -679,13 +465,16 @@ def main():
 		GPIO.wait_for_edge(EXIT, GPIO.RISING) # wait for exit button
 		if DEBUG_VERBOSE_OUTPUT:
 			print("Something made the exit trigger.")
-		play_wav(["/media/pi/WONDERPHONE/katies_phone_prompts/something_went_wrong.wav"])
+		play_wav([ROOT + "katies_phone_prompts/something_went_wrong.wav"])
 		p.wait()
 		print("Quitting program.")
+		logger.debug("prompt cache: " + str(PROMPT_CACHE.stats()) + " prebuilt: " + str(ASSETS.stats()) + " prefetch: " + str(PREFETCH.stats()) + " core: " + str(CORE.stats()))
+		logger.debug("recorder: " + str(RECORDER.stats()) + " transcoder: " + str(TRANSCODER.stats()) + " trimmer: " + str(TRIMMER.stats()))
+		logger.debug("barge-in: " + str(BARGE_IN.fire_count) + " cancel-to-silence: " + str(ENGINE.cancel_stats()))
 		logger.debug("----------PROGRAM END----------")
 		try:
 			if p.poll() == None: 	# If the process is still running... 
-				p.kill()				# kill it
+				p.stop()				# kill it
 		except NameError:
 			print ("p doesn't exist")
 		try:
@@ -696,7 +485,7 @@ def main():
 	except KeyboardInterrupt:
 		try:
 			if p.poll() == None:
-				p.kill()
+				p.stop()
 		except NameError:
 			print ("p doesn't exist")
 		try:
@@ -705,6 +494,19 @@ def main():
 		except NameError:
 			print ("r doesn't exist")
 		GPIO.cleanup()		# clean up GPIO on CTRL+C exit
+	CORE.close()
+	SAMPLER.close()
+	RECORDER.close()
+	TRANSCODER.close()
+	TRIMMER.close()
+	PREFETCH.close()
+	RECORDINGS.close()
+	BARGE_IN.close()
+	ENGINE.close()			# release the sound device
+	tracing.close()			# final export of the histograms
+	USAGE.close()			# last usage snapshot
+	logger.debug("log writer: " + str(handler.stats()))
+	handler.close()			# write out the last queued log lines
 	sys.exit(0)				# system exit
 	GPIO.cleanup()			# clean up GPIO on normal exit
 
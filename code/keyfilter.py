@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# Multi-sample key decisions for the Wonderphone keypad.
+# One ADC read is not enough to trust on this wiring, so a key is only decided
+# from a short burst of samples, either by their median or by a majority vote over
+# the keys each sample decodes to, and only when the burst agrees well enough.
+#
+# Offline harness: replay captured press traces and compare filter settings.
+#   python3 keyfilter.py capture -o presses.jsonl [--adc bitbang]   (on the phone)
+#   python3 keyfilter.py synth -o presses.jsonl                      (noisy synthetic traces)
+#   python3 keyfilter.py replay presses.jsonl [--windows 1,3,5,7] [--methods median,vote] [--agreement 0.3,0.4,0.6]
+# With the keys' interval bands, a burst that is more than half one key also has its
+# median in that key's band, so median and vote only decide differently when the
+# agreement asked for is below one half; the replay sweeps it across that line.
+# A trace file has one JSON object per line: {"key": "5", "samples": [...]}, the samples
+# starting at the first one above the noise threshold.
+
+import sys, json, argparse, random, time
+import numpy as np
+import keypad, sampler, tracing
+
+SAMPLE_INTERVAL = sampler.SAMPLE_INTERVAL	# latencies are reported at the live sampling rate
+
+class KeyFilter:
+	# method: "median" (decode the median sample) or "vote" (most common decoded key)
+	# min_agreement: fraction of the window that must decode to the chosen key
+	def __init__(self, table, window=5, method="vote", min_agreement=0.6):
+		if method not in ("median", "vote"):
+			raise ValueError("Unknown filter method: " + method)
+		self.window = window
+		self.method = method
+		self.min_agreement = min_agreement
+		self.keys = sorted(set(k for k in table.table if k is not None), key=keypad.KEYS.index)
+		# code -> key index (-1 for no key), so a whole window decodes in one take()
+		self.index = np.array([-1 if k is None else self.keys.index(k) for k in table.table], dtype=np.int8)
+
+	# decide: (key, representative adc value) for the last `window` samples, or None if not confident
+	@tracing.timed("key.filter")
+	def decide(self, samples):
+		if len(samples) < self.window:
+			return None
+		values = np.clip(np.asarray(samples[-self.window:], dtype=np.int16), 0, keypad.ADC_CODES - 1)
+		decoded = self.index.take(values)
+		if self.method == "median":
+			value = int(np.median(values))
+			winner = self.index[value]
+			if winner < 0:
+				return None
+		else:
+			valid = decoded[decoded >= 0]
+			if len(valid) == 0:
+				return None
+			winner = np.bincount(valid).argmax()
+			value = int(np.median(values[decoded == winner]))
+		if np.count_nonzero(decoded == winner) < self.min_agreement * self.window:
+			return None
+		return self.keys[winner], value
+
+	# decide_trace: first confident decision over a whole press trace, vectorized across
+	# every window position; returns (key, samples consumed) or (None, len(samples))
+	def decide_trace(self, samples):
+		values = np.clip(np.asarray(samples, dtype=np.int16), 0, keypad.ADC_CODES - 1)
+		if len(values) < self.window:
+			return None, len(values)
+		windows = np.lib.stride_tricks.sliding_window_view(values, self.window)
+		decoded = self.index.take(windows)
+		if self.method == "median":
+			winners = self.index.take(np.median(windows, axis=1).astype(np.int16))
+		else:
+			# per-window vote: count each key index across the window
+			counts = np.stack([(decoded == k).sum(axis=1) for k in range(len(self.keys))], axis=1)
+			winners = np.where(counts.max(axis=1) > 0, counts.argmax(axis=1), -1)
+		agreement = (decoded == winners[:, None]).sum(axis=1)
+		confident = (winners >= 0) & (agreement >= self.min_agreement * self.window)
+		hits = np.flatnonzero(confident)
+		if len(hits) == 0:
+			return None, len(values)
+		first = hits[0]
+		return self.keys[winners[first]], first + self.window
+
+#------------------------------------------ HARNESS ------------------------------------------
+
+def load_traces(paths):
+	traces = []
+	for path in paths:
+		with open(path) as f:
+			for line in f:
+				if line.strip():
+					traces.append(json.loads(line))
+	return traces
+
+# evaluate: accuracy and decision latency of one filter setting over a set of traces
+def evaluate(key_filter, traces):
+	correct = wrong = missed = 0
+	latencies = []
+	for trace in traces:
+		key, used = key_filter.decide_trace(trace["samples"])
+		if key is None:
+			missed += 1
+			continue
+		latencies.append(used * SAMPLE_INTERVAL)
+		if key == trace["key"]:
+			correct += 1
+		else:
+			wrong += 1
+	total = len(traces)
+	return {
+		"accuracy": correct / total if total else 0.0,
+		"wrong": wrong,
+		"missed": missed,
+		"mean_latency_ms": 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+		"max_latency_ms": 1000 * max(latencies) if latencies else 0.0,
+	}
+
+# synth_trace: a press with a rising edge, gaussian noise and occasional wild reads
+def synth_trace(key, bands, length=40, noise=12.0, glitch_rate=0.08):
+	low, high = bands[key]
+	center = (low + min(high, 1010)) / 2.0
+	samples = []
+	for i in range(length):
+		value = center * min(1.0, (i + 1) / 3.0) + random.gauss(0, noise)
+		if random.random() < glitch_rate:
+			value = random.randint(0, 1023)
+		samples.append(int(min(1023, max(0, value))))
+	threshold = keypad.DEFAULT_THRESHOLD
+	first = next((i for i, v in enumerate(samples) if v > threshold), 0)
+	return {"key": key, "samples": samples[first:]}
+
+def capture(driver, output, presses, channel=0, duration=0.3):
+	with open(output, "a") as f:
+		for n in range(presses):
+			key = random.choice(keypad.KEYS)
+			print("Press and hold %s" % key)
+			while driver.read(channel) <= keypad.DEFAULT_THRESHOLD:
+				time.sleep(0.001)
+			samples = []
+			end = time.monotonic() + duration
+			while time.monotonic() < end:
+				samples.append(driver.read(channel))
+				time.sleep(SAMPLE_INTERVAL)
+			f.write(json.dumps({"key": key, "samples": samples}) + "\n")
+			print("  release")
+			while driver.read(channel) > keypad.DEFAULT_THRESHOLD:
+				time.sleep(0.01)
+
+def main():
+	parser = argparse.ArgumentParser(description="Wonderphone key filter harness")
+	sub = parser.add_subparsers(dest="command")
+	r = sub.add_parser("replay", help="report accuracy and latency per filter setting")
+	r.add_argument("traces", nargs="+")
+	r.add_argument("--windows", default="1,3,5,7")
+	r.add_argument("--methods", default="median,vote")
+	r.add_argument("--agreement", default="0.3,0.4,0.5,0.6,0.8")
+	r.add_argument("--calibration", default=keypad.DEFAULT_CALIBRATION_FILE)
+	c = sub.add_parser("capture", help="record real press traces from the ADC")
+	c.add_argument("-o", "--output", required=True)
+	c.add_argument("-n", "--presses", type=int, default=48)
+	c.add_argument("--adc", default="bitbang")
+	s = sub.add_parser("synth", help="write noisy synthetic traces")
+	s.add_argument("-o", "--output", required=True)
+	s.add_argument("-n", "--presses", type=int, default=1200)
+	s.add_argument("--noise", type=float, default=12.0)
+	s.add_argument("--seed", type=int, default=1)
+	args = parser.parse_args()
+
+	if args.command == "replay":
+		table = keypad.load(args.calibration)
+		traces = load_traces(args.traces)
+		print("%d traces" % len(traces))
+		print("%-7s %6s %6s %9s %6s %7s %10s %10s" % ("method", "window", "agree", "accuracy", "wrong", "missed", "mean ms", "max ms"))
+		for agreement in [float(a) for a in args.agreement.split(",")]:
+			for method in args.methods.split(","):
+				for window in [int(w) for w in args.windows.split(",")]:
+					result = evaluate(KeyFilter(table, window, method, agreement), traces)
+					print("%-7s %6d %6.2f %8.1f%% %6d %7d %10.1f %10.1f" % (method, window, agreement, 100 * result["accuracy"],
+						result["wrong"], result["missed"], result["mean_latency_ms"], result["max_latency_ms"]))
+	elif args.command == "capture":
+		import adc
+		driver = adc.open_standalone(args.adc)
+		try:
+			capture(driver, args.output, args.presses)
+		finally:
+			driver.close()
+	elif args.command == "synth":
+		random.seed(args.seed)
+		with open(args.output, "w") as f:
+			for n in range(args.presses):
+				f.write(json.dumps(synth_trace(random.choice(keypad.KEYS), keypad.DEFAULT_BANDS, noise=args.noise)) + "\n")
+	else:
+		parser.print_help()
+		return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# Table-driven keypad decoding for the Wonderphone.
+# Each key pulls the ADC to its own voltage band. Instead of a chain of range checks,
+# decode() looks the 10-bit ADC value up in a precomputed 1024-entry table.
+# The bands come from a calibration file written by the calibration mode below;
+# without one, the bands that katies_payphone.py has always used are the default.
+# Values that fall between two bands go to the nearer one, so a press is not
+# silently dropped when the wiring drifts a little.
+#
+# Calibrate on the phone:  sudo python3 keypad.py calibrate [--adc bitbang] [-o FILE]
+# Show the current table:  python3 keypad.py show [-f FILE]
+
+import os, sys, json, argparse, time, logging
+import tracing
+
+logger = logging.getLogger('logwonderphone')
+
+KEYS = ["1", "2", "3", "4", "5", "6", "7", "8", "9", "*", "0", "#"]
+ADC_CODES = 1024
+DEFAULT_THRESHOLD = 390		# values at or below this are noise, not a key
+DEFAULT_CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "keypad_calibration.json")
+
+# inclusive (low, high) adc bands per key, from the original raw_adc_handler.
+# payphone.py used to take "1" only above 980; it now shares these bands, so 961..980
+# reads as "1" there too (with the gaps filled, it would go to "1" either way).
+DEFAULT_BANDS = {
+	"1": (961, 1023),
+	"2": (871, 909),
+	"3": (761, 809),
+	"4": (701, 749),
+	"5": (651, 669),
+	"6": (581, 609),
+	"7": (541, 569),
+	"8": (501, 524),
+	"9": (471, 489),
+	"*": (446, 469),
+	"0": (421, 439),
+	"#": (391, 419),
+}
+
+# build_table: expand bands into a list mapping every adc code to a key (or None)
+def build_table(bands, threshold=DEFAULT_THRESHOLD, fill_gaps=True):
+	table = [None] * ADC_CODES
+	for key, (low, high) in bands.items():
+		for code in range(max(low, threshold + 1), min(high, ADC_CODES - 1) + 1):
+			table[code] = key
+	if fill_gaps:
+		ordered = sorted(bands.items(), key=lambda kv: kv[1][0])
+		for code in range(threshold + 1, ADC_CODES):
+			if table[code] is not None:
+				continue
+			# distance from this code to each band; the nearest band wins
+			table[code] = min(ordered, key=lambda kv: max(kv[1][0] - code, code - kv[1][1]))[0]
+	return table
+
+class KeyTable:
+	def __init__(self, table, threshold=DEFAULT_THRESHOLD, bands=None):
+		self.table = table
+		self.threshold = threshold
+		self.bands = bands
+
+	# decode: the key for an adc value, or None for noise / out of range
+	@tracing.timed("key.decode")
+	def decode(self, value):
+		if 0 <= value < ADC_CODES:
+			return self.table[value]
+		return None
+
+# load: read the calibration file, falling back to the built-in bands
+def load(path=DEFAULT_CALIBRATION_FILE):
+	try:
+		with open(path) as f:
+			data = json.load(f)
+	except FileNotFoundError:
+		return KeyTable(build_table(DEFAULT_BANDS), DEFAULT_THRESHOLD, DEFAULT_BANDS)
+	threshold = data.get("threshold", DEFAULT_THRESHOLD)
+	bands = dict((k, tuple(v)) for k, v in data["bands"].items())
+	table = data.get("table") or build_table(bands, threshold)
+	if len(table) != ADC_CODES:
+		raise ValueError("%s: table must have %d entries" % (path, ADC_CODES))
+	return KeyTable(table, threshold, bands)
+
+def save(path, bands, threshold=DEFAULT_THRESHOLD):
+	data = {
+		"threshold": threshold,
+		"bands": dict((k, list(v)) for k, v in bands.items()),
+		"table": build_table(bands, threshold),
+	}
+	tmp = path + ".tmp"
+	with open(tmp, "w") as f:
+		json.dump(data, f, indent=1)
+	os.replace(tmp, path)
+
+#------------------------------------------ CALIBRATION ------------------------------------------
+
+# percentile: value at fraction q of an already sorted list
+def percentile(values, q):
+	return values[min(len(values) - 1, int(q * len(values)))]
+
+# bands_from_samples: pick band edges from the observed samples per key.
+# Keys are ordered by median value; the edge between two neighbours sits halfway
+# between the top of the lower key's spread and the bottom of the upper key's.
+def bands_from_samples(samples_by_key, threshold=DEFAULT_THRESHOLD):
+	spread = {}
+	for key, samples in samples_by_key.items():
+		values = sorted(v for v in samples if v > threshold)
+		if not values:
+			raise ValueError("no samples above the noise threshold for key " + key)
+		spread[key] = (percentile(values, 0.02), percentile(values, 0.5), percentile(values, 0.98))
+
+	ordered = sorted(spread, key=lambda k: spread[k][1])
+	bands = {}
+	low = threshold + 1
+	for lower, upper in zip(ordered, ordered[1:]):
+		top_of_lower = spread[lower][2]
+		bottom_of_upper = spread[upper][0]
+		if bottom_of_upper <= top_of_lower:
+			logger.warning("keypad: keys %s and %s overlap (%d..%d)", lower, upper, bottom_of_upper, top_of_lower)
+		edge = (top_of_lower + bottom_of_upper) // 2
+		bands[lower] = (low, edge)
+		low = edge + 1
+	bands[ordered[-1]] = (low, ADC_CODES - 1)
+	return bands
+
+# calibrate: ask for each key in turn and record samples while it is held
+def calibrate(driver, keys=KEYS, samples=200, channel=0):
+	samples_by_key = {}
+	for key in keys:
+		input("Hold down %s and press Enter..." % key)
+		collected = []
+		while len(collected) < samples:
+			collected.extend(driver.read_many(channel, 20))
+			time.sleep(0.01)
+		samples_by_key[key] = collected
+		values = sorted(collected)
+		print("  %s: min %d  median %d  max %d" % (key, values[0], percentile(values, 0.5), values[-1]))
+	return samples_by_key
+
+def main():
+	parser = argparse.ArgumentParser(description="Wonderphone keypad table tools")
+	sub = parser.add_subparsers(dest="command")
+	c = sub.add_parser("calibrate", help="record samples per key and write the lookup table")
+	c.add_argument("--adc", default="bitbang", help="ADC backend (see adc.py)")
+	c.add_argument("-n", "--samples", type=int, default=200, help="samples per key")
+	c.add_argument("-o", "--output", default=DEFAULT_CALIBRATION_FILE)
+	s = sub.add_parser("show", help="print the band edges in use")
+	s.add_argument("-f", "--file", default=DEFAULT_CALIBRATION_FILE)
+	args = parser.parse_args()
+
+	if args.command == "calibrate":
+		import adc
+		driver = adc.open_standalone(args.adc)
+		try:
+			bands = bands_from_samples(calibrate(driver, samples=args.samples))
+		finally:
+			driver.close()
+		save(args.output, bands)
+		print("wrote " + args.output)
+	elif args.command == "show":
+		table = load(args.file)
+		for key, (low, high) in sorted(table.bands.items(), key=lambda kv: -kv[1][0]):
+			print("%s: %4d..%4d" % (key, low, high))
+	else:
+		parser.print_help()
+		return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
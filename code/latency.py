@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# End-to-end latency benchmark for the Wonderphone.
+# Measures what a visitor feels, over many simulated sessions (sim.py): each phone
+# script replays jittered copies of its visitor session from traces/, and the
+# simulator's timeline gives, in real time,
+#   pickup		handset lifted -> first sample of the greeting / language prompt
+#   key			keypress -> first sample of the prompt it leads to, per menu transition
+#				("key main --1--> recorded") and over all of them ("key")
+#   hangup		handset down -> playback cut off
+#   save		# pressed -> the take is in the recordings index
+# and reports p50/p95/p99 in milliseconds. A prompt counts from its own first sample,
+# and only prompts asked for after the stimulus do, so one queued behind the tail of
+# an earlier prompt is measured from when it is really heard. Waits that are bounded by one audio period
+# (a stop lands at the next period) are shortened by the simulator's speed, so runs
+# are only comparable at the same speed; a baseline remembers the one it was made at.
+#
+#   python3 latency.py run [--phone katies] [-n SESSIONS] [--speed 20] [--seed 1]
+#                          [--save | --check] [--baseline latency_baseline.json]
+#                          [--threshold 0.25] [--slack-ms 5]
+# --save writes the results as the new baseline; --check fails (exit 1) when any
+# percentile with enough samples is worse than the baseline's by more than
+# threshold (a fraction) plus slack-ms.
+
+import os, sys, json, shutil, random, argparse, tempfile
+import sim
+
+SESSIONS 		= 10
+SPEED 			= 20.0
+JITTER 			= 0.2		# each gap between trace events is stretched or shrunk by up to this fraction
+SESSION_GAP 	= 4.0		# virtual seconds between one visitor hanging up and the next picking up
+RESPONSE_WINDOW = 2.0		# real seconds; a prompt starting later than this is not the response to a stimulus
+SAVE_WINDOW 	= 10.0		# real seconds for a saved take to reach the recordings index
+PERCENTILES 	= (50, 95, 99)
+MIN_SAMPLES 	= 5			# fewer samples than this are reported but not checked
+THRESHOLD 		= 0.25
+SLACK_MS 		= 5.0
+BASELINE_FILE 	= os.path.join(os.path.dirname(os.path.abspath(__file__)), "latency_baseline.json")
+TRACES 			= dict((phone, os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces", phone + "_session.json"))
+					for phone in sim.SCRIPTS)
+
+# sessions: count copies of a session's events, one after another, with jittered timing
+def sessions(events, count, seed=1, jitter=JITTER, gap=SESSION_GAP):
+	rng = random.Random(seed)
+	events = sorted(events, key=lambda e: e["at"])
+	out = []
+	offset = 0.0
+	for i in range(count):
+		at = offset
+		previous = events[0]["at"]
+		for event in events:
+			at += (event["at"] - previous) * rng.uniform(1 - jitter, 1 + jitter)
+			previous = event["at"]
+			if "end" not in event:
+				out.append(dict(event, at=round(at, 3)))
+		offset = at + gap
+	out.append({"at": round(offset, 3), "end": True})
+	return out
+
+# measure: latencies in ms by name from a simulator timeline
+def measure(timeline):
+	samples = {}
+	def add(name, start, end):
+		samples.setdefault(name, []).append(1000 * (end - start))
+
+	# first_start: the first prompt asked for at or after since to reach the sink
+	def first_start(entries, since):
+		return next((e for e in entries if tuple(e[1:3]) == ("audio", "start") and e[4] >= since), None)
+
+	stimuli = [i for i, entry in enumerate(timeline) if entry[1] in ("key", "hook")]
+	for n, i in enumerate(stimuli):
+		t, what, detail = timeline[i][:3]
+		until = timeline[stimuli[n + 1]][0] if n + 1 < len(stimuli) else float("inf")
+		after = [e for e in timeline[i + 1:] if e[0] < min(until, t + RESPONSE_WINDOW)]
+		if what == "hook":
+			if detail == "off":
+				response = first_start(after, t)
+			else:
+				response = next((e for e in after if tuple(e[1:3]) == ("audio", "stop")), None)
+			if response is not None:
+				add("pickup" if detail == "off" else "hangup", t, response[0])
+			continue
+		move = next((e for e in after if e[1] == "transition" and e[3] == detail), None)
+		if move is not None:
+			start = first_start(after, move[0])
+			if start is not None:
+				add("key", t, start[0])
+				add("key %s --%s--> %s" % (move[2], detail, move[4]), t, start[0])
+		if detail == "#":
+			saved = next((e for e in timeline[i + 1:] if e[1] == "saved" and e[0] < t + SAVE_WINDOW), None)
+			if saved is not None and not any(e[0] < saved[0] and e[1] == "key" and e[2] == "#" for e in timeline[i + 1:]):
+				add("save", t, saved[0])
+	return samples
+
+# percentile: value at q percent of an already sorted list
+def percentile(values, q):
+	return values[min(len(values) - 1, int(q / 100.0 * len(values)))]
+
+def summarize(samples):
+	summary = {}
+	for name, values in samples.items():
+		values = sorted(values)
+		summary[name] = dict([("n", len(values))] + [("p%d" % q, round(percentile(values, q), 2)) for q in PERCENTILES])
+	return summary
+
+# bench_phone: replay count sessions through a phone script; returns (summary, failure message or None)
+def bench_phone(phone, count, speed=SPEED, seed=1):
+	events, options = sim.load_trace(TRACES[phone])
+	work = tempfile.mkdtemp(prefix="wonderphone-latency-")
+	try:
+		content = os.path.join(work, "content")
+		sim.make_content(content)
+		trace = os.path.join(work, "trace.json")
+		with open(trace, "w") as f:
+			json.dump(dict(options, events=sessions(events, count, seed)), f)
+		timeline_path = os.path.join(work, "timeline.jsonl")
+		returncode, errors = sim.run(phone, trace, content, speed, timeline=timeline_path, quiet=True)
+		if returncode != 0 or errors or not os.path.exists(timeline_path):
+			return None, "%s: exit status %d, %d errors logged%s" % (phone, returncode, len(errors),
+				"".join("\n  " + line for line in errors[:5]))
+		with open(timeline_path) as f:
+			timeline = [json.loads(line) for line in f]
+	finally:
+		shutil.rmtree(work, ignore_errors=True)
+	return summarize(measure(timeline)), None
+
+# regressions: (phone, metric, percentile, baseline, now) for every percentile past the allowance
+def regressions(results, baseline, threshold=THRESHOLD, slack_ms=SLACK_MS):
+	found = []
+	for phone, metrics in results.items():
+		for name, now in metrics.items():
+			before = baseline.get("phones", {}).get(phone, {}).get(name)
+			if before is None or now["n"] < MIN_SAMPLES or before["n"] < MIN_SAMPLES:
+				continue
+			for q in PERCENTILES:
+				p = "p%d" % q
+				if now[p] > before[p] * (1 + threshold) + slack_ms:
+					found.append((phone, name, p, before[p], now[p]))
+	return found
+
+def main():
+	parser = argparse.ArgumentParser(description="End-to-end latency of Wonderphone interactions")
+	sub = parser.add_subparsers(dest="command")
+	r = sub.add_parser("run", help="replay simulated sessions and report latency percentiles")
+	r.add_argument("--phone", choices=sorted(sim.SCRIPTS) + ["all"], default="all")
+	r.add_argument("-n", "--sessions", type=int, default=SESSIONS)
+	r.add_argument("--speed", type=float, default=SPEED)
+	r.add_argument("--seed", type=int, default=1)
+	r.add_argument("--baseline", default=BASELINE_FILE)
+	mode = r.add_mutually_exclusive_group()
+	mode.add_argument("--save", action="store_true", help="write the results as the baseline")
+	mode.add_argument("--check", action="store_true", help="fail if a percentile regressed against the baseline")
+	r.add_argument("--threshold", type=float, default=THRESHOLD, help="fraction a percentile may grow by")
+	r.add_argument("--slack-ms", type=float, default=SLACK_MS, help="ms a percentile may grow by on top of the threshold")
+	args = parser.parse_args()
+	if args.command != "run":
+		parser.print_help()
+		return 1
+
+	baseline = None
+	if args.check:
+		if not os.path.exists(args.baseline):
+			print("no baseline at %s; make one with --save on the reference machine" % args.baseline)
+			return 2
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		if baseline.get("speed") != args.speed:
+			print("baseline was made at speed %s, not %s; rerun with --speed %s" % (baseline.get("speed"), args.speed, baseline.get("speed")))
+			return 2
+
+	phones = sorted(sim.SCRIPTS) if args.phone == "all" else [args.phone]
+	results = {}
+	for phone in phones:
+		summary, failure = bench_phone(phone, args.sessions, args.speed, args.seed)
+		if failure is not None:
+			print("FAILED: " + failure)
+			return 1
+		results[phone] = summary
+		print("%s: %d sessions at %gx" % (phone, args.sessions, args.speed))
+		print("  %-44s %5s %9s %9s %9s" % ("interaction", "n", "p50 ms", "p95 ms", "p99 ms"))
+		order = ["pickup", "key", "hangup", "save"]
+		for name in sorted(summary, key=lambda n: (order.index(n) if n in order else len(order), n)):
+			s = summary[name]
+			print("  %-44s %5d %9.1f %9.1f %9.1f" % (name, s["n"], s["p50"], s["p95"], s["p99"]))
+
+	if args.save:
+		with open(args.baseline, "w") as f:
+			json.dump({"speed": args.speed, "sessions": args.sessions, "seed": args.seed, "phones": results}, f, indent=1, sort_keys=True)
+		print("baseline written to " + args.baseline)
+	if baseline is not None:
+		found = regressions(results, baseline, args.threshold, args.slack_ms)
+		for phone, name, p, before, now in found:
+			print("REGRESSION %s %s %s: %.1f ms -> %.1f ms" % (phone, name, p, before, now))
+		if found:
+			return 1
+		print("no regressions against " + args.baseline)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
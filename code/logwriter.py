@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+# Non-blocking log file handler for the Wonderphone.
+# A FileHandler writes and flushes every line to the SD card in the thread that
+# logged it, which is often a GPIO callback or the menu loop, so a slow card shows
+# up as a slow keypress. BatchedFileHandler only puts the record on a bounded
+# queue; a writer thread formats and writes everything queued in one go, at most
+# BATCH_SECONDS after the first line (right away for warnings and errors).
+# The file is rotated to wonderphone.log.YYYYmmdd-HHMMSS when it passes MAX_BYTES or
+# MAX_AGE seconds, and the oldest rotated files are deleted to keep the log under
+# DISK_CAP bytes in all. When the writer falls behind, DEBUG and INFO lines are
+# dropped once the queue is LOW_PRIORITY_FILL full, and everything once it is full;
+# logging never waits. The writer notes how many lines it dropped in the log.
+#
+#   python3 logwriter.py bench [-n LINES] [--dir DIR]
+# compares the time a logger.debug() call takes with a FileHandler and with this one.
+
+import os, sys, time, queue, argparse, tempfile, threading, logging
+
+BATCH_SECONDS 		= 0.5
+BATCH_LINES 		= 128
+QUEUE_SIZE 			= 10000
+LOW_PRIORITY_FILL 	= 0.8		# fraction of the queue after which DEBUG/INFO are dropped
+MAX_BYTES 			= 2 * 1024 * 1024
+MAX_AGE 			= 24 * 3600
+DISK_CAP 			= 20 * 1024 * 1024
+
+_STOP = object()
+
+class BatchedFileHandler(logging.Handler):
+	def __init__(self, path, max_bytes=MAX_BYTES, max_age=MAX_AGE, disk_cap=DISK_CAP, queue_size=QUEUE_SIZE, level=logging.NOTSET):
+		logging.Handler.__init__(self, level)
+		self.path = os.path.abspath(path)
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self.disk_cap = disk_cap
+		self.queue = queue.Queue(queue_size)
+		self.low_priority_limit = int(queue_size * LOW_PRIORITY_FILL)
+		self.file = None
+		self.size = 0
+		self.opened = None
+		self.written = 0
+		self.batches = 0
+		self.rotations = 0
+		self.dropped = 0
+		self.dropped_high = 0			# warnings and errors lost with the queue full
+		self.reported = 0
+		self.closed = False
+		self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+		self.thread.start()
+
+	# emit: queue the record; never blocks (called with the handler lock held)
+	def emit(self, record):
+		if self.closed:
+			return
+		if record.levelno < logging.WARNING and self.queue.qsize() >= self.low_priority_limit:
+			self.dropped += 1
+			return
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+			if record.levelno >= logging.WARNING:
+				self.dropped_high += 1
+
+	# flush: wait for everything queued so far to be written
+	def flush(self):
+		if not self.closed and self.thread.is_alive():
+			done = threading.Event()
+			try:
+				self.queue.put(done, timeout=1.0)
+			except queue.Full:
+				return
+			done.wait(5.0)
+
+	def close(self):
+		if not self.closed:
+			self.closed = True
+			self.queue.put(_STOP)
+			self.thread.join()
+		logging.Handler.close(self)
+
+	def stats(self):
+		return {"written": self.written, "batches": self.batches, "rotations": self.rotations,
+			"dropped": self.dropped, "dropped_warnings": self.dropped_high, "queued": self.queue.qsize()}
+
+	def _run(self):
+		stop = False
+		while not stop:
+			batch = [self.queue.get()]
+			urgent = False
+			deadline = time.monotonic() + BATCH_SECONDS
+			while len(batch) < BATCH_LINES and not urgent:
+				last = batch[-1]
+				if last is _STOP or isinstance(last, threading.Event):
+					break
+				if last.levelno >= logging.WARNING:
+					urgent = True
+					break
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					break
+				try:
+					batch.append(self.queue.get(timeout=remaining))
+				except queue.Empty:
+					break
+			waiters = [item for item in batch if isinstance(item, threading.Event)]
+			stop = any(item is _STOP for item in batch)
+			records = [item for item in batch if isinstance(item, logging.LogRecord)]
+			if self.dropped != self.reported:
+				note = logging.LogRecord(self.name or "logwriter", logging.WARNING, __file__, 0,
+					"logwriter: dropped %d lines while the writer was behind", (self.dropped - self.reported,), None)
+				self.reported = self.dropped
+				records.append(note)
+			if records:
+				self._write(records)
+			for waiter in waiters:
+				waiter.set()
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+	def _format(self, record):
+		try:
+			return self.format(record) + "\n"
+		except Exception:
+			return "unformattable log record: %r %r\n" % (record.msg, record.args)
+
+	def _write(self, records):
+		text = "".join(self._format(r) for r in records)
+		try:
+			if self.file is None:
+				self._open()
+			elif self.size >= self.max_bytes or time.time() - self.opened >= self.max_age:
+				self._rotate()
+			self.file.write(text)
+			self.file.flush()
+			self.size += len(text.encode("utf-8", "replace"))
+			self.written += len(records)
+			self.batches += 1
+		except OSError:
+			self.dropped += len(records)
+			self.reported = self.dropped		# nowhere to report it
+			if self.file is not None:
+				self.file.close()
+			self.file = None
+
+	# _open: append to the log, rotating it first if a previous run left it too big or stale
+	def _open(self):
+		try:
+			st = os.stat(self.path)
+			if st.st_size >= self.max_bytes or time.time() - st.st_mtime >= self.max_age:
+				self._rotate_file()
+		except FileNotFoundError:
+			pass
+		self.file = open(self.path, "a", encoding="utf-8", errors="replace")
+		self.size = self.file.tell()
+		self.opened = time.time()
+
+	def _rotate(self):
+		self.file.close()
+		self.file = None
+		self._rotate_file()
+		self._open()
+
+	def _rotate_file(self):
+		target = self.path + "." + time.strftime("%Y%m%d-%H%M%S")
+		n = 1
+		while os.path.exists(target):
+			target = self.path + "." + time.strftime("%Y%m%d-%H%M%S") + "-%d" % n
+			n += 1
+		os.replace(self.path, target)
+		self.rotations += 1
+		self._enforce_cap()
+
+	# _enforce_cap: delete the oldest rotated files until the log and its rotations fit the disk cap
+	def _enforce_cap(self):
+		directory, base = os.path.split(self.path)
+		rotated = []
+		for name in os.listdir(directory):
+			if name.startswith(base + ".") and name[len(base) + 1:len(base) + 2].isdigit():
+				path = os.path.join(directory, name)
+				rotated.append((os.path.getmtime(path), path, os.path.getsize(path)))
+		rotated.sort()
+		total = sum(size for mtime, path, size in rotated) + self.max_bytes		# room for the live file to fill up
+		while rotated and total > self.disk_cap:
+			mtime, path, size = rotated.pop(0)
+			os.remove(path)
+			total -= size
+
+#------------------------------------------ BENCHMARK ------------------------------------------
+
+# bench: seconds per logger.debug() call, sorted, for a handler
+def bench_handler(handler, lines):
+	logger = logging.getLogger("logwriter-bench-%d" % id(handler))
+	logger.propagate = False
+	logger.setLevel(logging.DEBUG)
+	handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+	logger.addHandler(handler)
+	times = []
+	try:
+		for i in range(lines):
+			start = time.perf_counter()
+			logger.debug("menu: %s --%s--> %s %s", "main", "1", "recorded", "Record a message")
+			times.append(time.perf_counter() - start)
+	finally:
+		logger.removeHandler(handler)
+		handler.close()
+	return sorted(times)
+
+def main():
+	parser = argparse.ArgumentParser(description="Wonderphone log writer tools")
+	sub = parser.add_subparsers(dest="command")
+	b = sub.add_parser("bench", help="cost of a logger.debug() call with FileHandler and BatchedFileHandler")
+	b.add_argument("-n", "--lines", type=int, default=20000)
+	b.add_argument("--dir", help="directory to write the test logs in (default: a temporary one; use the SD card to see its latency)")
+	args = parser.parse_args()
+	if args.command != "bench":
+		parser.print_help()
+		return 1
+
+	directory = args.dir or tempfile.mkdtemp(prefix="wonderphone-log-")
+	print("%-20s %10s %10s %10s %10s" % ("handler", "mean us", "p50 us", "p99 us", "max us"))
+	for name, handler in (("FileHandler", logging.FileHandler(os.path.join(directory, "bench-file.log"))),
+			("BatchedFileHandler", BatchedFileHandler(os.path.join(directory, "bench-batched.log")))):
+		times = bench_handler(handler, args.lines)
+		us = lambda q: 1e6 * times[min(len(times) - 1, int(q * len(times)))]
+		print("%-20s %10.1f %10.1f %10.1f %10.1f" % (name, 1e6 * sum(times) / len(times), us(0.5), us(0.99), 1e6 * times[-1]))
+		if isinstance(handler, BatchedFileHandler):
+			print("  " + str(handler.stats()))
+	if not args.dir:
+		for name in os.listdir(directory):
+			os.remove(os.path.join(directory, name))
+		os.rmdir(directory)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+# Persistent manifest of the recordings in one directory, for the Wonderphone.
+# The manifest is an append-only JSON-lines file next to the directory
+# (katies_recordings.manifest.jsonl beside katies_recordings/). Each line is the full,
+# latest state of one recording; on load the last line for a name wins. Appends are
+# fsynced, a torn last line after a power cut is skipped (and the next append starts
+# on a line of its own), and the file is compacted
+# (rewritten atomically) once superseded lines outnumber live ones.
+# Entry fields: name, lang, size (bytes), duration (seconds), format ("rate/channels/bits"),
+# seq (creation order) and deleted, plus any flags set by other tools (empty, from trim.py).
+#
+# Staff tools:
+#   python3 manifest.py list DIR [--deleted]
+#   python3 manifest.py stats DIR
+#   python3 manifest.py check DIR          (exit status 1 if the manifest has drifted from the disk)
+#   python3 manifest.py rebuild DIR        (re-read every wav on disk and rewrite the manifest)
+
+import os, sys, json, wave, argparse, threading, logging
+import tracing
+
+logger = logging.getLogger('logwonderphone')
+
+SUFFIX = ".manifest.jsonl"
+MIN_COMPACT_LINES = 64
+
+# default_path: the manifest file that sits next to a recordings directory
+def default_path(directory):
+	return os.path.normpath(directory) + SUFFIX
+
+# default_lang: recordings/en and recordings/es carry their language in the directory name
+def default_lang(directory):
+	lang = os.path.basename(os.path.normpath(directory))
+	return lang if lang in ("en", "es") else None
+
+# probe: size, duration and format of one recording; duration and format are None
+# while the file is still being written and its header isn't readable yet
+def probe(path):
+	size = os.stat(path).st_size
+	try:
+		with wave.open(path, 'rb') as w:
+			rate = w.getframerate()
+			duration = round(w.getnframes() / float(rate), 3) if rate else None
+			fmt = "%d/%d/%d" % (rate, w.getnchannels(), 8 * w.getsampwidth())
+	except (wave.Error, EOFError):
+		duration = fmt = None
+	return size, duration, fmt
+
+class Manifest:
+	def __init__(self, directory, lang=None, path=None):
+		self.directory = directory
+		self.lang = lang if lang is not None else default_lang(directory)
+		self.path = path or default_path(directory)
+		self.entries = {}			# name -> entry, deleted ones included
+		self.seq = 0
+		self.lines = 0				# lines in the file, live or superseded
+		self.skipped = 0			# unreadable lines seen on load
+		self.torn = False			# the file ends in the middle of a line; the next append starts a new one
+		self.found = False			# whether load() found a manifest file (False on a first run)
+		self.lock = threading.Lock()
+		self.file = None
+
+	def load(self):
+		self.entries = {}
+		self.seq = self.lines = self.skipped = 0
+		self.torn = False
+		try:
+			f = open(self.path)
+		except FileNotFoundError:
+			self.found = False
+			return self
+		self.found = True
+		with f:
+			for line in f:
+				self.torn = not line.endswith("\n")
+				try:
+					entry = json.loads(line)
+					name = entry["name"]
+				except (ValueError, KeyError, TypeError):
+					self.skipped += 1		# a line torn by a power cut
+					continue
+				self.entries[name] = entry
+				self.seq = max(self.seq, entry.get("seq", 0))
+				self.lines += 1
+		if self.skipped:
+			logger.debug("manifest %s: skipped %d unreadable lines", self.path, self.skipped)
+		return self
+
+	def close(self):
+		with self.lock:
+			if self.file is not None:
+				self.file.close()
+				self.file = None
+
+	# names: live recordings, sorted by name (which is also chronological)
+	def names(self):
+		return sorted(name for name, entry in self.entries.items() if not entry.get("deleted"))
+
+	def get(self, name):
+		return self.entries.get(name)
+
+	# add: record a new file (or re-probe a known one, keeping its seq and flags)
+	def add(self, name):
+		size, duration, fmt = probe(os.path.join(self.directory, name))
+		with self.lock:
+			old = self.entries.get(name)
+			if old is not None and not old.get("deleted"):
+				base = old
+			else:
+				self.seq += 1
+				base = {"seq": self.seq}
+			self._write(dict(base, name=name, lang=self.lang, size=size, duration=duration,
+				format=fmt, deleted=False))
+
+	# update: re-probe a file whose contents changed (a recording that has just finished)
+	def update(self, name):
+		self.add(name)
+
+	# flag: set extra fields on a live recording's entry
+	def flag(self, name, **fields):
+		with self.lock:
+			entry = self.entries.get(name)
+			if entry is None or entry.get("deleted"):
+				return False
+			if any(entry.get(k) != v for k, v in fields.items()):
+				self._write(dict(entry, **fields))
+			return True
+
+	def mark_deleted(self, name):
+		with self.lock:
+			entry = self.entries.get(name)
+			if entry is None or entry.get("deleted"):
+				return
+			entry = dict(entry, deleted=True)
+			self._write(entry)
+
+	# check: (on disk but not in the manifest, in the manifest but gone from disk) for a directory listing
+	def check(self, names_on_disk):
+		on_disk = set(names_on_disk)
+		live = set(self.names())
+		return sorted(on_disk - live), sorted(live - on_disk)
+
+	# sync: bring the manifest in line with a directory listing; True if it had drifted.
+	# New recordings are probed first and everything is appended with one write and one fsync.
+	def sync(self, names_on_disk):
+		unknown, missing = self.check(names_on_disk)
+		probed = []
+		for name in unknown:
+			try:
+				probed.append((name, probe(os.path.join(self.directory, name))))
+			except OSError:
+				pass			# deleted again before we could look at it
+		with self.lock:
+			batch = []
+			for name, (size, duration, fmt) in probed:
+				old = self.entries.get(name)
+				if old is not None and not old.get("deleted"):
+					continue		# added by someone else meanwhile
+				self.seq += 1
+				batch.append({"seq": self.seq, "name": name, "lang": self.lang, "size": size, "duration": duration,
+					"format": fmt, "deleted": False})
+			for name in missing:
+				entry = self.entries.get(name)
+				if entry is not None and not entry.get("deleted"):
+					batch.append(dict(entry, deleted=True))
+			if batch:
+				self._write_many(batch)
+		if unknown or missing:
+			logger.debug("manifest %s: %d new, %d gone since last run", self.path, len(unknown), len(missing))
+		return bool(unknown or missing)
+
+	# rebuild: re-probe every recording in the directory and rewrite the manifest.
+	# Known recordings keep their seq; new ones are numbered after everything seen so far.
+	def rebuild(self, names_on_disk):
+		with self.lock:
+			old = dict(self.entries)
+		seq = max([e.get("seq", 0) for e in old.values()] or [0])
+		entries = {}
+		for name in sorted(names_on_disk):
+			size, duration, fmt = probe(os.path.join(self.directory, name))
+			if name in old:
+				base = old[name] if not old[name].get("deleted") else {"seq": old[name].get("seq", 0)}
+			else:
+				seq += 1
+				base = {"seq": seq}
+			entries[name] = dict(base, name=name, lang=self.lang, size=size, duration=duration,
+				format=fmt, deleted=False)
+		# keep the deletion history of names that are gone from the disk
+		for name, entry in old.items():
+			if name not in entries:
+				entries[name] = dict(entry, deleted=True)
+		with self.lock:
+			self.entries = entries
+			self.seq = seq
+			self._compact()
+
+	# compact: rewrite the file with one line per name
+	def compact(self):
+		with self.lock:
+			self._compact()
+
+	@tracing.timed("fs.manifest_compact")
+	def _compact(self):
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+		tmp = self.path + ".tmp"
+		with open(tmp, "w") as f:
+			for entry in sorted(self.entries.values(), key=lambda e: e["seq"]):
+				f.write(json.dumps(entry) + "\n")
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, self.path)
+		self.lines = len(self.entries)
+		self.torn = False
+
+	def _write(self, entry):
+		self._write_many([entry])
+
+	# _write_many: append entries with one write and one fsync
+	@tracing.timed("fs.manifest_write")
+	def _write_many(self, entries):
+		for entry in entries:
+			self.entries[entry["name"]] = entry
+		text = "".join(json.dumps(entry) + "\n" for entry in entries)
+		if self.file is None:
+			self.file = open(self.path, "a")
+			if self.torn:
+				text = "\n" + text
+				self.torn = False
+		self.file.write(text)
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.lines += len(entries)
+		if self.lines > max(MIN_COMPACT_LINES, 2 * len(self.entries)):
+			self._compact()
+
+	def stats(self):
+		live = [e for e in self.entries.values() if not e.get("deleted")]
+		return {
+			"recordings": len(live),
+			"deleted": len(self.entries) - len(live),
+			"bytes": sum(e["size"] for e in live),
+			"seconds": round(sum(e["duration"] or 0 for e in live), 1),
+			"lines": self.lines,
+		}
+
+#------------------------------------------ STAFF TOOLS ------------------------------------------
+
+def list_wavs(directory):
+	with os.scandir(directory) as entries:
+		return [e.name for e in entries if e.name.endswith(".wav") and not e.name.startswith(".") and e.is_file()]
+
+def main():
+	parser = argparse.ArgumentParser(description="Wonderphone recordings manifest tools")
+	sub = parser.add_subparsers(dest="command")
+	for command, help in (("list", "list recordings in creation order"), ("stats", "totals for the directory"),
+			("check", "compare the manifest with the files on disk"), ("rebuild", "re-read every recording and rewrite the manifest")):
+		c = sub.add_parser(command, help=help)
+		c.add_argument("directory")
+		c.add_argument("--lang", default=None)
+		if command == "list":
+			c.add_argument("--deleted", action="store_true", help="include deleted recordings")
+	args = parser.parse_args()
+	if args.command is None:
+		parser.print_help()
+		return 1
+
+	m = Manifest(args.directory, args.lang).load()
+	try:
+		if args.command == "list":
+			for entry in sorted(m.entries.values(), key=lambda e: e["seq"]):
+				if entry.get("deleted") and not args.deleted:
+					continue
+				print("%6d  %-32s %-4s %10d B %8s s  %-10s%s%s" % (entry["seq"], entry["name"], entry["lang"] or "-", entry["size"],
+					entry["duration"] if entry["duration"] is not None else "?", entry["format"] or "?",
+					"  deleted" if entry.get("deleted") else "", "  empty" if entry.get("empty") else ""))
+		elif args.command == "stats":
+			print(json.dumps(m.stats(), indent=1))
+		elif args.command == "check":
+			unknown, missing = m.check(list_wavs(args.directory))
+			for name in unknown:
+				print("not in manifest: " + name)
+			for name in missing:
+				print("missing on disk: " + name)
+			print("ok" if not (unknown or missing) else "drifted: run rebuild")
+			return 1 if unknown or missing else 0
+		elif args.command == "rebuild":
+			m.rebuild(list_wavs(args.directory))
+			print("wrote %s (%d recordings)" % (m.path, m.stats()["recordings"]))
+	finally:
+		m.close()
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+# Table-driven menus for the Wonderphone.
+# A menu is defined in data (see menus.py): a start state, a dict of states, and in
+# each state a transition per key. A transition names the state it leads to, a label
+# for the logs, and a list of steps; a step is an action name and its arguments,
+# e.g. ("play", "/media/pi/WONDERPHONE/prompts/en/MainMenu.wav") or ("record", "en").
+# The files of a transition's "play" steps are kept with it (Transition.audio) for prefetch.py.
+# A state's "other" transition covers the keys it doesn't list, and the definition's
+# "events" (hook, reset, ...) are transitions available from every state.
+#
+# build() checks the definition, binds the action names to the phone script's
+# functions and flattens everything into one list indexed by state * width + event,
+# so dispatch is a single list index whatever the size of the menu.
+# An action returns None to go on with the next step, an event (a key, "hook", ...)
+# to abandon the rest of the transition and dispatch that event instead, or STOP to
+# end there. Chained events are dispatched in a loop, not by recursion.
+#
+# Benchmark:  python3 menu.py bench [-n EVENTS]
+
+import sys, time, random, inspect, argparse, logging
+import tracing
+from collections import namedtuple
+
+logger = logging.getLogger('logwonderphone')
+
+KEYS = ("1", "2", "3", "4", "5", "6", "7", "8", "9", "*", "0", "#")
+STOP = object()
+
+Transition = namedtuple("Transition", "target label steps audio")
+
+class Menu:
+	def __init__(self, names, events, table, start, on_transition=None):
+		self.names = names				# state index -> name
+		self.states = dict((name, i) for i, name in enumerate(names))
+		self.events = events			# event -> column
+		self.width = len(events)
+		self.table = table				# state * width + column -> Transition or None
+		self.start = self.states[start]
+		self.state = self.start
+		self.on_transition = on_transition
+		self.listeners = []				# called with (state, event, transition) after each move, e.g. prefetch.py
+		self.dispatched = 0
+
+	@property
+	def current(self):
+		return self.names[self.state]
+
+	# transition: the table entry for an event in the current state (None if the key does nothing there)
+	def transition(self, event):
+		column = self.events.get(event)
+		if column is None:
+			return None
+		return self.table[self.state * self.width + column]
+
+	# dispatch: run the transition for an event, then any events its steps hand back
+	def dispatch(self, event):
+		while event is not None:
+			t = self._enter(event)
+			if t is None:
+				return
+			event = self._run(t)
+
+	# dispatch_async: the same for an asyncio core (core.py), where steps may be coroutines
+	async def dispatch_async(self, event):
+		while event is not None:
+			t = self._enter(event)
+			if t is None:
+				return
+			event = None
+			for action, args in t.steps:
+				result = action(*args)
+				if inspect.isawaitable(result):
+					result = await result
+				if result is STOP:
+					break
+				if result is not None:
+					event = result
+					break
+
+	# outgoing: the distinct transitions out of a state, with the events that lead to each
+	def outgoing(self, state):
+		found = {}
+		row = state * self.width
+		for event, column in self.events.items():
+			t = self.table[row + column]
+			if t is not None:
+				found.setdefault(id(t), (t, []))[1].append(event)
+		return list(found.values())
+
+	def reset(self):
+		self.state = self.start
+
+	# _enter: move along the transition for an event; None if the event does nothing here
+	@tracing.timed("menu.enter")
+	def _enter(self, event):
+		t = self.transition(event)
+		if t is None:
+			return None
+		self.dispatched += 1
+		if self.on_transition is not None:
+			self.on_transition(self.names[self.state], event, t)
+		logger.debug("menu: %s --%s--> %s %s", self.names[self.state], event, self.names[t.target], t.label or "")
+		state = self.state
+		self.state = t.target
+		for listener in self.listeners:
+			listener(state, event, t)
+		return t
+
+	def _run(self, t):
+		for action, args in t.steps:
+			result = action(*args)
+			if result is STOP:
+				return None
+			if result is not None:
+				return result
+		return None
+
+# build: a Menu from a definition and a dict of action name -> function
+def build(definition, actions, on_transition=None):
+	states = definition["states"]
+	global_events = definition.get("events", {})
+	names = list(states)
+	index = dict((name, i) for i, name in enumerate(names))
+	events = dict((e, i) for i, e in enumerate(KEYS + tuple(e for e in global_events if e not in KEYS)))
+	if definition["start"] not in index:
+		raise ValueError("menu: start state %r is not defined" % definition["start"])
+
+	def make(where, spec):
+		target = spec.get("to", where)
+		if target not in index:
+			raise ValueError("menu: %s leads to undefined state %r" % (where, target))
+		steps = []
+		audio = []
+		for step in spec.get("do", ()):
+			if step[0] not in actions:
+				raise ValueError("menu: %s uses undefined action %r" % (where, step[0]))
+			steps.append((actions[step[0]], tuple(step[1:])))
+			if step[0] == "play":
+				audio.extend(step[1:])
+		return Transition(index[target], spec.get("label"), tuple(steps), tuple(audio))
+
+	shared = dict((e, make("events." + e, spec)) for e, spec in global_events.items())
+	table = [None] * (len(names) * len(events))
+	for name, keys in states.items():
+		for key in keys:
+			if key not in KEYS and key != "other" and key not in global_events:
+				raise ValueError("menu: %s has a transition for unknown key %r" % (name, key))
+		other = make(name, keys["other"]) if "other" in keys else None
+		row = index[name] * len(events)
+		for event, column in events.items():
+			if event in keys:
+				table[row + column] = make(name, keys[event])
+			elif event in shared:
+				table[row + column] = shared[event]
+			elif event in KEYS:
+				table[row + column] = other
+	return Menu(names, events, table, definition["start"], on_transition)
+
+#------------------------------------------ BENCHMARK ------------------------------------------
+
+# bench: dispatch a random key stream through a menu whose actions do nothing
+def bench(definition, count, seed=1):
+	actions = dict((name, lambda *args: None) for name in action_names(definition))
+	start = time.perf_counter()
+	m = build(definition, actions)
+	compile_seconds = time.perf_counter() - start
+	rng = random.Random(seed)
+	keys = [rng.choice(KEYS) for i in range(count)]
+	dispatch = m.dispatch
+	start = time.perf_counter()
+	for key in keys:
+		dispatch(key)
+	elapsed = time.perf_counter() - start
+	return {"states": len(m.names), "cells": len(m.table), "compile": compile_seconds,
+		"dispatched": m.dispatched, "per_second": count / elapsed, "ns": 1e9 * elapsed / count}
+
+# action_names: every action a definition uses
+def action_names(definition):
+	specs = list(definition.get("events", {}).values())
+	for keys in definition["states"].values():
+		specs.extend(keys.values())
+	return set(step[0] for spec in specs for step in spec.get("do", ()))
+
+def main():
+	import menus
+	parser = argparse.ArgumentParser(description="Wonderphone menu tools")
+	sub = parser.add_subparsers(dest="command")
+	b = sub.add_parser("bench", help="dispatch throughput of the phone menus")
+	b.add_argument("-n", "--events", type=int, default=1000000)
+	s = sub.add_parser("show", help="print a menu's transition table")
+	s.add_argument("menu", choices=sorted(menus.MENUS))
+	args = parser.parse_args()
+
+	if args.command == "bench":
+		print("%-10s %7s %7s %11s %14s %10s" % ("menu", "states", "cells", "compile ms", "events/s", "ns/event"))
+		for name, definition in sorted(menus.MENUS.items()):
+			r = bench(definition, args.events)
+			print("%-10s %7d %7d %11.2f %14.0f %10.0f" % (name, r["states"], r["cells"], 1000 * r["compile"], r["per_second"], r["ns"]))
+		return 0
+	if args.command == "show":
+		definition = menus.MENUS[args.menu]
+		m = build(definition, dict((name, lambda *a: None) for name in action_names(definition)))
+		for state, name in enumerate(m.names):
+			for event, column in m.events.items():
+				t = m.table[state * m.width + column]
+				if t is not None:
+					print("%-10s %-6s -> %-10s %s" % (name, event, m.names[t.target], t.label or ""))
+		return 0
+	parser.print_help()
+	return 1
+
+if __name__ == "__main__":
+	sys.exit(main())
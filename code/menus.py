@@ -0,0 +1,103 @@
+# Menu definitions for the two Wonderphone programs, in the format menu.py compiles.
+# The action names are bound to functions by each phone script:
+#   payphone.py:        play, wait, record (lang), respond (lang)
+#   katies_payphone.py: play, wait, listen, record, discard, discard_message, save,
+#                       play_take, greeting, reset, restart, check_messages,
+#                       introduction, last_message_notice, play_message,
+#                       playback_instructions, next_message
+
+import os
+
+# WONDERPHONE_ROOT points the phones at another content tree (sim.py makes placeholder ones)
+ROOT 	= os.environ.get("WONDERPHONE_ROOT", "/media/pi/WONDERPHONE").rstrip("/") + "/"
+PROMPTS = ROOT + "prompts/"
+STORIES = ROOT + "stories/"
+KATIES 	= ROOT + "katies_phone_prompts/"
+
+#------------------------------------------ PAYPHONE ------------------------------------------
+# States keep payphone.py's old MENU numbers: "1"/"2" are the English/Spanish main menus,
+# "13" is option 3 of the English menu, "171" is recording a personal prompt in English.
+# In any option, 1 goes back up to the language's main menu, and * or # replays it.
+
+def payphone_menu():
+	menu = {
+		"start": "lang",
+		"events": {
+			"hook": {"to": "lang", "label": "Main Menu", "do": [("play", PROMPTS + "languageselect.wav")]},
+		},
+		"states": {"lang": {}},
+	}
+
+	for lang, top, label in (("en", "1", "ENGLISH"), ("es", "2", "SPANISH")):
+		p = PROMPTS + lang + "/"
+		main_menu = {"to": top, "label": "Return to main menu", "do": [("play", p + "MainMenu.wav")]}
+		up = {"to": top}
+		menu["states"]["lang"][top] = dict(main_menu, label=label)
+		options = menu["states"][top] = {}
+		for key, name, audio in (
+				("1", "Story from Dallas' Past", [p + "Menu1.wav", STORIES + "1/PersonalStory.wav"]),
+				("2", "Story about Dallas' Future", [p + "Menu2.wav", STORIES + "2/FutureStory.wav"]),
+				("3", "Action Prompt", [p + "Menu3.wav", p + "Prompt3.wav"]),
+				("4", "Historical Wonder", [p + "Menu4.wav", STORIES + "4/HistoryStory.wav"]),
+				("5", "Architectural Wonder", [p + "Menu5.wav", STORIES + "5/ArchitectureStory.wav"]),
+				("6", "Musical Wonder", [p + "Menu6.wav", STORIES + "6/GarageGrooves1.wav"]),
+				("7", "Personal Prompt", [p + "Menu7.wav", p + "Prompt7.wav", p + "Ready7.wav"]),
+				("8", "Personal Responses", [p + "Menu8.wav", p + "Prompt8.wav", p + "Finish8.wav"]),
+				("9", "Wonder Hunt", [p + "Menu9.wav", p + "Prompt9.wav"]),
+				("0", "About Wonderphone", [p + "Menu10.wav"])):
+			options[key] = {"to": top + key, "label": name, "do": [("play",) + tuple(audio)]}
+			menu["states"][top + key] = {"1": up, "*": main_menu, "#": main_menu}
+		# 8: after the prompt, a visitor's recording
+		options["8"]["do"] = options["8"]["do"] + [("wait",), ("respond", lang)]
+		# 7, then 1: record a personal prompt
+		menu["states"][top + "7"]["1"] = {"to": top + "71", "label": "Recording Personal Prompt",
+			"do": [("play", PROMPTS + "recordtone.wav"), ("wait",), ("record", lang), ("play", p + "Finish7.wav")]}
+		menu["states"][top + "71"] = {"1": up, "*": main_menu, "#": main_menu}
+	return menu
+
+PAYPHONE = payphone_menu()
+
+#------------------------------------------ KATIE'S PHONE ------------------------------------------
+# "main" offers 1 (record) and 2 (playback); "recorded" is the menu after a take
+# (1 re-record, 2 review, # save, 0 discard); "playback" steps through the saved messages
+# (1 replay, 2 next, 0 main menu). "listen" waits for the prompt to end or be cut off
+# by a key, which it hands back to the menu; a hang-up comes back as "hook".
+
+LISTEN = ("listen",)
+MAIN_MENU = [("greeting",), ("play", KATIES + "main_menu.wav"), LISTEN]
+RESET = [("reset",)] + MAIN_MENU
+POST_RECORDING = [("play", KATIES + "post_recording_instructions.wav"), LISTEN]
+RECORD = [("play", KATIES + "new_recording_instructions.wav"), ("record",),
+	("play", KATIES + "recording_ended.wav"), ("wait",)] + POST_RECORDING
+PLAY_MESSAGE = [("check_messages",), ("introduction",), ("last_message_notice",), ("play_message",), LISTEN,
+	("playback_instructions",), LISTEN]
+
+KATIES_PHONE = {
+	"start": "main",
+	"events": {
+		"hook": {"to": "main", "label": "Restart", "do": [("restart",)] + RESET},
+		"reset": {"to": "main", "label": "Main Menu", "do": RESET},
+	},
+	"states": {
+		"main": {
+			"1": {"to": "recorded", "label": "Record a message", "do": RECORD},
+			"2": {"to": "playback", "label": "Playback messages", "do": PLAY_MESSAGE},
+			"other": {"label": "Main Menu", "do": [("play", KATIES + "main_menu.wav"), LISTEN]},
+		},
+		"recorded": {
+			"1": {"label": "Re-record message", "do": [("discard",)] + RECORD},
+			"2": {"label": "Review message", "do": [("play", KATIES + "replay_message.wav"), ("wait",), ("play_take",), LISTEN] + POST_RECORDING},
+			"#": {"to": "main", "label": "Save message", "do": [("save",), ("play", KATIES + "recording_saved.wav"), ("wait",)] + RESET},
+			"0": {"to": "main", "label": "Discard message", "do": [("discard_message",)] + RESET},
+			"other": {"do": POST_RECORDING},
+		},
+		"playback": {
+			"1": {"label": "Replay message", "do": [("play", KATIES + "replay_message.wav"), LISTEN] + PLAY_MESSAGE},
+			"2": {"label": "Next message", "do": [("next_message",)] + PLAY_MESSAGE},
+			"0": {"to": "main", "label": "Main Menu", "do": RESET},
+			"other": {"do": [("playback_instructions",), LISTEN]},
+		},
+	},
+}
+
+MENUS = {"payphone": PAYPHONE, "katies": KATIES_PHONE}
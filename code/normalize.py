@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# Batch loudness normalization for Wonderphone recordings.
+# Visitors hold the handset at every distance from their mouth, so one message is a
+# whisper and the next is shouting. This brings every recording to TARGET_DBFS:
+# loudness is the rms level of the windows that have sound in them (the silence gate
+# from trim.py), measured with numpy in one pass. The gain is capped so the peak stays
+# under CEILING_DBFS and never exceeds MAX_GAIN_DB, so quiet noise isn't blown up.
+# Files are rewritten atomically (rewrite.py), in a process pool across all cores, and the manifest
+# remembers which target each recording was normalized to, so a rerun only touches
+# new recordings. Recordings flagged empty by trim.py are skipped.
+# Run it with the phone stopped: it updates the same manifest the phone appends to.
+#
+#   python3 normalize.py DIR [DIR ...] [--target -20] [--ceiling -1] [--max-gain 20] [-j WORKERS] [--dry-run] [--force]
+# prints files normalized and throughput in audio seconds per wall second.
+
+import os, sys, time, wave, argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import audio, manifest, trim, rewrite
+
+TARGET_DBFS 	= -20.0
+CEILING_DBFS 	= -1.0		# peak limit after gain
+MAX_GAIN_DB 	= 20.0
+MIN_CHANGE_DB 	= 0.5		# smaller corrections aren't worth rewriting the file for
+
+# loudness: (gated rms level, peak level) of 16-bit frames in dBFS; level is None if there is no sound
+def loudness(frames, rate, gate=trim.THRESHOLD_DBFS, window_seconds=trim.WINDOW_SECONDS):
+	window = max(1, int(rate * window_seconds))
+	levels = trim.window_levels(frames, window)
+	loud = levels[levels > gate]
+	peak = int(np.abs(frames.astype(np.int32)).max()) if frames.size else 0
+	peak_db = 20 * np.log10(peak / 32768.0) if peak else -np.inf
+	if len(loud) == 0:
+		return None, float(peak_db)
+	# average power, not average dB: loud windows count for what they are
+	level = 10 * np.log10(np.mean(np.power(10.0, loud / 10)))
+	return float(level), float(peak_db)
+
+# gain_for: the gain in dB that brings level to target without pushing the peak past the ceiling
+def gain_for(level, peak_db, target=TARGET_DBFS, ceiling=CEILING_DBFS, max_gain=MAX_GAIN_DB):
+	return min(target - level, ceiling - peak_db, max_gain)
+
+# apply_gain: scale 16-bit frames by gain_db; returns (frames, samples clipped)
+def apply_gain(frames, gain_db):
+	scaled = np.rint(frames.astype(np.float32) * np.float32(10 ** (gain_db / 20)))
+	clipped = int(np.count_nonzero((scaled > 32767) | (scaled < -32768)))
+	return np.clip(scaled, -32768, 32767).astype('<i2'), clipped
+
+# normalize_file: normalize one recording in place; runs in a worker process
+def normalize_file(path, target=TARGET_DBFS, ceiling=CEILING_DBFS, max_gain=MAX_GAIN_DB, dry_run=False):
+	params, data = audio.read_wav(path)
+	channels, width, rate = params
+	if width != 2:
+		data = audio.ChunkConverter(params, channels, rate).convert(data)
+	frames = np.frombuffer(data, dtype='<i2').reshape(-1, channels)
+	level, peak_db = loudness(frames, rate)
+	result = {"path": path, "audio_seconds": len(frames) / float(rate), "level": level,
+		"gain": 0.0, "clipped": 0, "changed": False}
+	if level is None:
+		return result
+	gain = gain_for(level, peak_db, target, ceiling, max_gain)
+	result["gain"] = round(gain, 2)
+	if abs(gain) < MIN_CHANGE_DB or dry_run:
+		return result
+	out, result["clipped"] = apply_gain(frames, gain)
+	if not rewrite.replace_wav(path, out.tobytes(), channels, rate):
+		return result
+	result["changed"] = True
+	return result
+
+def main():
+	parser = argparse.ArgumentParser(description="Normalize the loudness of Wonderphone recordings")
+	parser.add_argument("directories", nargs="+")
+	parser.add_argument("--target", type=float, default=TARGET_DBFS, help="loudness to aim for, in dBFS")
+	parser.add_argument("--ceiling", type=float, default=CEILING_DBFS, help="highest peak allowed after gain, in dBFS")
+	parser.add_argument("--max-gain", type=float, default=MAX_GAIN_DB, help="most gain applied to a quiet recording, in dB")
+	parser.add_argument("-j", "--workers", type=int, default=os.cpu_count())
+	parser.add_argument("--dry-run", action="store_true", help="report gains without writing anything")
+	parser.add_argument("--force", action="store_true", help="also redo recordings already normalized to this target")
+	args = parser.parse_args()
+
+	manifests = {}
+	jobs = []
+	skipped = 0
+	for directory in args.directories:
+		m = manifests[directory] = manifest.Manifest(directory).load()
+		names = sorted(manifest.list_wavs(directory))
+		if not args.dry_run:
+			m.sync(names)
+		for name in names:
+			entry = m.get(name) or {}
+			if entry.get("empty") or (entry.get("normalized") == args.target and not args.force):
+				skipped += 1
+				continue
+			jobs.append((directory, name))
+
+	start = time.perf_counter()
+	results = []
+	try:
+		with ProcessPoolExecutor(args.workers) as pool:
+			futures = [(directory, name, pool.submit(normalize_file, os.path.join(directory, name), args.target,
+				args.ceiling, args.max_gain, args.dry_run)) for directory, name in jobs]
+			for directory, name, future in futures:
+				try:
+					r = future.result()
+				except (OSError, wave.Error, EOFError, ValueError) as e:
+					print("failed: %s (%s)" % (name, e))
+					continue
+				results.append(r)
+				if args.dry_run or not os.path.exists(r["path"]):
+					continue
+				m = manifests[directory]
+				if r["changed"]:
+					m.update(name)
+				m.flag(name, normalized=args.target)
+		elapsed = time.perf_counter() - start
+	finally:
+		for m in manifests.values():
+			m.close()
+
+	changed = [r for r in results if abs(r["gain"]) >= MIN_CHANGE_DB]
+	silent = [r for r in results if r["level"] is None]
+	audio_seconds = sum(r["audio_seconds"] for r in results)
+	gains = [r["gain"] for r in results if r["level"] is not None]
+	print("%d files, %d normalized, %d already at level, %d without sound, %d skipped (done before or empty)%s" % (
+		len(results), len(changed), len(results) - len(changed) - len(silent), len(silent), skipped,
+		" (dry run)" if args.dry_run else ""))
+	if gains:
+		print("gain: min %+.1f dB, max %+.1f dB; %d samples clipped" % (min(gains), max(gains), sum(r["clipped"] for r in results)))
+	print("%.1f audio s in %.2f s: %.0f audio s per wall s, %.1f files/s" % (audio_seconds, elapsed,
+		audio_seconds / elapsed if elapsed else 0, len(results) / elapsed if elapsed else 0))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -3,16 +3,29 @@
 # Script by Edward Li
 # Updated Sept 17, 2017
 
-import time, os, sys, subprocess, signal, logging, math
-import RPi.GPIO as GPIO
-from os import listdir
-from os.path import isfile, join
-from random import *
+import time, os, sys, logging
+import audio, assets, prompt_cache, barge_in, adc, sampler, keypad, keyfilter, recordings, manifest, shuffle, recorder, transcode, trim, rewrite, menu, menus, prefetch, core, sim, tracing, logwriter, usage
+from menus import ROOT
+
+# background workers: saved takes are trimmed and old recordings transcoded in process pools (trim.py, transcode.py);
+# their workers are forked here, before any of this script's threads run, so none can inherit a held lock (rewrite.py)
+TRIM_POOL = rewrite.pool(trim.WORKERS)
+TRANSCODE_POOL = rewrite.pool(transcode.WORKERS)
+
+# SIMULATOR: with WONDERPHONE_SIM=trace.json the GPIO pins, ADC, speaker and microphone are
+# simulated and the trace is replayed against them on a faster virtual clock (sim.py)
+SIM = sim.from_environment()
+if SIM is None:
+	import RPi.GPIO as GPIO
+else:
+	GPIO = SIM.gpio
 
 GPIO.setmode(GPIO.BCM)
 
 logger = logging.getLogger('logwonderphone')
-handler = logging.FileHandler('/home/pi/Desktop/wonderphone.log')
+# Lines are queued and written in batches by a background thread, rotated by size and age
+# and capped on disk; under back-pressure debug lines are dropped rather than waited for (logwriter.py)
+handler = logwriter.BatchedFileHandler(os.environ.get('WONDERPHONE_LOG', '/home/pi/Desktop/wonderphone.log'))
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
 handler.setFormatter(formatter)
 logger.addHandler(handler)
@@ -21,49 +34,18 @@ logger.setLevel(logging.DEBUG)
 
 
 # read SPI data from MCP3008 chip, 8 possible adc's (0 thru 7)
+# The pins are kept in the signature for the existing call sites; the ADC driver (adc.py) owns them.
 def readadc(adcnum, clockpin, mosipin, misopin, cspin):
-	if ((adcnum > 7) or (adcnum < 0)):
-		return -1
-	GPIO.output(cspin, True)
-	
-	GPIO.output(clockpin, False)  # start clock low
-	GPIO.output(cspin, False)     # bring CS low
-	
-	commandout = adcnum
-	commandout |= 0x18  # start bit + single-ended bit
-	commandout <<= 3    # we only need to send 5 bits here
-	for i in range(5):
-		if (commandout & 0x80):
-			GPIO.output(mosipin, True)
-		else:
-			GPIO.output(mosipin, False)
-		commandout <<= 1
-		GPIO.output(clockpin, True)
-		GPIO.output(clockpin, False)
-	
-	adcout = 0
-	# read in one empty bit, one null bit and 10 ADC bits
-	for i in range(12):
-		GPIO.output(clockpin, True)
-		GPIO.output(clockpin, False)
-		adcout <<= 1
-		if (GPIO.input(misopin)):
-			adcout |= 0x1
-	
-	GPIO.output(cspin, True)
-	
-	adcout >>= 1       # first bit is 'null' so drop it
-	return adcout
+	return ADC.read(adcnum)
 
 # pins connected from the SPI port on the ADC to the Cobbler
 SPICLK = 18
 SPIMISO = 23
 SPIMOSI = 24
 SPICS = 25
-GPIO.setup(SPIMOSI, GPIO.OUT)
-GPIO.setup(SPIMISO, GPIO.IN)
-GPIO.setup(SPICLK, GPIO.OUT)
-GPIO.setup(SPICS, GPIO.OUT)
+# ADC driver: "bitbang" (the pins above), "spidev" (hardware SPI0, see adc.py) or "sim"
+ADC_BACKEND = os.environ.get("WONDERPHONE_ADC", "bitbang")
+ADC = adc.open_adc(ADC_BACKEND, GPIO, (SPICLK, SPIMOSI, SPIMISO, SPICS)) if SIM is None else SIM.adc
 
 
 # pins connected from various I/O to the Cobbler
@@ -79,394 +61,213 @@ DEBUG_RAWADC = 0
 DEBUG_PRESSED = 1
 DEBUG_HOOK = 1
 
+# keypad decoding: 1024-entry adc value -> key table, from keypad_calibration.json if present
+KEYPAD = keypad.load()
+# a key is only accepted once a burst of KEY_FILTER_WINDOW samples agrees on it (keyfilter.py)
+KEY_FILTER_WINDOW = 5
+KEY_FILTER = keyfilter.KeyFilter(KEYPAD, window = KEY_FILTER_WINDOW, method = "vote")
+
+# keypad sampler: one background thread owns the ADC and turns samples into debounced press events
+KEY_EVENT_TIMEOUT = 0.1	# seconds to wait for the sampler to confirm a press after the PRESSED edge
+SAMPLER = sampler.KeypadSampler(ADC, key_filter = KEY_FILTER)
+
+# audio output: the engine keeps the sound device open
+# set WONDERPHONE_AUDIO_SINK to "null" or "file:/path/out.wav" to run without a sound card
+AUDIO_SINK = os.environ.get("WONDERPHONE_AUDIO_SINK", "alsa")
+# prompts are preloaded into RAM at startup (in device format) so playback never waits on the USB stick
+PROMPT_CACHE_BYTES = 48 * 1024 * 1024
+# prompts converted ahead of time by "python3 assets.py build" are used in place of the originals when up to date
+ASSETS = assets.PrebuiltAssets(ROOT)
+PROMPT_CACHE = prompt_cache.PromptCache([ROOT + "prompts"], budget_bytes = PROMPT_CACHE_BYTES, assets = ASSETS)
+ENGINE = audio.AudioEngine(audio.open_sink(AUDIO_SINK) if SIM is None else SIM.sink, cache = PROMPT_CACHE, assets = ASSETS)
+# recordings per language: loaded from the manifest next to each directory at startup (manifest.py),
+# then kept current by a directory watcher that also checks the manifest against the disk (recordings.py);
+# set up before the recorder, which hands over takes a previous run left in the staging area as soon as it starts
+RECORDINGS = {}
+for lang in ("en", "es"):
+	RECORDINGS[lang] = recordings.RecordingsIndex(ROOT + "recordings/" + lang,
+		manifest = manifest.Manifest(ROOT + "recordings/" + lang, lang))
+# personal responses are drawn from a shuffle bag per language: no repeats until every one has played (shuffle.py)
+# RESPONSE_RECENCY_WEIGHT > 0 (up to 1) makes newer recordings more likely to come up first
+RESPONSE_RECENCY_WEIGHT = 0.0
+RESPONSES = dict((lang, shuffle.ShuffleBag(index, RESPONSE_RECENCY_WEIGHT)) for lang, index in RECORDINGS.items())
+
+# audio input: recordings are captured in-process
+# set WONDERPHONE_AUDIO_SOURCE to "silence" or "file:/path/in.wav" to run without a microphone
+AUDIO_SOURCE = os.environ.get("WONDERPHONE_AUDIO_SOURCE", "alsa")
+# capture format: mono 16 kHz is plenty for a handset and a fifth of the bytes of cd quality
+CAPTURE_RATE = 16000
+CAPTURE_CHANNELS = 1
+MAX_RECORDING_SECONDS = 30
+# takes are staged in RAM and written out to the USB stick by a background writer once complete
+RECORDING_STAGING_DIR = recorder.STAGING_DIR
+RECORDING_STAGING_BYTES = 32 * 1024 * 1024
+# saved takes have their leading and trailing silence trimmed in the background (trim.py); near-silent ones are flagged empty
+def recording_saved(path):
+	RECORDINGS[os.path.basename(os.path.dirname(path))].add(path)
+	TRIMMER.submit(path)
+def recording_trimmed(result):
+	index = RECORDINGS[os.path.basename(os.path.dirname(result["path"]))]
+	index.refresh(result["path"])
+	if result["empty"]:
+		index.flag(result["path"], empty = True)
+TRIMMER = trim.Trimmer(on_done = recording_trimmed, pool = TRIM_POOL)
+RECORDER = recorder.Recorder(recorder.open_source(AUDIO_SOURCE, CAPTURE_RATE, CAPTURE_CHANNELS) if SIM is None else SIM.source(CAPTURE_RATE, CAPTURE_CHANNELS),
+	rate = CAPTURE_RATE, channels = CAPTURE_CHANNELS, staging_dir = RECORDING_STAGING_DIR,
+	staging_budget = RECORDING_STAGING_BYTES, on_saved = recording_saved)
+# older recordings are converted to the capture format by a background process pool (transcode.py)
+TRANSCODER = transcode.Transcoder(CAPTURE_RATE, CAPTURE_CHANNELS,
+	on_done = lambda path: RECORDINGS[os.path.basename(os.path.dirname(path))].refresh(path), pool = TRANSCODE_POOL)
+# keypresses and hang-ups cut the current prompt off within one audio period,
+# straight from button_pressed/phone_hook, before they have even read the ADC
+BARGE_IN = barge_in.BargeIn(ENGINE, lambda: GPIO.input(PRESSED))
+
+# USAGE
+# Pickups, call lengths, menu choices and recordings are counted in memory and snapshotted
+# once a minute, one small file per day (usage.py); "python3 usage.py weekly" rolls them up
+USAGE_DIR = os.environ.get("WONDERPHONE_USAGE", usage.DIRECTORY)
+# menu choices are counted per language: states "1.." are English, "2.." Spanish
+USAGE = usage.Usage(USAGE_DIR, "payphone", language = lambda state: {"1": "en", "2": "es"}.get(state[:1]))
+
 # global vars
-MENU = 0
 HOOKCOUNT = 0
 
-# play wav file on the attached system sound device
+# play wav file on the attached system sound device (through the persistent audio engine)
 def play_wav(wav_filename):
 	global p
 	msg = "playing " + ", ".join(wav_filename)
 	logger.debug(msg)
-	p = subprocess.Popen(
-		['aplay','-i','-D','plughw:1'] + wav_filename,
-		stdin = subprocess.PIPE,
-		stdout = subprocess.PIPE,
-		stderr = subprocess.STDOUT,
-		shell = False
-	)
+	PREFETCH.played(wav_filename)
+	p = ENGINE.play(wav_filename)
 	
-# play wav file on the attached system sound device
-def play_multiple_wav(wav_filename1, wav_filename2):
-	global p
-	msg = "playing " + wav_filename1 + " " + wav_filename2
-	logger.debug(msg)
-	p = subprocess.Popen(
-		['aplay','-i','-D','plughw:1', wav_filename1, wav_filename2],
-		stdin = subprocess.PIPE,
-		stdout = subprocess.PIPE,
-		stderr = subprocess.STDOUT,
-		shell = False
-	)
-
-# record wav file on the attached system sound device
+# record wav file on the attached system sound device (in-process, see recorder.py)
+# up to MAX_RECORDING_SECONDS; the take is staged in RAM and appears as wav_filename once the background writer has copied it out after r.save()
 def record_wav(wav_filename):
 	global r
-	r = subprocess.Popen(
-		['arecord','-f','cd','-d','30','-t','wav','-D','plughw:1','--max-file-time','30',wav_filename],
-		stdin = subprocess.PIPE,
-		stdout = subprocess.PIPE,
-		stderr = subprocess.STDOUT,
-		shell = False
-	)
-	print(r.stdout.read())
-
-# find a random file in the recordings to play
-def find_file(path):
-	files = [f for f in listdir(path) if isfile(join(path, f))]
-	#print files
-	#print len(files)
-	x = 0
-	x = randrange(len(files))
-	#print x
-	filename = path + "/" + files[x]
+	r = RECORDER.record(wav_filename, max_seconds = MAX_RECORDING_SECONDS)
+
+# find a random file in the recordings to play, without repeats until all have played
+def find_file(lang):
+	name = RESPONSES[lang].pick()
+	if name is None:
+		return None
+	filename = RECORDINGS[lang].path(name)
 	#print(filename)
 	return filename
 
+# record a personal prompt (menu 7, then 1) into the language's recordings; * or # ends it early,
+# and a hang-up ends it too (the take is kept)
+async def record_prompt(lang):
+	year, month, day, hour, minute, second = time.strftime("%Y,%m,%d,%H,%M,%S").split(',')
+	savename = RECORDINGS[lang].path(year + month + day + "-" + hour + minute + second + ".wav")
+	print("recording started")
+	logger.debug("recording started")
+	record_wav(savename)
+	try:
+		await CORE.finished(r)
+	finally:
+		r.save()
+		USAGE.count("recordings_saved")
+	print("recording stopped")
+	logger.debug("recording stopped")
+
+# play a visitor's recording (menu 8)
+def respond(lang):
+	filename = find_file(lang)
+	if filename is not None:
+		play_wav([filename])
+		USAGE.count("responses_played")
+	else:
+		USAGE.count("responses_missing")
+
+# wait_for_playback: a keypress cuts the prompt off in the audio engine (barge-in), once the key that chose it is let go
+async def wait_for_playback():
+	await CORE.when(SAMPLER.add_release_callback)
+	BARGE_IN.arm()
+	try:
+		await CORE.finished(p)
+	finally:
+		BARGE_IN.disarm()
+
+def menu_transition(state, key, transition):
+	if DEBUG_PRESSED and transition.label:
+		print(state, key, transition.label)
+
+# the menu: states, keys and the audio for each are defined in menus.py and compiled
+# into a transition table, so a keypress is a single table lookup (menu.py)
+MENU = menu.build(menus.PAYPHONE, {
+	"play": lambda *wav_filenames: play_wav(list(wav_filenames)),
+	"wait": wait_for_playback,
+	"record": record_prompt,
+	"respond": respond,
+}, on_transition = menu_transition)
+# while a prompt plays, the audio behind the keys most often pressed next is read ahead (prefetch.py)
+PREFETCH = prefetch.Prefetcher(MENU, PROMPT_CACHE, ASSETS)
+if SIM is not None:
+	SIM.attach(MENU, RECORDINGS.values(), ENGINE)
+USAGE.attach(MENU)
+# GPIO callbacks cut off what is playing or recording and post the event; one asyncio loop runs the menu (core.py)
+CORE = core.PhoneCore(MENU, speed = SIM.speed if SIM else 1.0)
+
 # determine what to do when a button is pressed
 def button_pressed(channel):
-	global MENU
 	if GPIO.input(HOOK) == 1:
-		btnval = readadc(0, SPICLK, SPIMOSI, SPIMISO, SPICS) # check value of ADC
+		BARGE_IN.key_pressed()
+		# take the debounced press that raised this edge from the sampler
+		event = SAMPLER.next_press(timeout = KEY_EVENT_TIMEOUT, since = time.monotonic() - KEY_EVENT_TIMEOUT)
+		btnval = event.value if event is not None else SAMPLER.latest()
 		if DEBUG_RAWADC:
 			print ("btnval:", btnval)
-			
-		if btnval > 980: # 1
-			if p.poll() == None:
-				p.kill()
-			# English selected
-			if MENU == -1:
-				if DEBUG_PRESSED:
-					print("1 ENGLISH")
-					logger.debug("1")
-				MENU = 1
-				play_wav(["/media/pi/WONDERPHONE/prompts/en/MainMenu.wav"])
-			# English selected --> Story from Dallas' Past
-			elif MENU == 1:
-				if DEBUG_PRESSED:
-					print("11 Story from Dallas' Past.")
-					logger.debug("11")
-				MENU = 11
-				play_wav(["/media/pi/WONDERPHONE/prompts/en/Menu1.wav", "/media/pi/WONDERPHONE/stories/1/PersonalStory.wav"])
-			# Spanish selected --> Story from Dallas' Past
-			elif MENU == 2:
-				if DEBUG_PRESSED:
-					print("21 Story from Dallas' Past. (Spanish)")
-					logger.debug("21")
-				MENU = 21
-				play_wav(["/media/pi/WONDERPHONE/prompts/es/Menu1.wav","/media/pi/WONDERPHONE/stories/1/PersonalStory.wav"])
-			# English selected --> Personal Prompt --> Recording
-			elif MENU == 17:
-				if DEBUG_PRESSED:
-					print("171 Recording Personal Prompt.")
-					logger.debug("171")
-				MENU = 171
-				play_wav(["/media/pi/WONDERPHONE/prompts/recordtone.wav"])
-				p.wait()
-				year, month, day, hour, minute, second = time.strftime("%Y,%m,%d,%H,%M,%S").split(',')
-				savename = "/media/pi/WONDERPHONE/recordings/en/" + year + month + day + "-" + hour + minute + second + ".wav"
-				print("recording started")
-				logger.debug("recording started")
-				record_wav(savename)
-				print("recording stopped")
-				logger.debug("recording stopped")
-				play_wav(["/media/pi/WONDERPHONE/prompts/en/Finish7.wav"])
-			# Spanish selected --> Personal Prompt --> Recording
-			elif MENU == 27:
-				if DEBUG_PRESSED:
-					print("271 Recording Personal Prompt. (Spanish)")
-					logger.debug("271")
-				MENU = 271
-				play_wav(["/media/pi/WONDERPHONE/prompts/recordtone.wav"])
-				p.wait()
-				year, month, day, hour, minute, second = time.strftime("%Y,%m,%d,%H,%M,%S").split(',')
-				savename = "/media/pi/WONDERPHONE/recordings/es/" + year + month + day + "-" + hour + minute + second + ".wav"
-				print("recording started")
-				logger.debug("recording started")
-				record_wav(savename)
-				print("recording stopped")
-				logger.debug("recording stopped")
-				play_wav(["/media/pi/WONDERPHONE/prompts/es/Finish7.wav"])
-			else:
-				print("New menu val " + str(math.floor(MENU/10)))
-				while(MENU > 2):
-					MENU = math.floor(MENU/10)
-	
-		if btnval > 870 and btnval < 910: # 2
-			if p.poll() == None:
-				p.kill()
-			# Spanish selected
-			if MENU == -1:
-				if DEBUG_PRESSED:
-					print("2 SPANISH")
-					logger.debug("2")
-				MENU = 2
-				play_wav(["/media/pi/WONDERPHONE/prompts/es/MainMenu.wav"])
-			# English selected --> Story about Dallas' Future
-			elif MENU == 1:
-				if DEBUG_PRESSED:
-					print("12 Story about Dallas' Future.")
-					logger.debug("12")
-				MENU = 12
-				play_wav(["/media/pi/WONDERPHONE/prompts/en/Menu2.wav", "/media/pi/WONDERPHONE/stories/2/FutureStory.wav"])
-			# Spanish selected --> Story about Dallas' Future
-			elif MENU == 2:
-				if DEBUG_PRESSED:
-					print("22 Story about Dallas' Future. (Spanish)")
-					logger.debug("22")
-				MENU = 22
-				play_wav(["/media/pi/WONDERPHONE/prompts/es/Menu2.wav", "/media/pi/WONDERPHONE/stories/2/FutureStory.wav"])
-			
-		if btnval > 760 and btnval < 810: # 3
-			if p.poll() == None:
-				p.kill()
-			# English selected --> Action Prompt
-			if MENU == 1:
-				if DEBUG_PRESSED:
-					print("13 Action Prompt.")
-					logger.debug("13")
-				MENU = 13
-				play_wav(["/media/pi/WONDERPHONE/prompts/en/Menu3.wav", "/media/pi/WONDERPHONE/prompts/en/Prompt3.wav"])
-			# Spanish selected --> Action Prompt
-			elif MENU == 2:
-				if DEBUG_PRESSED:
-					print("23 Action Prompt. (Spanish)")
-					logger.debug("23")
-				MENU = 23
-				play_wav(["/media/pi/WONDERPHONE/prompts/es/Menu3.wav", "/media/pi/WONDERPHONE/prompts/es/Prompt3.wav"])
-				
-		if btnval > 700 and btnval < 750: # 4
-			if p.poll() == None:
-				p.kill()
-			# English selected --> Historical Wonder
-			if MENU == 1:
-				if DEBUG_PRESSED:
-					print("14 Historical Wonder.")
-					logger.debug("14")
-				MENU = 14
-				play_wav(["/media/pi/WONDERPHONE/prompts/en/Menu4.wav", "/media/pi/WONDERPHONE/stories/4/HistoryStory.wav"])
-			# Spanish selected --> Action Prompt
-			elif MENU == 2:
-				if DEBUG_PRESSED:
-					print("24 Historical Wonder. (Spanish)")
-					logger.debug("24")
-				MENU = 24
-				play_wav(["/media/pi/WONDERPHONE/prompts/es/Menu4.wav", "/media/pi/WONDERPHONE/stories/4/HistoryStory.wav"])
-				
-		if btnval > 650 and btnval < 670: # 5
-			if p.poll() == None:
-				p.kill()
-			# English selected --> Architectural Wonder
-			if MENU == 1:
-				if DEBUG_PRESSED:
-					print("15 Architectural Wonder.")
-					logger.debug("15")
-				MENU = 15
-				play_wav(["/media/pi/WONDERPHONE/prompts/en/Menu5.wav", "/media/pi/WONDERPHONE/stories/5/ArchitectureStory.wav"])
-			# Spanish selected --> Architectural Wonder
-			elif MENU == 2:
-				if DEBUG_PRESSED:
-					print("25 Architectural Wonder. (Spanish)")
-					logger.debug("25")
-				MENU = 25
-				play_wav(["/media/pi/WONDERPHONE/prompts/es/Menu5.wav", "/media/pi/WONDERPHONE/stories/5/ArchitectureStory.wav"])
-				
-		if btnval > 580 and btnval < 610: # 6
-			if p.poll() == None:
-				p.kill()
-			# English selected --> Musical Wonder
-			if MENU == 1:
-				if DEBUG_PRESSED:
-					print("16 Musical Wonder.")
-					logger.debug("16")
-				MENU = 16
-				play_wav(["/media/pi/WONDERPHONE/prompts/en/Menu6.wav", "/media/pi/WONDERPHONE/stories/6/GarageGrooves1.wav"])
-			# Spanish selected --> Musical Wonder
-			elif MENU == 2:
-				if DEBUG_PRESSED:
-					print("26 Musical Wonder. (Spanish)")
-					logger.debug("26")
-				MENU = 26
-				play_wav(["/media/pi/WONDERPHONE/prompts/es/Menu6.wav", "/media/pi/WONDERPHONE/stories/6/GarageGrooves1.wav"])
-				
-		if btnval > 540 and btnval < 570: # 7
-			if p.poll() == None:
-				p.kill()
-			# English selected --> Personal Prompt
-			if MENU == 1:
-				if DEBUG_PRESSED:
-					print("17 Personal Prompt.")
-					logger.debug("17")
-				MENU = 17
-				play_wav(["/media/pi/WONDERPHONE/prompts/en/Menu7.wav", "/media/pi/WONDERPHONE/prompts/en/Prompt7.wav", "/media/pi/WONDERPHONE/prompts/en/Ready7.wav"])
-			# Spanish selected --> Personal Prompt
-			elif MENU == 2:
-				if DEBUG_PRESSED:
-					print("27 Personal Prompt. (Spanish)")
-					logger.debug("27")
-				MENU = 27
-				play_wav(["/media/pi/WONDERPHONE/prompts/es/Menu7.wav", "/media/pi/WONDERPHONE/prompts/es/Prompt7.wav", "/media/pi/WONDERPHONE/prompts/es/Ready7.wav"])
-				
-		if btnval > 500 and btnval < 525: # 8
-			if p.poll() == None:
-				p.kill()
-			# English selected --> Personal Responses 
-			if MENU == 1:
-				if DEBUG_PRESSED:
-					print("18 Personal Responses.")
-					logger.debug("18")
-				MENU = 18
-				play_wav(["/media/pi/WONDERPHONE/prompts/en/Menu8.wav", "/media/pi/WONDERPHONE/prompts/en/Prompt8.wav", "/media/pi/WONDERPHONE/prompts/en/Finish8.wav"])
-				p.wait()
-				filename = find_file("/media/pi/WONDERPHONE/recordings/en")
-				play_wav([filename])
-				
-			# Spanish selected --> Personal Responses
-			elif MENU == 2:
-				if DEBUG_PRESSED:
-					print("28 Personal Responses. (Spanish)")
-					logger.debug("28")
-				MENU = 28
-				play_wav(["/media/pi/WONDERPHONE/prompts/es/Menu8.wav", "/media/pi/WONDERPHONE/prompts/es/Prompt8.wav", "/media/pi/WONDERPHONE/prompts/es/Finish8.wav"])
-				p.wait()
-				filename = find_file("/media/pi/WONDERPHONE/recordings/es")
-				play_wav([filename])
-				
-		if btnval > 470 and btnval < 490: # 9
-			if p.poll() == None:
-				p.kill()
-			# English selected --> Wonder Hunt
-			if MENU == 1:
-				if DEBUG_PRESSED:
-					print("19 Wonder Hunt.")
-					logger.debug("19")
-				MENU = 19
-				play_wav(["/media/pi/WONDERPHONE/prompts/en/Menu9.wav", "/media/pi/WONDERPHONE/prompts/en/Prompt9.wav"])
-			# Spanish selected --> Wonder Hunt
-			elif MENU == 2:
-				if DEBUG_PRESSED:
-					print("29 Wonder Hunt. (Spanish)")
-					logger.debug("29")
-				MENU = 29
-				play_wav(["/media/pi/WONDERPHONE/prompts/es/Menu9.wav", "/media/pi/WONDERPHONE/prompts/es/Prompt9.wav"])
-				
-		if btnval > 420 and btnval < 440: # 0
+		key = KEYPAD.decode(btnval) # O(1) lookup in the calibrated keypad table
+		if key is None:
+			return
+
+		try:
 			if p.poll() == None:
-				p.kill()
-			# English selected --> About Wonderphone
-			if MENU == 1:
-				if DEBUG_PRESSED:
-					print("10 About Wonderphone.")
-					logger.debug("10")
-				MENU = 10
-				play_wav(["/media/pi/WONDERPHONE/prompts/en/Menu10.wav"])
-			# Spanish selected --> About Wonderphone
-			elif MENU == 2:
-				if DEBUG_PRESSED:
-					print("20 About Wonderphone. (Spanish)")
-					logger.debug("20")
-				MENU = 20
-				play_wav(["/media/pi/WONDERPHONE/prompts/es/Menu10.wav"])
-				
-		if btnval > 445 and btnval < 470: # star
-			try:
-				if p.poll() == None:
-					p.kill()
-			except NameError:
-				print ("p doesn't exist")
-			try:
-				if r.poll() == None:
-					r.kill()
-			except NameError:
-				print ("r doesn't exist")
-			# English selected --> Return to English menu
-			if MENU < 20 and MENU >= 10  or MENU >= 100 and MENU < 200:
-				if DEBUG_PRESSED:
-					print("STAR Return to English menu.")
-					logger.debug("STAR")
-					print("English Menu.")
-					logger.debug("English Menu.")
-				play_wav(["/media/pi/WONDERPHONE/prompts/en/MainMenu.wav"])
-				MENU = 1
-			# Spanish selected --> Return to Spanish menu
-			elif MENU < 30 and MENU >= 20 or MENU >= 200 and MENU < 300:
-				if DEBUG_PRESSED:
-					print("STAR Return to Spanish menu.")
-					logger.debug("STAR")
-					print("Spanish Menu.")
-					logger.debug("Spanish Menu.")
-				play_wav(["/media/pi/WONDERPHONE/prompts/es/MainMenu.wav"])
-				MENU = 2
-		
-		if btnval > 390 and btnval < 420: # pound
-			try:
-				if p.poll() == None:
-					p.kill()
-			except NameError:
-				print ("p doesn't exist")
+				p.stop()
+		except NameError:
+			print ("p doesn't exist")
+		if key == "*" or key == "#":
 			try:
 				if r.poll() == None:
 					r.kill()
 			except NameError:
 				print ("r doesn't exist")
-			# English selected --> Return to English menu
-			if MENU < 20 and MENU >= 10  or MENU >= 100 and MENU < 200:
-				if DEBUG_PRESSED:
-					print("POUND Return to English menu.")
-					logger.debug("POUND")
-					print("English Menu.")
-					logger.debug("English Menu.")
-				play_wav(["/media/pi/WONDERPHONE/prompts/en/MainMenu.wav"])
-				MENU = 1
-			# Spanish selected --> Return to Spanish menu
-			elif MENU < 30 and MENU >= 20 or MENU >= 200 and MENU < 300:
-				if DEBUG_PRESSED:
-					print("POUND Return to Spanish menu.")
-					logger.debug("POUND")
-					print("Spanish Menu.")
-					logger.debug("Spanish Menu.")
-				play_wav(["/media/pi/WONDERPHONE/prompts/es/MainMenu.wav"])
-				MENU = 2
+		CORE.post(key)
 
 # phone hook: start the phone menu on switch off
 def phone_hook(channel):
-	global MENU
 	global HOOKCOUNT
 	hookval = GPIO.input(HOOK) # check value of hook switch
+	if hookval == 0:
+		BARGE_IN.hung_up()
 	#if hookval == 1:
 
 	if DEBUG_HOOK:
 		print(hookval, "Phone off hook.")
-	if DEBUG_PRESSED:
-		print("Main Menu.")
-		logger.debug("Main Menu.")
-	MENU = -1
 	HOOKCOUNT += 1
+	USAGE.hook(hookval == 1)
 	msg = "Phone off hook. HOOKCOUNT: " + str(HOOKCOUNT)
 	logger.debug(msg)
 	try:
 		if p.poll() == None:
-			p.kill()
+			p.stop()
 			print("MEF: ending current playback; returning to main menu")
 	except NameError:
 		print("MEF: error; p does not exist")
 
-
-	wav_file = "/media/pi/WONDERPHONE/prompts/languageselect.wav"
-	play_wav([wav_file])
+	CORE.post("hook") # back to the language selection
 
 def main():
 	try:
+		SAMPLER.start()
+		for index in RECORDINGS.values():
+			index.start_watching()
+			TRANSCODER.submit_backlog(index)
+		PROMPT_CACHE.preload() # read every prompt off the USB stick once, before the first call
+		CORE.start()
+		USAGE.start()
+		tracing.start() # latency histograms of the hot paths, with WONDERPHONE_TRACE=/path/trace.json (tracing.py)
 		phone_hook(HOOK)
 		logger.debug("---------PROGRAM START---------")
 		print("Waiting for action...")
@@ -477,10 +278,13 @@ def main():
 		print("hookcount total:", HOOKCOUNT)
 		msg = "hookcount total:" + str(HOOKCOUNT)
 		logger.debug(msg)
+		logger.debug("prompt cache: " + str(PROMPT_CACHE.stats()) + " prebuilt: " + str(ASSETS.stats()) + " prefetch: " + str(PREFETCH.stats()) + " core: " + str(CORE.stats()))
+		logger.debug("recorder: " + str(RECORDER.stats()) + " transcoder: " + str(TRANSCODER.stats()) + " trimmer: " + str(TRIMMER.stats()))
+		logger.debug("barge-in: " + str(BARGE_IN.fire_count) + " cancel-to-silence: " + str(ENGINE.cancel_stats()))
 		logger.debug("----------PROGRAM END----------")
 		try:
 			if p.poll() == None:
-				p.kill()
+				p.stop()
 		except NameError:
 			print ("p doesn't exist")
 		try:
@@ -491,7 +295,7 @@ def main():
 	except KeyboardInterrupt:
 		try:
 			if p.poll() == None:
-				p.kill()
+				p.stop()
 		except NameError:
 			print ("p doesn't exist")
 		try:
@@ -500,6 +304,20 @@ def main():
 		except NameError:
 			print ("r doesn't exist")
 		GPIO.cleanup()		# clean up GPIO on CTRL+C exit
+	CORE.close()
+	SAMPLER.close()
+	RECORDER.close()
+	TRANSCODER.close()
+	TRIMMER.close()
+	PREFETCH.close()
+	for index in RECORDINGS.values():
+		index.close()
+	BARGE_IN.close()
+	ENGINE.close()			# release the sound device
+	tracing.close()			# final export of the histograms
+	USAGE.close()			# last usage snapshot
+	logger.debug("log writer: " + str(handler.stats()))
+	handler.close()			# write out the last queued log lines
 	sys.exit(0)				# system exit
 	GPIO.cleanup()			# clean up GPIO on normal exit
 
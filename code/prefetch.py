@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# Predictive prefetch for the Wonderphone.
+# While a prompt plays, the caller can only press one of a few keys, and the menu table
+# (menu.py) says what each of them will play. The prefetcher listens to the menu, and on
+# every move it warms the first file of the likeliest next transitions on a background
+# thread: prompts the PromptCache covers are loaded into it, anything else (stories,
+# recordings) has its first PREFETCH_BYTES read so the USB stick's pages are in the page
+# cache when playback starts. With learn=True the candidates are ranked by how often each
+# transition has been taken from that state; otherwise by the menu's own order. A
+# predict(state) callback can add files the table can't know about (the next recording).
+# The phone scripts call played() from play_wav, which keeps the counters: a hit is a
+# play whose first file was warmed beforehand, and time saved is what warming it took.
+
+import os, time, wave, queue, threading, logging
+from collections import OrderedDict, defaultdict
+
+logger = logging.getLogger('logwonderphone')
+
+CANDIDATES 		= 3					# transitions warmed per menu state
+PREFETCH_BYTES 	= 1024 * 1024		# head of an uncached file read into the page cache
+READ_BLOCK 		= 256 * 1024
+WARM_ENTRIES 	= 64				# files remembered as warm
+
+class Prefetcher:
+	def __init__(self, menu, cache=None, assets=None, candidates=CANDIDATES, learn=True, predict=None):
+		self.menu = menu
+		self.cache = cache
+		self.assets = assets
+		self.candidates = candidates
+		self.learn = learn
+		self.predict = predict
+		self.counts = defaultdict(int)		# (state, event) -> times taken
+		self.warm = OrderedDict()			# path -> seconds it took to warm, oldest first
+		self.pending = set()
+		self.generation = 0
+		self.lock = threading.Lock()
+		self.jobs = queue.Queue()
+		self.prefetched = 0
+		self.hits = 0
+		self.late = 0					# played while still being warmed
+		self.misses = 0
+		self.saved = 0.0
+		self.thread = threading.Thread(target=self._run, name="prefetch", daemon=True)
+		self.thread.start()
+		menu.listeners.append(self._moved)
+
+	# candidates_for: files likely to be played next from a state, best first
+	def candidates_for(self, state):
+		outgoing = self.menu.outgoing(state)
+		if self.learn:
+			counts = self.counts
+			outgoing.sort(key=lambda te: -sum(counts[(state, e)] for e in te[1]))
+		paths = []
+		for t, events in outgoing[:self.candidates]:
+			if t.audio and t.audio[0] not in paths:
+				paths.append(t.audio[0])
+		if self.predict is not None:
+			paths.extend(p for p in self.predict(self.menu.names[state]) if p not in paths)
+		return paths
+
+	# played: note what is about to play; call it before handing the files to the engine
+	def played(self, paths):
+		if not paths or not isinstance(paths[0], str):
+			return
+		path = paths[0]
+		with self.lock:
+			if path in self.warm:
+				self.hits += 1
+				self.saved += self.warm[path]
+			elif path in self.pending:
+				self.late += 1
+			else:
+				self.misses += 1
+
+	def stats(self):
+		with self.lock:
+			plays = self.hits + self.late + self.misses
+			return {"prefetched": self.prefetched, "hits": self.hits, "late": self.late, "misses": self.misses,
+				"hit_rate": round(self.hits / float(plays), 3) if plays else None,
+				"saved_ms": round(1000 * self.saved, 1)}
+
+	def close(self):
+		self.jobs.put(None)
+		self.thread.join()
+
+	# _moved: menu listener; queue the new state's candidates, dropping any still queued for the old one
+	def _moved(self, state, event, transition):
+		self.counts[(state, event)] += 1
+		paths = self.candidates_for(transition.target)
+		if transition.audio:
+			paths = [p for p in paths if p != transition.audio[0]]	# about to be played anyway
+		with self.lock:
+			self.generation += 1
+			generation = self.generation
+			paths = [p for p in paths if p not in self.warm]
+			self.pending = set(paths)
+		for path in paths:
+			self.jobs.put((generation, path))
+
+	def _run(self):
+		while True:
+			job = self.jobs.get()
+			if job is None:
+				return
+			generation, path = job
+			if generation != self.generation:
+				continue
+			try:
+				cost = self._warm(path)
+			except (OSError, EOFError, wave.Error, ValueError) as e:
+				logger.debug("prefetch: %s (%s)", path, e)
+				cost = None
+			with self.lock:
+				self.pending.discard(path)
+				if cost is not None:
+					self.warm[path] = cost
+					self.warm.move_to_end(path)
+					while len(self.warm) > WARM_ENTRIES:
+						self.warm.popitem(last=False)
+
+	# _warm: bring one file into memory; returns the seconds it took (0 if it was already there)
+	def _warm(self, path):
+		if self.cache is not None and self.cache.covers(path):
+			if self.cache.cached(path):
+				return 0.0
+			start = time.perf_counter()
+			self.cache.prefetch(path)
+			self.prefetched += 1
+			return time.perf_counter() - start
+		if self.assets is not None:
+			path = self.assets.resolve(path)
+		start = time.perf_counter()
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			offset = 0
+			while offset < PREFETCH_BYTES:
+				block = os.pread(fd, READ_BLOCK, offset)
+				if not block:
+					break
+				offset += len(block)
+		finally:
+			os.close(fd)
+		self.prefetched += 1
+		return time.perf_counter() - start
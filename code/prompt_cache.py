@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+# Preloaded prompt cache for the Wonderphone.
+# Every prompt under the given roots is loaded once at startup, already in the
+# output device's format, so playback never has to go back to the slow USB stick.
+# Files that are already in device format are memory-mapped and handed out as
+# zero-copy views; everything else is converted once and kept as bytes.
+# A byte budget with LRU eviction keeps the cache inside a small Pi's RAM.
+# With prebuilt assets (assets.py), prompts are loaded from their converted copies,
+# which are already in device format and so get mapped instead of converted.
+
+import os, mmap, wave, struct, threading, logging
+from collections import OrderedDict
+import audio, tracing
+
+logger = logging.getLogger('logwonderphone')
+
+DEFAULT_BUDGET_BYTES = 48 * 1024 * 1024
+
+# wav_data_chunk: return (offset, length) of the pcm data chunk in a wav file
+def wav_data_chunk(f):
+	f.seek(0)
+	riff, _, wavetag = struct.unpack('<4sI4s', f.read(12))
+	if riff != b'RIFF' or wavetag != b'WAVE':
+		raise wave.Error("not a RIFF/WAVE file")
+	while True:
+		header = f.read(8)
+		if len(header) < 8:
+			raise wave.Error("no data chunk")
+		tag, size = struct.unpack('<4sI', header)
+		if tag == b'data':
+			return f.tell(), size
+		f.seek(size + (size & 1), os.SEEK_CUR)
+
+class PromptCache:
+	def __init__(self, roots, budget_bytes=DEFAULT_BUDGET_BYTES, channels=audio.CHANNELS, rate=audio.RATE, assets=None):
+		self.roots = [os.path.join(os.path.abspath(r), "") for r in roots]
+		self.budget_bytes = budget_bytes
+		self.channels = channels
+		self.rate = rate
+		self.assets = assets
+		self.entries = OrderedDict()	# path -> pcm buffer, least recently used first
+		self.bytes_used = 0
+		self.hits = 0
+		self.misses = 0
+		self.prefetches = 0
+		self.evictions = 0
+		self.lock = threading.Lock()
+
+	# covers: only prompts under our roots are cached; recordings go straight to disk
+	def covers(self, path):
+		path = os.path.abspath(path)
+		return any(path.startswith(root) for root in self.roots)
+
+	# cached: whether a prompt is in memory right now
+	def cached(self, path):
+		with self.lock:
+			return os.path.abspath(path) in self.entries
+
+	# preload: load every wav under the roots that still fits in the budget
+	def preload(self):
+		for root in self.roots:
+			for dirpath, dirnames, filenames in os.walk(root):
+				dirnames.sort()
+				for name in sorted(filenames):
+					if not name.lower().endswith(".wav"):
+						continue
+					path = os.path.join(dirpath, name)
+					if path in self.entries:
+						continue
+					try:
+						buf = self._load(path)
+					except (OSError, EOFError, wave.Error, ValueError):
+						logger.exception("prompt cache: could not load %s", path)
+						continue
+					if self.bytes_used + len(buf) > self.budget_bytes:
+						logger.debug("prompt cache: no room left for %s, not preloaded", path)
+						continue
+					with self.lock:
+						self._insert(path, buf)
+
+	# get: return the device-format pcm for a prompt, loading it on a miss
+	def get(self, path):
+		path = os.path.abspath(path)
+		with self.lock:
+			buf = self.entries.get(path)
+			if buf is not None:
+				self.entries.move_to_end(path)
+				self.hits += 1
+				return buf
+			self.misses += 1
+		return self._fill(path)
+
+	# prefetch: load a prompt ahead of its playback (prefetch.py); counted apart from playback's hits and misses
+	def prefetch(self, path):
+		path = os.path.abspath(path)
+		with self.lock:
+			if path in self.entries:
+				return
+			self.prefetches += 1
+		self._fill(path)
+
+	def stats(self):
+		with self.lock:
+			return {
+				"entries": len(self.entries),
+				"bytes": self.bytes_used,
+				"budget": self.budget_bytes,
+				"hits": self.hits,
+				"misses": self.misses,
+				"prefetches": self.prefetches,
+				"evictions": self.evictions,
+			}
+
+	def _fill(self, path):
+		buf = self._load(path)
+		with self.lock:
+			if path not in self.entries:
+				self._insert(path, buf)
+		return buf
+
+	def _insert(self, path, buf):
+		self.entries[path] = buf
+		self.bytes_used += len(buf)
+		# Evict least recently used prompts, but never the one we just added
+		while self.bytes_used > self.budget_bytes and len(self.entries) > 1:
+			_, old = self.entries.popitem(last=False)
+			self.bytes_used -= len(old)
+			self.evictions += 1
+
+	@tracing.timed("fs.prompt_load")
+	def _load(self, path):
+		if self.assets is not None:
+			path = self.assets.resolve(path)
+		w = wave.open(path, 'rb')
+		try:
+			params = (w.getnchannels(), w.getsampwidth(), w.getframerate())
+		finally:
+			w.close()
+
+		if params == (self.channels, audio.SAMPLE_WIDTH, self.rate):
+			# Already playable as-is: map the file and hand out a view of the data chunk
+			with open(path, 'rb') as f:
+				offset, length = wav_data_chunk(f)
+				m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			length = min(length, len(m) - offset)
+			view = memoryview(m)[offset:offset + length]
+			# Touch every page now so the read from USB happens at startup, not mid-call
+			sum(view[::mmap.PAGESIZE])
+			return view
+
+		params, data = audio.read_wav(path)
+		return audio.to_device_format(data, params, self.channels, self.rate)
@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+
+# In-process audio recorder for the Wonderphone (replaces spawning arecord).
+# A capture thread reads period-sized chunks from an input source and appends them
+# to a temp file (<name>.wav.part) that starts with a placeholder wav header. When
+# capture stops the header's RIFF and data sizes are patched in. The recording is then
+# only pending: save() renames it onto its final name atomically, discard() unlinks it.
+# Nothing ever has to look through the directory for "the newest file" to undo a
+# recording, and a half-written take never appears under a .wav name.
+#
+# With a staging directory on tmpfs, the take is captured there instead, so the call
+# never waits on the USB stick and a hang-up costs no flash writes at all. Saving
+# queues the take for a background writer that copies it out and renames it into
+# place. Back-pressure: every take reserves its full length of staging space up front
+# (what's left, if it has no limit); a take that outgrows its reservation is moved to
+# the USB stick by a helper thread and carries on there, and when too little room is
+# left for a new take it records straight to the stick as before. Queued takes
+# outlive a restart of the phone script, not a power cut or reboot: tmpfs is RAM.
+#
+# Input sources:
+#   alsa[:device]   the sound card (pyalsaaudio), opened only while recording
+#   file:/path.wav  plays a wav file in as if it were the microphone (then silence); for tests
+#   silence         endless silence
+# Both scripts read WONDERPHONE_AUDIO_SOURCE to pick one.
+
+import os, struct, threading, queue, shutil, time, logging
+import audio, tracing
+
+logger = logging.getLogger('logwonderphone')
+
+CHUNK_FRAMES 	= 1024		# frames per read from the input source
+FLUSH_INTERVAL 	= 1.0		# seconds between flush + fsync of the temp file; 0 syncs every chunk
+TEMP_SUFFIX 	= ".part"
+
+# write-behind staging (see Recorder): takes are captured in RAM and only copied to the USB stick once saved
+STAGING_DIR 	= "/dev/shm/wonderphone-recordings"
+STAGING_BUDGET 	= 32 * 1024 * 1024	# ~3 minutes of cd-quality audio, live take and unflushed takes together
+MIN_STAGING_SECONDS = 10			# with less room than this left, a take goes straight to disk
+QUEUED_SUFFIX 	= ".queued"			# saved, waiting for the background writer
+DEST_SUFFIX 	= ".dest"			# next to a queued take: the path it is going to
+COPY_BLOCK 		= 256 * 1024
+
+# wav_header: a canonical 44-byte PCM wav header for data_bytes of audio
+def wav_header(channels, rate, sample_width, data_bytes=0):
+	block_align = channels * sample_width
+	return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_bytes, b'WAVE',
+		b'fmt ', 16, 1, channels, rate, rate * block_align, block_align, 8 * sample_width,
+		b'data', data_bytes)
+
+#------------------------------------------ SOURCES ------------------------------------------
+
+class AlsaSource:
+	def __init__(self, device=audio.DEVICE, rate=audio.RATE, channels=audio.CHANNELS, period_frames=CHUNK_FRAMES):
+		import alsaaudio
+		self.alsaaudio = alsaaudio
+		self.device = device
+		self.rate = rate
+		self.channels = channels
+		self.period_frames = period_frames
+		self.pcm = None
+
+	def start(self):
+		alsaaudio = self.alsaaudio
+		self.pcm = alsaaudio.PCM(
+			alsaaudio.PCM_CAPTURE,
+			alsaaudio.PCM_NORMAL,
+			device = self.device,
+			channels = self.channels,
+			rate = self.rate,
+			format = alsaaudio.PCM_FORMAT_S16_LE,
+			periodsize = self.period_frames
+		)
+
+	# read: the next period; empty after an overrun, which pyalsaaudio recovers from on the next read
+	def read(self):
+		length, data = self.pcm.read()
+		return data if length > 0 else b""
+
+	def stop(self):
+		if self.pcm is not None:
+			self.pcm.close()
+			self.pcm = None
+
+	def close(self):
+		self.stop()
+
+# FileSource: a fake microphone that plays a wav file in at real-time pace, then silence
+class FileSource:
+	def __init__(self, filename=None, rate=audio.RATE, channels=audio.CHANNELS, period_frames=CHUNK_FRAMES, realtime=True):
+		self.filename = filename
+		self.rate = rate
+		self.channels = channels
+		self.period_frames = period_frames
+		self.realtime = realtime
+		self.silence = bytes(period_frames * channels * audio.SAMPLE_WIDTH)
+		self.chunks = None
+
+	def start(self):
+		if self.filename is not None:
+			self.chunks = audio.stream_wav(self.filename, self.channels, self.rate, self.period_frames)
+		self.next_time = time.monotonic()
+
+	def read(self):
+		data = None
+		if self.chunks is not None:
+			data = next(self.chunks, None)
+			if data is None:
+				self.chunks = None
+		if data is None:
+			data = self.silence
+		if self.realtime:
+			self.next_time += len(data) / float(self.channels * audio.SAMPLE_WIDTH * self.rate)
+			delay = self.next_time - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+		return data
+
+	def stop(self):
+		if self.chunks is not None:
+			self.chunks.close()
+			self.chunks = None
+
+	def close(self):
+		self.stop()
+
+# open_source: build an input source from a spec: "alsa[:device]", "file:/path.wav" or "silence"
+def open_source(spec, rate=audio.RATE, channels=audio.CHANNELS, chunk_frames=CHUNK_FRAMES):
+	kind, _, arg = spec.partition(":")
+	if kind == "alsa":
+		return AlsaSource(arg or audio.DEVICE, rate, channels, chunk_frames)
+	if kind == "file":
+		return FileSource(arg, rate, channels, chunk_frames)
+	if kind == "silence":
+		return FileSource(None, rate, channels, chunk_frames)
+	raise ValueError("Unknown audio source: " + spec)
+
+# free_path: path, or the same name with -1, -2, ... if a file already has it; a save never overwrites a recording
+def free_path(path):
+	if not os.path.exists(path):
+		return path
+	stem, ext = os.path.splitext(path)
+	n = 1
+	while os.path.exists("%s-%d%s" % (stem, n, ext)):
+		n += 1
+	free = "%s-%d%s" % (stem, n, ext)
+	logger.warning("recorder: %s already exists; saving as %s", path, os.path.basename(free))
+	return free
+
+#------------------------------------------ RECORDING ------------------------------------------
+
+# Recording: one take. Popen-like poll()/wait() while capturing, then save() or discard().
+class Recording:
+	# reserved: bytes of staging space set aside for this take; None writes straight to the destination
+	# previous: the take before this one, which may still be finishing
+	def __init__(self, recorder, path, max_seconds, reserved, previous=None):
+		self.recorder = recorder
+		self.previous = previous
+		self.source = recorder.source
+		self.path = path
+		self.rate = recorder.rate
+		self.channels = recorder.channels
+		self.sample_width = recorder.sample_width
+		self.max_bytes = None if max_seconds is None else int(max_seconds * self.rate) * self.channels * self.sample_width
+		self.flush_interval = recorder.flush_interval
+		self.reserved = reserved
+		if reserved is None:
+			self.temp_path = path + TEMP_SUFFIX
+		else:
+			self.temp_path = os.path.join(recorder.staging_dir, os.path.basename(path) + TEMP_SUFFIX)
+		self.staged = reserved is not None	# still (only) in the staging area
+		self.spill = None					# helper copying the staged part out when the reservation runs out
+		self.data_bytes = 0
+		self.returncode = None
+		self.saved = False
+		self.discarded = False
+		self.flushed = False
+		self.stop_requested = threading.Event()
+		self.done = threading.Event()
+		self.callbacks = []
+		self.lock = threading.Lock()
+		self.thread = threading.Thread(target=self._run, name="recorder", daemon=True)
+
+	def poll(self):
+		return self.returncode
+
+	def wait(self, timeout=None):
+		self.done.wait(timeout)
+		return self.returncode
+
+	# add_done_callback: call fn(take) once capture has ended, from the capture thread (right away if it has)
+	def add_done_callback(self, fn):
+		with self.lock:
+			if not self.done.is_set():
+				self.callbacks.append(fn)
+				return
+		fn(self)
+
+	# duration: seconds captured so far
+	def duration(self):
+		return self.data_bytes / float(self.rate * self.channels * self.sample_width)
+
+	# stop: ask the capture thread to end the take and finalize the temp file's header; returns
+	# straight away (await CORE.finished(take), or wait(), for it to be done). Safe to call more than once.
+	def stop(self):
+		self.stop_requested.set()
+		return self.returncode
+
+	kill = stop
+
+	# save: stop capture and move the take onto its real name once it has ended, on the capture
+	# thread if it is still finishing. A staged take is handed to the background writer and
+	# shows up there once it is flushed.
+	def save(self):
+		self.stop()
+		if not self.saved and not self.discarded:
+			self.saved = True
+			self.add_done_callback(Recording._save)
+		return self.path
+
+	# discard: stop capture and delete the take once it has ended; returns False if it was already saved or discarded
+	def discard(self):
+		self.stop()
+		if self.saved or self.discarded:
+			return False
+		self.discarded = True
+		self.add_done_callback(Recording._remove)
+		return True
+
+	# playable_path: where the take can be played from right now (before or after save)
+	def playable_path(self):
+		if self.saved and (self.flushed or not self.staged):
+			return self.path
+		return self.temp_path
+
+	def _save(self):
+		try:
+			if self.staged:
+				self.recorder._queue(self)
+			else:
+				self.path = free_path(self.path)
+				os.replace(self.temp_path, self.path)
+				self.recorder._saved(self.path)
+		except OSError as e:
+			logger.error("recorder: could not save %s: %s", self.path, e)
+
+	def _remove(self):
+		try:
+			os.remove(self.temp_path)
+		except FileNotFoundError:
+			pass
+
+	def _run(self):
+		source = self.source
+		f = None
+		returncode = 1
+		try:
+			if self.previous is not None:
+				self.previous.done.wait()		# the take before this one lets go of the source first
+				self.previous = None
+			f = open(self.temp_path, "wb")
+			f.write(wav_header(self.channels, self.rate, self.sample_width))
+			source.start()
+			next_flush = time.monotonic() + self.flush_interval
+			while not self.stop_requested.is_set():
+				data = source.read()
+				if self.max_bytes is not None and self.data_bytes + len(data) >= self.max_bytes:
+					data = data[:self.max_bytes - self.data_bytes]
+					self.stop_requested.set()
+				f.write(data)
+				self.data_bytes += len(data)
+				if self.staged:
+					# back-pressure: a take that outgrows its share of the staging area moves to the destination
+					if self.spill is None and self.data_bytes > self.reserved:
+						self.spill = Spill(f, self.temp_path, self.path + TEMP_SUFFIX)
+					if self.spill is not None and self.spill.done.is_set():
+						f = self._finish_spill(f)
+				elif time.monotonic() >= next_flush:
+					f.flush()
+					os.fsync(f.fileno())
+					next_flush = time.monotonic() + self.flush_interval
+			returncode = 0
+		except Exception as e:
+			logger.debug("recorder: %s failed: %s", self.temp_path, e)
+		finally:
+			source.stop()
+			if f is not None:
+				if self.spill is not None and self.staged:
+					self.spill.done.wait()
+					f = self._finish_spill(f)
+				# patch the sizes into the placeholder header
+				f.seek(4)
+				f.write(struct.pack('<I', 36 + self.data_bytes))
+				f.seek(40)
+				f.write(struct.pack('<I', self.data_bytes))
+				f.flush()
+				if not self.staged:
+					os.fsync(f.fileno())
+				f.close()
+			self.returncode = returncode
+			# done only once the callbacks (a deferred save or discard) have run; any added meanwhile run too
+			while True:
+				with self.lock:
+					callbacks, self.callbacks = self.callbacks, []
+					if not callbacks:
+						self.done.set()
+						break
+				for fn in callbacks:
+					fn(self)
+
+	# _finish_spill: append what was captured while the helper copied, then carry on at the destination
+	def _finish_spill(self, f):
+		spill = self.spill
+		if spill.error is not None:
+			logger.debug("recorder: could not move %s out of staging (%s); staying there", self.temp_path, spill.error)
+			self.reserved = float("inf")
+			return f
+		f.flush()
+		with open(self.temp_path, "rb") as staged, open(spill.destination, "ab") as out:
+			staged.seek(spill.copied)
+			shutil.copyfileobj(staged, out)
+		f.close()
+		os.remove(self.temp_path)
+		self.temp_path = spill.destination
+		self.staged = False
+		self.recorder.spills += 1
+		logger.debug("recorder: staging full, %s continues on %s", os.path.basename(self.path), spill.destination)
+		f = open(self.temp_path, "r+b")
+		f.seek(0, os.SEEK_END)
+		return f
+
+# Spill: copy the staged part of a take to its destination on a helper thread, so capture never waits on the USB stick
+class Spill:
+	def __init__(self, f, source, destination):
+		f.flush()
+		self.copied = f.tell()
+		self.source = source
+		self.destination = destination
+		self.error = None
+		self.done = threading.Event()
+		threading.Thread(target=self._run, name="recorder-spill", daemon=True).start()
+
+	@tracing.timed("fs.recording_spill")
+	def _run(self):
+		try:
+			with open(self.source, "rb") as src, open(self.destination, "wb") as out:
+				remaining = self.copied
+				while remaining > 0:
+					block = src.read(min(COPY_BLOCK, remaining))
+					if not block:
+						break
+					out.write(block)
+					remaining -= len(block)
+		except OSError as e:
+			self.error = e
+		self.done.set()
+
+class Recorder:
+	# staging_dir: a RAM-backed directory (tmpfs) where takes are captured during the call; None disables staging
+	# staging_budget: bytes of staging space shared by the live take and takes waiting to be flushed
+	# on_saved: called with the final path once a saved take is on the destination
+	def __init__(self, source, rate=audio.RATE, channels=audio.CHANNELS, sample_width=audio.SAMPLE_WIDTH,
+			flush_interval=FLUSH_INTERVAL, staging_dir=None, staging_budget=STAGING_BUDGET, on_saved=None):
+		self.source = source
+		self.rate = rate
+		self.channels = channels
+		self.sample_width = sample_width
+		self.flush_interval = flush_interval
+		self.staging_dir = staging_dir
+		self.staging_budget = staging_budget
+		self.on_saved = on_saved
+		self.current = None
+		self.queued_bytes = 0				# staged bytes saved but not yet flushed
+		self.queued = 0
+		self.spills = 0
+		self.direct = 0						# takes that went straight to the destination
+		self.flushed = 0
+		self.flush_seconds = 0.0
+		self.lock = threading.Lock()
+		self.flush_queue = queue.Queue()
+		self.flusher = None
+		if staging_dir is not None:
+			try:
+				os.makedirs(staging_dir, exist_ok=True)
+			except OSError as e:
+				logger.debug("recorder: no staging area at %s (%s); recording straight to disk", staging_dir, e)
+				self.staging_dir = None
+		if self.staging_dir is not None:
+			self.flusher = threading.Thread(target=self._flush_run, name="recorder-flush", daemon=True)
+			self.flusher.start()
+			self._recover()
+
+	# record: start capturing a take; one take at a time, so a take still running is stopped
+	def record(self, path, max_seconds=None):
+		previous = self.current
+		if previous is not None:
+			previous.stop()
+		self.current = Recording(self, path, max_seconds, self._reserve(max_seconds), previous)
+		if self.current.reserved is None:
+			self.direct += 1
+		self.current.thread.start()
+		return self.current
+
+	# pending: saved takes still waiting for the background writer
+	def pending(self):
+		return self.queued
+
+	def stats(self):
+		return {"direct": self.direct, "spills": self.spills, "flushed": self.flushed, "pending": self.queued,
+			"flush_seconds": round(self.flush_seconds, 2)}
+
+	def close(self):
+		if self.current is not None:
+			self.current.stop()
+			self.current.wait()
+		if self.flusher is not None:
+			self.flush_queue.put(None)		# the writer finishes everything queued before this
+			self.flusher.join()
+		self.source.close()
+
+	# _reserve: staging space for a new take. A take gets its full length if it has one,
+	# otherwise whatever is free; with less than MIN_STAGING_SECONDS free it goes straight to disk.
+	def _reserve(self, max_seconds):
+		if self.staging_dir is None:
+			return None
+		bytes_per_second = self.rate * self.channels * self.sample_width
+		with self.lock:
+			free = self.staging_budget - self.queued_bytes
+		if free < MIN_STAGING_SECONDS * bytes_per_second:
+			logger.debug("recorder: staging area full (%d bytes waiting); recording straight to disk", self.queued_bytes)
+			return None
+		if max_seconds is not None:
+			return min(free, int(max_seconds * bytes_per_second))
+		return free
+
+	def _saved(self, path):
+		if self.on_saved is not None:
+			self.on_saved(path)
+
+	# _queue: park a saved take in the staging area (under a name that says where it goes) for the writer
+	def _queue(self, take):
+		queued_path = take.temp_path[:-len(TEMP_SUFFIX)] + QUEUED_SUFFIX
+		with open(queued_path + DEST_SUFFIX, "w") as f:
+			f.write(take.path)
+		os.replace(take.temp_path, queued_path)
+		take.temp_path = queued_path
+		size = os.path.getsize(queued_path)
+		with self.lock:
+			self.queued_bytes += size
+			self.queued += 1
+		self.flush_queue.put((queued_path, take.path, size, take))
+
+	# _recover: takes that were saved but not flushed before the process restarted are queued again; unsaved ones are dropped
+	def _recover(self):
+		for name in sorted(os.listdir(self.staging_dir)):
+			staged = os.path.join(self.staging_dir, name)
+			if name.endswith(TEMP_SUFFIX):
+				os.remove(staged)
+			elif name.endswith(QUEUED_SUFFIX):
+				try:
+					with open(staged + DEST_SUFFIX) as f:
+						destination = f.read()
+				except OSError:
+					continue
+				size = os.path.getsize(staged)
+				with self.lock:
+					self.queued_bytes += size
+					self.queued += 1
+				self.flush_queue.put((staged, destination, size, None))
+
+	# _flush_run: the background writer; copies saved takes out to the USB stick one at a time
+	def _flush_run(self):
+		while True:
+			item = self.flush_queue.get()
+			if item is None:
+				return
+			staged, destination, size, take = item
+			start = time.monotonic()
+			try:
+				part = destination + TEMP_SUFFIX
+				with tracing.span("fs.recording_flush"):
+					with open(staged, "rb") as src, open(part, "wb") as out:
+						shutil.copyfileobj(src, out, COPY_BLOCK)
+						out.flush()
+						os.fsync(out.fileno())
+					destination = free_path(destination)
+					os.replace(part, destination)
+				if take is not None:
+					take.path = destination
+					take.flushed = True
+				os.remove(staged)
+				os.remove(staged + DEST_SUFFIX)
+				self.flushed += 1
+				self._saved(destination)
+			except OSError as e:
+				# leave the staged copy where it is; it is picked up again on the next start
+				logger.debug("recorder: could not flush %s to %s (%s)", staged, destination, e)
+			finally:
+				self.flush_seconds += time.monotonic() - start
+				with self.lock:
+					self.queued_bytes -= size
+					self.queued -= 1
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# In-memory index of a recordings directory for the Wonderphone.
+# The directory is listed once; after that the index is kept up to date by our own
+# add/delete calls and by a watcher thread that picks up changes made by anything
+# else (inotify through inotify_simple when it is installed, otherwise polling the
+# directory's mtime). Recording names sort chronologically (zero-padded counters
+# in katies_payphone.py, timestamps in payphone.py), so the index is a sorted list:
+# newest, count and by-position lookups never touch the USB stick.
+# The mtime poller waits for a burst of changes to settle before it lists the
+# directory, and a listing the index already matches (our own saves, trims,
+# transcodes and deletes) is neither synced to the manifest nor announced.
+# With a manifest (manifest.py) the index starts from the manifest instead of the
+# directory, and the watcher's first pass checks the two against each other.
+
+import os, bisect, threading, logging
+import tracing
+
+logger = logging.getLogger('logwonderphone')
+
+SUFFIX = ".wav"
+POLL_INTERVAL = 2.0		# seconds between mtime checks when inotify is not available
+
+class RecordingsIndex:
+	def __init__(self, directory, suffix=SUFFIX, poll_interval=POLL_INTERVAL, manifest=None):
+		self.directory = directory
+		self.suffix = suffix
+		self.poll_interval = poll_interval
+		self.manifest = manifest
+		self.names = []				# oldest first
+		self.lock = threading.Lock()
+		self.closed = threading.Event()
+		self.thread = None
+		self.rescans = 0
+		self.unchanged_rescans = 0		# mtime changes that turned out to be our own
+		self.listeners = []			# callables (kind, name): "add"/"discard" with a name, "rescan" with None
+		if manifest is None:
+			self.rescan()
+		elif manifest.load().found:
+			self.names = [n for n in manifest.names() if self._wanted(n)]
+		else:
+			# no manifest yet (first run): list the directory now; the watcher's first pass fills the manifest in
+			self.names = self._listing() or []
+
+	def __len__(self):
+		return len(self.names)
+
+	def _wanted(self, name):
+		return name.endswith(self.suffix) and not name.startswith(".")
+
+	# rescan: rebuild the index from a full directory listing. With changed_only, a listing
+	# the index already matches (our own add/discard got there first) is left at that.
+	# The listing is published before the manifest is synced: probing a whole USB stick takes a while.
+	@tracing.timed("fs.rescan")
+	def rescan(self, changed_only=False):
+		names = self._listing()
+		if names is None:
+			return
+		if changed_only and names == self.names:
+			self.unchanged_rescans += 1
+			return
+		with self.lock:
+			self.names = names
+			self.rescans += 1
+		self._notify("rescan", None)
+		if self.manifest is not None:
+			self.manifest.sync(names)
+
+	# _listing: sorted recording names in the directory, or None if it can't be listed
+	def _listing(self):
+		try:
+			with os.scandir(self.directory) as entries:
+				return sorted(e.name for e in entries if self._wanted(e.name) and e.is_file())
+		except OSError as e:
+			logger.debug("recordings index: cannot list %s (%s)", self.directory, e)
+			return None
+
+	def path(self, name):
+		return os.path.join(self.directory, name)
+
+	# newest: name of the most recent recording, or None
+	def newest(self):
+		names = self.names
+		return names[-1] if names else None
+
+	# at: name at a position counted from the newest (0 is the newest), like the old reverse-sorted listdir
+	def at(self, position):
+		names = self.names
+		return names[len(names) - 1 - position]
+
+	# info: the manifest entry for a recording (size, duration, format, seq), or None
+	def info(self, name):
+		if self.manifest is None:
+			return None
+		return self.manifest.get(name)
+
+	# add: note a recording we just created; accepts a name or a full path
+	def add(self, name):
+		name = os.path.basename(name)
+		if not self._wanted(name):
+			return
+		added = True
+		with self.lock:
+			names = self.names
+			if not names or name > names[-1]:
+				names.append(name)
+			else:
+				i = bisect.bisect_left(names, name)
+				if i == len(names) or names[i] != name:
+					names.insert(i, name)
+				else:
+					added = False
+		if added:
+			self._notify("add", name)
+		self.refresh(name)
+
+	# refresh: update the manifest entry of a recording that has been written to
+	def refresh(self, name):
+		if self.manifest is None:
+			return
+		try:
+			self.manifest.update(os.path.basename(name))
+		except OSError as e:
+			logger.debug("recordings index: cannot probe %s (%s)", name, e)
+
+	# flag: set extra manifest fields on a recording (e.g. empty=True from trim.py)
+	def flag(self, name, **fields):
+		if self.manifest is None:
+			return False
+		return self.manifest.flag(os.path.basename(name), **fields)
+
+	# discard: forget a recording without touching the file
+	def discard(self, name):
+		name = os.path.basename(name)
+		removed = True
+		with self.lock:
+			names = self.names
+			if names and names[-1] == name:
+				names.pop()
+			else:
+				i = bisect.bisect_left(names, name)
+				if i < len(names) and names[i] == name:
+					del names[i]
+				else:
+					removed = False
+		if removed:
+			self._notify("discard", name)
+		if self.manifest is not None:
+			self.manifest.mark_deleted(name)
+
+	def _notify(self, kind, name):
+		for listener in self.listeners:
+			listener(kind, name)
+
+	# delete: remove the file and its index entry; False if it was already gone
+	def delete(self, name):
+		self.discard(name)
+		try:
+			os.remove(self.path(name))
+		except FileNotFoundError:
+			return False
+		return True
+
+	# delete_newest: delete the most recent recording; returns its name, or None if there was nothing to delete
+	def delete_newest(self):
+		name = self.newest()
+		if name is None or not self.delete(name):
+			return None
+		return name
+
+	#------------------------------------------ WATCHER ------------------------------------------
+
+	# start_watching: follow changes made outside this process (staff copying files, cleanup scripts)
+	def start_watching(self):
+		try:
+			import inotify_simple
+			target, args = self._watch_inotify, (inotify_simple,)
+		except ImportError:
+			target, args = self._watch_mtime, ()
+		self.thread = threading.Thread(target=target, args=args, name="recordings-index", daemon=True)
+		self.thread.start()
+
+	def close(self):
+		self.closed.set()
+		if self.thread is not None and self.thread.is_alive():
+			self.thread.join()
+		if self.manifest is not None:
+			self.manifest.close()
+
+	def _watch_inotify(self, inotify_simple):
+		flags = inotify_simple.flags
+		added = flags.CREATE | flags.MOVED_TO
+		removed = flags.DELETE | flags.MOVED_FROM
+		written = flags.CLOSE_WRITE
+		with inotify_simple.INotify() as inotify:
+			watching = False
+			while not self.closed.is_set():
+				if not watching:
+					try:
+						inotify.add_watch(self.directory, added | removed | written | flags.DELETE_SELF | flags.UNMOUNT)
+						watching = True
+						self.rescan()	# catch up on anything that changed while we weren't watching
+					except OSError:
+						self.closed.wait(self.poll_interval)
+						continue
+				for event in inotify.read(timeout=int(self.poll_interval * 1000)):
+					if event.mask & (flags.Q_OVERFLOW | flags.IGNORED):
+						# events were lost, or the directory went away (USB stick pulled)
+						watching = bool(event.mask & flags.Q_OVERFLOW)
+						self.rescan()
+					elif event.mask & added:
+						self.add(event.name)
+					elif event.mask & removed:
+						self.discard(event.name)
+					elif event.mask & written and self._wanted(event.name):
+						self.refresh(event.name)
+
+	def _watch_mtime(self):
+		last = self._mtime()
+		self.rescan()	# check the starting list (possibly from the manifest) against the disk
+		settling = False
+		while not self.closed.wait(self.poll_interval):
+			mtime = self._mtime()
+			if mtime != last:
+				last = mtime
+				settling = True		# a save is followed by its trim and transcode; wait for the burst to end
+			elif settling:
+				settling = False
+				self.rescan(changed_only=True)
+
+	def _mtime(self):
+		try:
+			return os.stat(self.directory).st_mtime_ns
+		except OSError:
+			return None
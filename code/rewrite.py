@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+# Rewriting Wonderphone recordings in place, for trim.py, normalize.py and transcode.py.
+# A recording is written to a temp file next to it, fsynced and renamed over the
+# original, so a reader or a power cut sees the old file or the new one, never half of
+# one. The phone scripts run these rewrites in the background, in process pools at
+# low priority, leaving the cores to audio and the keypad.
+#
+# A pool's workers are forked as soon as it is made, and the phone scripts make theirs
+# before any of their threads (log writer, audio engine, sampler, ...) are running: a
+# child forked while another thread holds a lock can hang on it for good. Forkserver
+# or spawn would be safe at any time, but they re-run the main script's top level in
+# every worker, which for the phone scripts means the GPIO pins and the sound card.
+
+import os, wave, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+NICE 			= 10
+TEMP_SUFFIX 	= ".part"
+
+# replace_wav: rewrite path as 16-bit pcm; False (and nothing written) if it was deleted meanwhile
+def replace_wav(path, pcm, channels, rate):
+	tmp = path + TEMP_SUFFIX
+	with open(tmp, "wb") as f:
+		w = wave.open(f, "wb")
+		w.setnchannels(channels)
+		w.setsampwidth(2)
+		w.setframerate(rate)
+		w.writeframes(pcm)
+		w.close()
+		f.flush()
+		os.fsync(f.fileno())
+	if not os.path.exists(path):
+		os.remove(tmp)		# deleted while we were working on it; don't bring it back
+		return False
+	os.replace(tmp, path)
+	return True
+
+def lower_priority():
+	os.nice(NICE)
+
+# pool: a process pool for background rewrites, its workers at low priority and already forked
+def pool(workers):
+	p = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"), initializer=lower_priority)
+	p.submit(os.getpid).result()		# a fork pool starts all its workers on the first job
+	return p
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# Background keypad sampler for the Wonderphone.
+# One thread owns the ADC: it samples the keypad channel at a fixed rate into a
+# fixed-size ring buffer and turns the samples into debounced press/release
+# events on a queue. Nothing else reads the ADC or sleeps waiting for a release.
+
+import threading, queue, time, logging
+from array import array
+from collections import namedtuple
+import tracing
+
+logger = logging.getLogger('logwonderphone')
+
+SAMPLE_INTERVAL 	= 0.005	# seconds between samples (200 Hz)
+RING_SIZE 			= 1024	# samples kept for inspection (~5 s at 200 Hz)
+PRESS_THRESHOLD 	= 390	# adc value above which a key is down (MIN_ADC_VAL_KEYPRESS_VAL)
+DEBOUNCE_SAMPLES 	= 3		# consecutive samples needed to accept a press or release
+MAX_DECISION_SAMPLES = 40	# give up on a press the key filter can't decide within this many samples
+EVENT_QUEUE_SIZE 	= 64
+
+# kind is "press" or "release"; value is the adc value the press was accepted on
+# key is the key the filter decided on (None when the sampler runs without a key filter)
+KeyEvent = namedtuple('KeyEvent', ['kind', 'value', 'time', 'key'], defaults=[None])
+
+class KeypadSampler:
+	# key_filter: optional keyfilter.KeyFilter; presses are then only reported once a
+	# burst of samples agrees on a key, with the value the filter settled on
+	def __init__(self, adc, channel=0, interval=SAMPLE_INTERVAL, ring_size=RING_SIZE,
+			threshold=PRESS_THRESHOLD, debounce=DEBOUNCE_SAMPLES, key_filter=None):
+		self.adc = adc
+		self.key_filter = key_filter
+		self.channel = channel
+		self.interval = interval
+		self.threshold = threshold
+		self.debounce = debounce
+		self.ring = array('H', bytes(2 * ring_size))
+		self.ring_size = ring_size
+		self.count = 0						# total samples taken; next write goes to count % ring_size
+		self.events = queue.Queue(EVENT_QUEUE_SIZE)
+		self.pressed = False
+		self.released = threading.Event()
+		self.released.set()
+		self.release_callbacks = []
+		self.lock = threading.Lock()
+		self.closed = threading.Event()
+		self.thread = threading.Thread(target=self._run, name="keypad-sampler", daemon=True)
+
+	def start(self):
+		self.thread.start()
+
+	def close(self):
+		self.closed.set()
+		if self.thread.is_alive():
+			self.thread.join()
+
+	# latest: the most recent sample
+	def latest(self):
+		if self.count == 0:
+			return 0
+		return self.ring[(self.count - 1) % self.ring_size]
+
+	# recent: the last n samples, oldest first
+	def recent(self, n):
+		n = min(n, self.count, self.ring_size)
+		end = self.count % self.ring_size
+		start = (end - n) % self.ring_size
+		if start < end or n == 0:
+			return self.ring[start:end]
+		return self.ring[start:] + self.ring[:end]
+
+	# clear: forget events nobody was listening for
+	def clear(self):
+		while True:
+			try:
+				self.events.get_nowait()
+			except queue.Empty:
+				return
+
+	# next_press: block until a key press event (at or after since, if given) or timeout; None on timeout
+	def next_press(self, timeout=None, since=None):
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while True:
+			remaining = None if deadline is None else max(0, deadline - time.monotonic())
+			try:
+				event = self.events.get(timeout=remaining)
+			except queue.Empty:
+				return None
+			if event.kind == "press" and (since is None or event.time >= since):
+				return event
+
+	# wait_release: block until no key is held down
+	def wait_release(self, timeout=None):
+		return self.released.wait(timeout)
+
+	# add_release_callback: call fn() once no key is held down, from the sampler thread (right away if none is)
+	def add_release_callback(self, fn):
+		with self.lock:
+			if not self.released.is_set():
+				self.release_callbacks.append(fn)
+				return
+		fn()
+
+	def _emit(self, kind, value, key=None):
+		event = KeyEvent(kind, value, time.monotonic(), key)
+		try:
+			self.events.put_nowait(event)
+		except queue.Full:
+			# Nobody is draining the queue; drop the oldest event rather than block sampling
+			try:
+				self.events.get_nowait()
+			except queue.Empty:
+				pass
+			self.events.put_nowait(event)
+
+	def _run(self):
+		read = tracing.wrap("adc.read", self.adc.read)
+		channel = self.channel
+		ring = self.ring
+		size = self.ring_size
+		streak = 0
+		deciding_since = None		# sample count when the current press was debounced, until it is decided
+		next_time = time.monotonic()
+		while not self.closed.is_set():
+			value = read(channel)
+			ring[self.count % size] = max(value, 0)
+			self.count += 1
+
+			# Count consecutive samples that disagree with the current state
+			down = value > self.threshold
+			if down != self.pressed:
+				streak += 1
+				if streak >= self.debounce:
+					self.pressed = down
+					streak = 0
+					if down:
+						with self.lock:
+							self.released.clear()
+						deciding_since = self.count
+					else:
+						with self.lock:
+							self.released.set()
+							callbacks, self.release_callbacks = self.release_callbacks, []
+						for fn in callbacks:
+							fn()
+						deciding_since = None
+						self._emit("release", value)
+			else:
+				streak = 0
+
+			if deciding_since is not None:
+				if self.key_filter is None:
+					self._emit("press", value)
+					deciding_since = None
+				else:
+					decision = self.key_filter.decide(self.recent(self.key_filter.window))
+					if decision is not None:
+						self._emit("press", decision[1], decision[0])
+						deciding_since = None
+					elif self.count - deciding_since > MAX_DECISION_SAMPLES:
+						logger.debug("keypad sampler: dropped undecided press, last samples %s", list(self.recent(8)))
+						deciding_since = None
+
+			next_time += self.interval
+			delay = next_time - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+			else:
+				next_time = time.monotonic()
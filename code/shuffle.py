@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# No-repeat random picks from a recordings index, for the Wonderphone's
+# "personal responses" (payphone.py, key 8).
+# A shuffle bag holds the recordings not yet played this round. A pick swaps a
+# random entry with the last one and pops it, so it is O(1) and nothing repeats
+# until every recording has been heard; then the bag refills from the index.
+# The bag follows the index as recordings come and go, so it never rescans the
+# directory itself.
+# With recency_weight > 0, a pick draws two candidates and prefers the newer one
+# (with probability 0.5 + recency_weight / 2), which favours fresh recordings while
+# staying O(1).
+#
+# Benchmark against the old listdir + randrange:  python3 shuffle.py bench [--sizes 10,1000,50000] [-n PICKS]
+
+import os, sys, random, threading, argparse, tempfile, shutil, time
+from os.path import isfile, join
+import recordings
+
+LISTDIR_PICKS = 200
+
+class ShuffleBag:
+	def __init__(self, index, recency_weight=0.0, rng=None):
+		self.index = index
+		self.recency_weight = recency_weight
+		self.rng = rng or random.Random()
+		self.bag = []				# names still to be played this round
+		self.slots = {}				# name -> position in bag
+		self.played = set()			# names already picked this round
+		self.stale = True			# rebuild from the index on the next pick
+		self.rounds = 0
+		self.lock = threading.Lock()
+		index.listeners.append(self._changed)
+
+	def __len__(self):
+		return len(self.bag)
+
+	# pick: a recording name that hasn't been played this round, or None if there are none
+	def pick(self):
+		with self.lock:
+			if not self.bag:
+				self._refill()
+			elif self.stale:
+				self._rebuild()
+			bag = self.bag
+			if not bag:
+				return None
+			i = self.rng.randrange(len(bag))
+			if self.recency_weight > 0 and len(bag) > 1:
+				j = self.rng.randrange(len(bag))
+				newer, older = (i, j) if bag[i] > bag[j] else (j, i)
+				i = newer if self.rng.random() < 0.5 + self.recency_weight / 2 else older
+			name = bag[i]
+			self._remove_at(i)
+			self.played.add(name)
+			return name
+
+	# _refill: start a new round with every recording in the index
+	def _refill(self):
+		self.played = set()
+		self._rebuild()
+		self.rounds += 1
+
+	# _rebuild: the index was rescanned; keep the current round, minus what has been played
+	def _rebuild(self):
+		played = self.played
+		self.bag = [name for name in self.index.names if name not in played]
+		self.slots = dict((name, i) for i, name in enumerate(self.bag))
+		self.stale = False
+
+	def _remove_at(self, i):
+		bag = self.bag
+		del self.slots[bag[i]]
+		last = bag.pop()
+		if i < len(bag):
+			bag[i] = last
+			self.slots[last] = i
+
+	# _changed: index listener; new recordings join the current round, deleted ones leave it
+	def _changed(self, kind, name):
+		with self.lock:
+			if kind == "add" and name not in self.slots and not self.stale:
+				self.slots[name] = len(self.bag)
+				self.bag.append(name)
+			elif kind == "discard" and name in self.slots:
+				self._remove_at(self.slots[name])
+			elif kind == "rescan":
+				self.stale = True
+
+#------------------------------------------ BENCHMARK ------------------------------------------
+
+# old_find_file: the original find_file() from payphone.py, for comparison
+def old_find_file(path):
+	files = [f for f in os.listdir(path) if isfile(join(path, f))]
+	return path + "/" + files[random.randrange(len(files))]
+
+def bench(size, picks, recency_weight=0.0):
+	directory = tempfile.mkdtemp(prefix="wonderphone-shuffle-")
+	try:
+		for i in range(size):
+			open(join(directory, "%08d.wav" % i), "w").close()
+		results = {}
+		n = min(picks, LISTDIR_PICKS)	# a directory scan per pick; a few hundred are plenty to time
+		start = time.perf_counter()
+		for i in range(n):
+			old_find_file(directory)
+		results["listdir"] = (time.perf_counter() - start) / n
+
+		index = recordings.RecordingsIndex(directory)
+		bag = ShuffleBag(index, recency_weight)
+		start = time.perf_counter()
+		for i in range(picks):
+			bag.pick()
+		results["bag"] = (time.perf_counter() - start) / picks
+		results["rounds"] = bag.rounds
+		return results
+	finally:
+		shutil.rmtree(directory)
+
+def main():
+	parser = argparse.ArgumentParser(description="Wonderphone shuffle bag tools")
+	sub = parser.add_subparsers(dest="command")
+	b = sub.add_parser("bench", help="compare pick latency with the old listdir + randrange")
+	b.add_argument("--sizes", default="10,1000,50000")
+	b.add_argument("-n", "--picks", type=int, default=10000)
+	b.add_argument("--recency", type=float, default=0.0, help="recency weight (0..1)")
+	args = parser.parse_args()
+	if args.command != "bench":
+		parser.print_help()
+		return 1
+
+	print("%10s %14s %14s %8s" % ("recordings", "listdir us", "bag us", "rounds"))
+	for size in [int(s) for s in args.sizes.split(",")]:
+		r = bench(size, args.picks, args.recency)
+		print("%10d %14.1f %14.2f %8d" % (size, 1e6 * r["listdir"], 1e6 * r["bag"], r["rounds"]))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+
+# Hardware-free simulator for the Wonderphone.
+# With WONDERPHONE_SIM=trace.json set, the phone scripts take their GPIO module, ADC,
+# sound output and microphone from here instead of RPi.GPIO, the MCP3008 and ALSA.
+# Everything simulated runs on a virtual clock SPEED times faster than real time:
+# prompts "play" and takes "record" at that pace, and the trace, a scripted session
+# of hook edges and keypresses, is replayed against the same clock. The replay runs
+# inside GPIO.wait_for_edge(EXIT), where the scripts sit once they are set up, and
+# returns when the trace ends, so the script shuts down as if the exit button was hit.
+#
+# A trace is a JSON list of events, or {"speed": 20, "voice": "in.wav", "events": [...]}
+# ("voice" is what the microphone hears, looped silence without it). Each event has
+# "at", virtual seconds from the start of the replay, and one of
+#   {"hook": "off"} / {"hook": "on"}	pick the handset up / hang it up
+#   {"key": "1", "hold": 0.15}			press a key (adc value from the keypad calibration)
+#   {"adc": 512, "hold": 0.15}			press with a raw adc value
+#   {"end": true}						keep going until "at", then stop
+# Key holds are never shorter than MIN_HOLD real seconds: the keypad sampler and the
+# debounce in the scripts run on real time. So do their short timeouts, which makes
+# a session a little longer in virtual time than on the device; leave some slack
+# between events rather than timing them to the millisecond.
+#
+#   python3 sim.py content DIR [--seconds 3] [--story-seconds 20]
+#   python3 sim.py run {katies,payphone} TRACE [--speed 20] [--content DIR]
+# "content" writes a placeholder content tree (silent prompts and stories, empty
+# recording folders) for WONDERPHONE_ROOT; "run" replays a trace against one of the
+# scripts, in a temporary content tree unless one is given, and fails if the script
+# does or if anything was logged at ERROR. traces/ has a visitor session for each phone.
+# With WONDERPHONE_SIM_TIMELINE=path the replay also writes a timeline (JSON lines of
+# [real time, what, details...]) of stimuli, menu transitions, prompts starting (with
+# when they were asked for) and stopping and recordings saved, which latency.py measures.
+
+import os, sys, json, time, wave, queue, shutil, argparse, tempfile, threading, subprocess, logging
+import audio, adc, keypad, recorder, menus
+
+logger = logging.getLogger('logwonderphone')
+
+SPEED 		= 20.0		# virtual seconds per real second
+HOLD 		= 0.15		# virtual seconds a key is held down if the trace doesn't say
+MIN_HOLD 	= 0.08		# real seconds: long enough for the sampler to debounce and decide a press
+PINS 		= {"pressed": 20, "hook": 8, "exit": 21}	# the Wonderphone's wiring (see payphone.py)
+SCRIPTS 	= {"katies": "katies_payphone.py", "payphone": "payphone.py"}
+
+# prompts katies_payphone.py plays itself rather than through the menu table
+SCRIPT_PROMPTS = ["greetings_message.wav", "message_discarded.wav", "no_messages.wav", "playback_introduction.wav",
+	"last_message.wav", "playback_last_message_instructions.wav", "playback_instructions.wav",
+	"no_messages_left.wav", "next_message.wav", "something_went_wrong.wav"]
+RECORDING_DIRS = ["katies_recordings", "recordings/en", "recordings/es"]
+
+class VirtualClock:
+	def __init__(self, speed=SPEED):
+		self.speed = speed
+		self.origin = time.monotonic()
+
+	# now: virtual seconds since the clock was made
+	def now(self):
+		return (time.monotonic() - self.origin) * self.speed
+
+	def sleep(self, seconds):
+		if seconds > 0:
+			time.sleep(seconds / self.speed)
+
+	def sleep_until(self, t):
+		self.sleep(t - self.now())
+
+# SimGPIO: the parts of RPi.GPIO the phone scripts use. Edge callbacks run on one
+# thread, in order, as RPi.GPIO runs them; bouncetime is measured on the virtual clock.
+class SimGPIO:
+	BCM = 11
+	BOARD = 10
+	IN = 1
+	OUT = 0
+	HIGH = 1
+	LOW = 0
+	PUD_OFF = 20
+	PUD_DOWN = 21
+	PUD_UP = 22
+	RISING = 31
+	FALLING = 32
+	BOTH = 33
+
+	def __init__(self, clock, on_wait=None):
+		self.clock = clock
+		self.on_wait = on_wait			# called with the pin from wait_for_edge
+		self.levels = {}
+		self.detect = {}				# pin -> [edge, callback, bouncetime, virtual time of the last edge]
+		self.lock = threading.Lock()
+		self.callbacks = queue.Queue()
+		self.thread = threading.Thread(target=self._run, name="sim-gpio", daemon=True)
+		self.thread.start()
+
+	def setmode(self, mode):
+		pass
+
+	def setwarnings(self, flag):
+		pass
+
+	def setup(self, pin, direction, pull_up_down=PUD_OFF, initial=None):
+		if initial is not None:
+			self.levels[pin] = initial
+		else:
+			self.levels.setdefault(pin, 1 if pull_up_down == self.PUD_UP else 0)
+
+	def input(self, pin):
+		return self.levels.get(pin, 0)
+
+	def output(self, pin, value):
+		self.levels[pin] = 1 if value else 0
+
+	def add_event_detect(self, pin, edge, callback=None, bouncetime=0):
+		with self.lock:
+			self.detect[pin] = [edge, callback, bouncetime / 1000.0, None]
+
+	def remove_event_detect(self, pin):
+		with self.lock:
+			self.detect.pop(pin, None)
+
+	def wait_for_edge(self, pin, edge, bouncetime=None, timeout=None):
+		if self.on_wait is not None:
+			self.on_wait(pin)
+		return pin
+
+	def cleanup(self, *pins):
+		pass
+
+	# set_level: drive a pin from the simulator, firing its edge callback like a real edge would
+	def set_level(self, pin, level):
+		with self.lock:
+			old = self.levels.get(pin, 0)
+			self.levels[pin] = level
+			detect = self.detect.get(pin)
+			if detect is None or old == level:
+				return
+			edge, callback, bounce, last = detect
+			if edge != self.BOTH and edge != (self.RISING if level else self.FALLING):
+				return
+			now = self.clock.now()
+			if last is not None and now - last < bounce:
+				return
+			detect[3] = now
+		if callback is not None:
+			self.callbacks.put((callback, pin))
+
+	def _run(self):
+		while True:
+			callback, pin = self.callbacks.get()
+			try:
+				callback(pin)
+			except Exception:
+				logger.exception("sim: callback for pin %d failed", pin)
+
+# SimSink: swallows audio at the virtual clock's pace and counts what was played;
+# mark is told when playback is cut off (prompts starting come from the engine, see attach)
+class SimSink(audio.NullSink):
+	def __init__(self, clock, rate=audio.RATE, channels=audio.CHANNELS, mark=None):
+		audio.NullSink.__init__(self, rate, channels, realtime=False)
+		self.clock = clock
+		self.mark = mark
+		self.next_time = None
+		self.write_started = None		# real time the last write began, i.e. when its first sample was "heard"
+
+	def write(self, data):
+		self.write_started = time.monotonic()
+		audio.NullSink.write(self, data)
+		now = self.clock.now()
+		if self.next_time is None or self.next_time < now:
+			self.next_time = now		# the device was idle; start from here
+		self.next_time += len(data) / float(self.channels * audio.SAMPLE_WIDTH * self.rate)
+		self.clock.sleep_until(self.next_time)
+
+	def drop(self):
+		self.next_time = None
+		if self.mark is not None:
+			self.mark("audio", "stop")
+
+	def seconds(self):
+		return self.frames_written / float(self.rate)
+
+# SimSource: the microphone; a voice file (then silence) or just silence, at the virtual clock's pace
+class SimSource(recorder.FileSource):
+	def __init__(self, clock, voice=None, rate=audio.RATE, channels=audio.CHANNELS):
+		recorder.FileSource.__init__(self, voice, rate, channels, realtime=False)
+		self.clock = clock
+		self.frames_read = 0
+
+	def start(self):
+		recorder.FileSource.start(self)
+		self.next_time = self.clock.now()
+
+	def read(self):
+		data = recorder.FileSource.read(self)
+		frames = len(data) // (self.channels * audio.SAMPLE_WIDTH)
+		self.frames_read += frames
+		self.next_time += frames / float(self.rate)
+		self.clock.sleep_until(self.next_time)
+		return data
+
+	def seconds(self):
+		return self.frames_read / float(self.rate)
+
+class Simulator:
+	# timeline_path: where to write the timeline once the trace has been replayed
+	def __init__(self, events, speed=SPEED, voice=None, pins=PINS, timeline_path=None):
+		self.events = sorted(events, key=lambda e: e["at"])
+		self.voice = voice
+		self.pins = pins
+		self.timeline_path = timeline_path
+		self.timeline = []
+		self.clock = VirtualClock(speed)
+		self.gpio = SimGPIO(self.clock, on_wait=self._wait)
+		self.adc_value = 0
+		self.adc = adc.SimulatedAdc(lambda channel: self.adc_value if channel == 0 else 0)
+		self.sink = SimSink(self.clock, mark=self.mark)
+		self.sources = []
+		self.keys = keypad.load()
+		self.replayed = None
+
+	@property
+	def speed(self):
+		return self.clock.speed
+
+	# source: a simulated microphone in the capture format the script asks for
+	def source(self, rate=audio.RATE, channels=audio.CHANNELS):
+		s = SimSource(self.clock, self.voice, rate, channels)
+		self.sources.append(s)
+		return s
+
+	# attach: put the script's menu moves, saved recordings and prompts starting on the timeline.
+	# A start is marked per playback handle, at the write of its first period and with the
+	# time the handle was made, so a prompt queued behind another one starts when it is heard.
+	def attach(self, menu, recordings=(), engine=None):
+		names = menu.names
+		if engine is not None:
+			engine.on_start = lambda handle: self.timeline.append((self.sink.write_started, "audio", "start", handle.name, handle.created))
+		menu.listeners.append(lambda state, event, t: self.mark("transition", names[state], event, names[t.target], t.label))
+		for index in recordings:
+			index.listeners.append(lambda kind, name: self.mark("saved", name) if kind == "add" else None)
+
+	# mark: note something on the timeline, in real (monotonic) time
+	def mark(self, what, *details):
+		self.timeline.append((time.monotonic(), what) + details)
+
+	# key_value: an adc value in the middle of a key's calibrated band
+	def key_value(self, key):
+		if self.keys.bands and key in self.keys.bands:
+			low, high = self.keys.bands[key]
+			return (max(low, self.keys.threshold + 1) + high) // 2
+		for code in range(len(self.keys.table)):
+			if self.keys.table[code] == key:
+				return code
+		raise ValueError("sim: no adc value decodes to key %r" % key)
+
+	# replay: run the trace against the virtual clock; returns the summary
+	def replay(self):
+		origin = self.clock.now()
+		start = time.monotonic()
+		for event in self.events:
+			self.clock.sleep_until(origin + event["at"])
+			self._apply(event)
+		real = time.monotonic() - start
+		virtual = self.clock.now() - origin
+		self.replayed = {"events": len(self.events), "virtual_seconds": round(virtual, 1), "real_seconds": round(real, 2),
+			"speedup": round(virtual / real, 1) if real else None, "played_seconds": round(self.sink.seconds(), 1),
+			"recorded_seconds": round(sum(s.seconds() for s in self.sources), 1)}
+		return self.replayed
+
+	def press(self, value, hold=HOLD, key=None):
+		self.adc_value = value
+		self.mark("key", key if key is not None else self.keys.decode(value))
+		self.gpio.set_level(self.pins["pressed"], 1)
+		time.sleep(max(hold / self.speed, MIN_HOLD))
+		self.adc_value = 0
+		self.gpio.set_level(self.pins["pressed"], 0)
+
+	def _apply(self, event):
+		logger.debug("sim: %.2f %s", event["at"], event)
+		if "hook" in event:
+			self.mark("hook", event["hook"])
+			self.gpio.set_level(self.pins["hook"], 1 if event["hook"] == "off" else 0)
+		elif "key" in event:
+			self.press(self.key_value(event["key"]), event.get("hold", HOLD), event["key"])
+		elif "adc" in event:
+			self.press(event["adc"], event.get("hold", HOLD))
+
+	# _wait: GPIO.wait_for_edge; the script is set up and waiting for the exit button, so replay now
+	def _wait(self, pin):
+		if pin != self.pins["exit"] or self.replayed is not None:
+			return
+		r = self.replay()
+		print("sim: %(events)d events, %(virtual_seconds).1f virtual s in %(real_seconds).2f s (%(speedup)sx), "
+			"played %(played_seconds).1f s, recorded %(recorded_seconds).1f s" % r)
+		logger.debug("sim: " + str(r))
+		if self.timeline_path:
+			with open(self.timeline_path, "w") as f:
+				for entry in self.timeline:
+					f.write(json.dumps(entry) + "\n")
+
+# load_trace: (events, options) from a trace file, checking every event
+def load_trace(path):
+	with open(path) as f:
+		data = json.load(f)
+	options = {}
+	if isinstance(data, dict):
+		options = dict((k, v) for k, v in data.items() if k != "events")
+		data = data.get("events", [])
+	for i, event in enumerate(data):
+		if not isinstance(event.get("at"), (int, float)):
+			raise ValueError("sim: event %d of %s has no \"at\" time" % (i, path))
+		if not any(k in event for k in ("hook", "key", "adc", "end")):
+			raise ValueError("sim: event %d of %s is not a hook, key, adc or end event" % (i, path))
+		if event.get("hook", "off") not in ("off", "on"):
+			raise ValueError("sim: event %d of %s: hook must be \"off\" or \"on\"" % (i, path))
+	if options.get("voice"):
+		options["voice"] = os.path.join(os.path.dirname(os.path.abspath(path)), options["voice"])
+	return data, options
+
+# from_environment: the simulator the phone scripts should use, or None to use the hardware
+def from_environment():
+	path = os.environ.get("WONDERPHONE_SIM")
+	if not path:
+		return None
+	events, options = load_trace(path)
+	speed = float(os.environ.get("WONDERPHONE_SIM_SPEED") or options.get("speed") or SPEED)
+	return Simulator(events, speed, options.get("voice"), timeline_path=os.environ.get("WONDERPHONE_SIM_TIMELINE"))
+
+#------------------------------------------ CONTENT ------------------------------------------
+
+def write_silence(path, seconds, rate=audio.RATE, channels=audio.CHANNELS):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	w = wave.open(path, "wb")
+	w.setnchannels(channels)
+	w.setsampwidth(audio.SAMPLE_WIDTH)
+	w.setframerate(rate)
+	w.writeframes(bytes(int(rate * seconds) * channels * audio.SAMPLE_WIDTH))
+	w.close()
+
+# make_content: placeholder prompts and stories for every file the phones play, under root
+def make_content(root, seconds=3.0, story_seconds=20.0):
+	root = os.path.join(os.path.abspath(root), "")
+	paths = set(menus.KATIES + name for name in SCRIPT_PROMPTS)
+	for definition in menus.MENUS.values():
+		specs = list(definition.get("events", {}).values())
+		for keys in definition["states"].values():
+			specs.extend(keys.values())
+		for spec in specs:
+			for step in spec.get("do", ()):
+				if step[0] == "play":
+					paths.update(step[1:])
+	written = 0
+	for path in sorted(paths):
+		if not path.startswith(menus.ROOT):
+			continue
+		target = os.path.join(root, path[len(menus.ROOT):])
+		if not os.path.exists(target):
+			write_silence(target, story_seconds if path.startswith(menus.STORIES) else seconds)
+			written += 1
+	for d in RECORDING_DIRS:
+		os.makedirs(os.path.join(root, d), exist_ok=True)
+	return written
+
+#------------------------------------------ RUN ------------------------------------------
+
+# run: replay a trace against a phone script in a child process; returns (returncode, error lines)
+def run(script, trace, content, speed=None, timeline=None, quiet=False):
+	log = os.path.join(content, "wonderphone.log")
+	env = dict(os.environ, WONDERPHONE_SIM=os.path.abspath(trace), WONDERPHONE_ROOT=content, WONDERPHONE_LOG=log,
+		WONDERPHONE_USAGE=os.path.join(content, "usage"))
+	if speed is not None:
+		env["WONDERPHONE_SIM_SPEED"] = str(speed)
+	if timeline is not None:
+		env["WONDERPHONE_SIM_TIMELINE"] = os.path.abspath(timeline)
+	here = os.path.dirname(os.path.abspath(__file__))
+	returncode = subprocess.call([sys.executable, os.path.join(here, SCRIPTS[script])], env=env, cwd=here,
+		stdout=subprocess.DEVNULL if quiet else None)
+	errors = []
+	if os.path.exists(log):
+		with open(log) as f:
+			errors = [line.rstrip() for line in f if " ERROR " in line or " CRITICAL " in line]
+	return returncode, errors
+
+def main():
+	parser = argparse.ArgumentParser(description="Run the Wonderphone without its hardware")
+	sub = parser.add_subparsers(dest="command")
+	c = sub.add_parser("content", help="write a placeholder content tree")
+	c.add_argument("root")
+	c.add_argument("--seconds", type=float, default=3.0, help="length of each prompt")
+	c.add_argument("--story-seconds", type=float, default=20.0)
+	r = sub.add_parser("run", help="replay a trace against a phone script")
+	r.add_argument("script", choices=sorted(SCRIPTS))
+	r.add_argument("trace")
+	r.add_argument("--speed", type=float)
+	r.add_argument("--content", help="content tree to use (default: a temporary placeholder tree)")
+	args = parser.parse_args()
+
+	if args.command == "content":
+		print("%d files written" % make_content(args.root, args.seconds, args.story_seconds))
+		return 0
+	if args.command == "run":
+		content = args.content or tempfile.mkdtemp(prefix="wonderphone-sim-")
+		try:
+			if not args.content:
+				make_content(content)
+			returncode, errors = run(args.script, args.trace, os.path.abspath(content), args.speed)
+		finally:
+			if not args.content:
+				shutil.rmtree(content, ignore_errors=True)
+		for line in errors:
+			print(line)
+		if returncode != 0 or errors:
+			print("FAILED: exit status %d, %d errors logged" % (returncode, len(errors)))
+			return 1
+		print("ok")
+		return 0
+	parser.print_help()
+	return 1
+
+if __name__ == "__main__":
+	sys.exit(main())
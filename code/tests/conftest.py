@@ -0,0 +1,5 @@
+# The phone modules are flat files in code/; make them importable from the tests.
+
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
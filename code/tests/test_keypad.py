@@ -0,0 +1,54 @@
+import json
+import pytest
+import keypad
+
+BANDS = {"1": (900, 1023), "2": (700, 749), "3": (500, 549)}
+
+def test_bands_decode_to_their_keys():
+	table = keypad.KeyTable(keypad.build_table(BANDS, threshold=400))
+	assert table.decode(1023) == "1"
+	assert table.decode(725) == "2"
+	assert table.decode(500) == "3"
+
+def test_noise_and_out_of_range_decode_to_nothing():
+	table = keypad.KeyTable(keypad.build_table(BANDS, threshold=400))
+	assert table.decode(0) is None
+	assert table.decode(400) is None
+	assert table.decode(-1) is None
+	assert table.decode(keypad.ADC_CODES) is None
+
+def test_gaps_go_to_the_nearest_band():
+	table = keypad.build_table(BANDS, threshold=400)
+	assert table[401] == "3"		# below the lowest band, above the threshold
+	assert table[560] == "3"
+	assert table[690] == "2"
+	assert table[760] == "2"
+	assert table[890] == "1"
+	assert None not in table[401:]
+
+def test_gaps_stay_empty_without_filling():
+	table = keypad.build_table(BANDS, threshold=400, fill_gaps=False)
+	assert table[600] is None and table[401] is None
+	assert table[725] == "2"
+
+def test_default_bands_cover_every_key():
+	table = keypad.build_table(keypad.DEFAULT_BANDS)
+	assert set(table[keypad.DEFAULT_THRESHOLD + 1:]) == set(keypad.KEYS)
+
+def test_save_and_load_round_trip(tmp_path):
+	path = str(tmp_path / "calibration.json")
+	keypad.save(path, BANDS, threshold=400)
+	table = keypad.load(path)
+	assert table.threshold == 400 and table.bands == BANDS
+	assert table.decode(560) == "3"
+
+def test_load_falls_back_to_the_default_bands(tmp_path):
+	table = keypad.load(str(tmp_path / "missing.json"))
+	assert table.bands == keypad.DEFAULT_BANDS
+
+def test_load_rejects_a_short_table(tmp_path):
+	path = str(tmp_path / "calibration.json")
+	with open(path, "w") as f:
+		json.dump({"bands": {"1": [900, 1023]}, "table": ["1"] * 10}, f)
+	with pytest.raises(ValueError):
+		keypad.load(path)
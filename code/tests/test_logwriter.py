@@ -0,0 +1,81 @@
+import os, threading, logging
+import logwriter
+
+def make_logger(handler):
+	handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+	logger = logging.getLogger("logwriter-test-%d" % id(handler))
+	logger.propagate = False
+	logger.setLevel(logging.DEBUG)
+	logger.addHandler(handler)
+	return logger
+
+def read_lines(path):
+	with open(path) as f:
+		return f.read().splitlines()
+
+def rotated(path):
+	directory, base = os.path.split(path)
+	return sorted(name for name in os.listdir(directory) if name.startswith(base + "."))
+
+def test_lines_are_written_in_order(tmp_path):
+	path = str(tmp_path / "wonderphone.log")
+	handler = logwriter.BatchedFileHandler(path)
+	logger = make_logger(handler)
+	for i in range(300):
+		logger.debug("line %d", i)
+	handler.flush()
+	assert read_lines(path) == ["DEBUG line %d" % i for i in range(300)]
+	handler.close()
+	assert handler.stats()["written"] == 300 and handler.stats()["dropped"] == 0
+
+def test_a_full_queue_drops_debug_first_and_says_so(tmp_path, monkeypatch):
+	gate = threading.Event()
+	run = logwriter.BatchedFileHandler._run
+	monkeypatch.setattr(logwriter.BatchedFileHandler, "_run", lambda self: (gate.wait(), run(self)))
+	path = str(tmp_path / "wonderphone.log")
+	handler = logwriter.BatchedFileHandler(path, queue_size=10)
+	logger = make_logger(handler)
+	for i in range(20):
+		logger.debug("debug %d", i)		# only the first 8 fit under LOW_PRIORITY_FILL
+	for i in range(3):
+		logger.warning("warning %d", i)	# the queue has room for two more
+	assert handler.dropped == 13 and handler.dropped_high == 1
+	gate.set()
+	handler.close()
+	# a warning ends its batch, and the note on what was dropped follows that batch
+	assert read_lines(path) == ["DEBUG debug %d" % i for i in range(8)] + ["WARNING warning 0",
+		"WARNING logwriter: dropped 13 lines while the writer was behind", "WARNING warning 1"]
+
+def test_rotates_past_max_bytes_and_keeps_under_the_disk_cap(tmp_path):
+	path = str(tmp_path / "wonderphone.log")
+	handler = logwriter.BatchedFileHandler(path, max_bytes=100, disk_cap=400)
+	logger = make_logger(handler)
+	for i in range(8):
+		logger.info("%03d %s", i, "x" * 110)		# each batch fills the file past max_bytes
+		handler.flush()
+	handler.close()
+	assert handler.rotations == 7
+	assert read_lines(path) == ["INFO 007 " + "x" * 110]
+	# 2 * ~120 bytes and room for the live file fit in 400; the oldest rotations are gone
+	kept = sorted(read_lines(os.path.join(str(tmp_path), name))[0][:8] for name in rotated(path))
+	assert kept == ["INFO 005", "INFO 006"]
+
+def test_a_big_log_from_a_previous_run_is_rotated_on_open(tmp_path):
+	path = str(tmp_path / "wonderphone.log")
+	with open(path, "w") as f:
+		f.write("old\n" * 50)
+	handler = logwriter.BatchedFileHandler(path, max_bytes=100)
+	logger = make_logger(handler)
+	logger.info("new")
+	handler.close()
+	assert read_lines(path) == ["INFO new"]
+	assert len(rotated(path)) == 1
+
+def test_nothing_is_queued_after_close(tmp_path):
+	path = str(tmp_path / "wonderphone.log")
+	handler = logwriter.BatchedFileHandler(path)
+	logger = make_logger(handler)
+	logger.info("before")
+	handler.close()
+	logger.info("after")
+	assert read_lines(path) == ["INFO before"]
@@ -0,0 +1,86 @@
+import json, os, wave
+import manifest
+
+def write_wav(path, frames=1600):
+	with wave.open(path, "wb") as w:
+		w.setnchannels(1)
+		w.setsampwidth(2)
+		w.setframerate(16000)
+		w.writeframes(bytes(2 * frames))
+
+def make_manifest(tmp_path, names):
+	directory = tmp_path / "en"
+	directory.mkdir()
+	for name in names:
+		write_wav(str(directory / name))
+	return manifest.Manifest(str(directory)).load()
+
+def test_entries_are_probed(tmp_path):
+	m = make_manifest(tmp_path, ["a.wav"])
+	m.add("a.wav")
+	entry = m.get("a.wav")
+	assert entry["duration"] == 0.1 and entry["format"] == "16000/1/16" and entry["lang"] == "en"
+	assert entry["seq"] == 1 and not entry["deleted"]
+
+def test_last_line_wins_on_load(tmp_path):
+	m = make_manifest(tmp_path, ["a.wav", "b.wav"])
+	m.add("a.wav")
+	m.add("b.wav")
+	m.flag("a.wav", empty=True)
+	m.mark_deleted("b.wav")
+	m.close()
+	again = manifest.Manifest(m.directory).load()
+	assert again.names() == ["a.wav"]
+	assert again.get("a.wav")["empty"] is True
+	assert again.get("b.wav")["deleted"] is True
+	assert again.seq == 2
+
+def test_torn_last_line_is_skipped(tmp_path):
+	m = make_manifest(tmp_path, ["a.wav", "b.wav"])
+	m.add("a.wav")
+	m.add("b.wav")
+	m.close()
+	with open(m.path) as f:
+		text = f.read()
+	with open(m.path, "w") as f:
+		f.write(text[:-20])		# power cut in the middle of the last append
+	again = manifest.Manifest(m.directory).load()
+	assert again.skipped == 1
+	assert again.names() == ["a.wav"]
+
+def test_append_after_a_torn_line_survives(tmp_path):
+	m = make_manifest(tmp_path, ["a.wav", "b.wav", "c.wav"])
+	m.add("a.wav")
+	m.add("b.wav")
+	m.close()
+	with open(m.path) as f:
+		text = f.read()
+	with open(m.path, "w") as f:
+		f.write(text[:-20])
+	again = manifest.Manifest(m.directory).load()
+	again.add("c.wav")
+	again.close()
+	last = manifest.Manifest(m.directory).load()
+	assert last.names() == ["a.wav", "c.wav"]
+
+def test_sync_appends_new_and_deleted_in_one_batch(tmp_path):
+	m = make_manifest(tmp_path, ["a.wav", "b.wav"])
+	m.add("a.wav")
+	assert m.sync(["b.wav"])
+	assert m.names() == ["b.wav"]
+	assert m.get("a.wav")["deleted"]
+	assert not m.sync(["b.wav"])
+	m.close()
+	with open(m.path) as f:
+		lines = [json.loads(line) for line in f]
+	assert [(e["name"], e["deleted"]) for e in lines] == [("a.wav", False), ("b.wav", False), ("a.wav", True)]
+
+def test_compaction_keeps_one_line_per_name(tmp_path, monkeypatch):
+	monkeypatch.setattr(manifest, "MIN_COMPACT_LINES", 4)
+	m = make_manifest(tmp_path, ["a.wav"])
+	for i in range(10):
+		m.update("a.wav")
+	m.close()
+	with open(m.path) as f:
+		assert len(f.readlines()) <= 4
+	assert manifest.Manifest(m.directory).load().names() == ["a.wav"]
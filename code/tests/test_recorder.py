@@ -0,0 +1,100 @@
+import os, wave
+import recorder
+
+RATE = 16000
+
+def make_recorder(tmp_path, staging=False):
+	saved = []
+	source = recorder.FileSource(None, rate=RATE, channels=1, realtime=False)
+	staging_dir = str(tmp_path / "staging") if staging else None
+	r = recorder.Recorder(source, rate=RATE, channels=1, staging_dir=staging_dir, on_saved=saved.append)
+	return r, saved
+
+def frames(path):
+	with wave.open(path, "rb") as w:
+		return w.getnframes()
+
+def test_save_writes_a_complete_wav(tmp_path):
+	r, saved = make_recorder(tmp_path)
+	path = str(tmp_path / "take.wav")
+	take = r.record(path, max_seconds=0.25)
+	assert take.wait(5) == 0
+	take.save()
+	r.close()
+	assert saved == [path]
+	assert frames(path) == RATE // 4
+	assert not os.path.exists(path + recorder.TEMP_SUFFIX)
+
+def test_stop_returns_without_waiting_and_save_lands_once_done(tmp_path):
+	r, saved = make_recorder(tmp_path)
+	path = str(tmp_path / "take.wav")
+	take = r.record(path)
+	take.stop()
+	take.save()
+	assert take.wait(5) == 0
+	r.close()
+	assert saved == [path] and os.path.exists(path)
+
+def test_discard_leaves_nothing_behind(tmp_path):
+	r, saved = make_recorder(tmp_path)
+	path = str(tmp_path / "take.wav")
+	take = r.record(path, max_seconds=0.1)
+	assert take.discard()
+	assert not take.discard()
+	take.wait(5)
+	take.save()				# too late: it was discarded
+	r.close()
+	assert saved == []
+	assert os.listdir(str(tmp_path)) == []
+
+def test_save_never_overwrites_a_recording(tmp_path):
+	r, saved = make_recorder(tmp_path)
+	path = str(tmp_path / "take.wav")
+	for n in range(2):
+		take = r.record(path, max_seconds=0.1)
+		take.wait(5)
+		take.save()
+	r.close()
+	assert saved == [path, str(tmp_path / "take-1.wav")]
+
+def test_staged_take_is_flushed_to_its_destination(tmp_path):
+	r, saved = make_recorder(tmp_path, staging=True)
+	path = str(tmp_path / "take.wav")
+	take = r.record(path, max_seconds=0.25)
+	take.wait(5)
+	assert take.playable_path().startswith(r.staging_dir)
+	take.save()
+	r.close()		# the writer finishes everything queued first
+	assert saved == [path]
+	assert take.flushed and take.playable_path() == path
+	assert frames(path) == RATE // 4
+	assert os.listdir(r.staging_dir) == []
+	assert r.stats()["flushed"] == 1 and r.stats()["pending"] == 0
+
+def test_queued_take_is_flushed_after_a_restart(tmp_path):
+	staging = tmp_path / "staging"
+	staging.mkdir()
+	destination = str(tmp_path / "take.wav")
+	queued = str(staging / ("take.wav" + recorder.QUEUED_SUFFIX))
+	with open(queued, "wb") as f:
+		f.write(recorder.wav_header(1, RATE, 2, 4) + bytes(4))
+	with open(queued + recorder.DEST_SUFFIX, "w") as f:
+		f.write(destination)
+	with open(str(staging / ("unsaved.wav" + recorder.TEMP_SUFFIX)), "wb") as f:
+		f.write(recorder.wav_header(1, RATE, 2))
+	r, saved = make_recorder(tmp_path, staging=True)
+	r.close()
+	assert saved == [destination]
+	assert frames(destination) == 2
+	assert os.listdir(str(staging)) == []
+
+def test_a_new_take_stops_the_one_still_running(tmp_path):
+	r, saved = make_recorder(tmp_path)
+	first = r.record(str(tmp_path / "1.wav"))
+	second = r.record(str(tmp_path / "2.wav"), max_seconds=0.1)
+	assert first.wait(5) == 0
+	assert second.wait(5) == 0
+	first.save()
+	second.save()
+	r.close()
+	assert sorted(saved) == [str(tmp_path / "1.wav"), str(tmp_path / "2.wav")]
@@ -0,0 +1,73 @@
+import os, wave
+import manifest, recordings
+
+def write_wav(path, frames=160):
+	with wave.open(path, "wb") as w:
+		w.setnchannels(1)
+		w.setsampwidth(2)
+		w.setframerate(16000)
+		w.writeframes(bytes(2 * frames))
+
+def make_dir(tmp_path, names):
+	directory = tmp_path / "en"
+	directory.mkdir()
+	for name in names:
+		write_wav(str(directory / name))
+	return str(directory)
+
+def test_first_run_without_manifest_indexes_the_directory(tmp_path):
+	directory = make_dir(tmp_path, ["b.wav", "a.wav", "notes.txt", ".hidden.wav"])
+	m = manifest.Manifest(directory)
+	index = recordings.RecordingsIndex(directory, manifest=m)
+	try:
+		assert not m.found
+		assert index.names == ["a.wav", "b.wav"]
+		assert index.newest() == "b.wav"
+		assert not os.path.exists(m.path)		# nothing written until the watcher's first pass
+		index.rescan()
+		assert m.names() == ["a.wav", "b.wav"]
+	finally:
+		index.close()
+
+def test_starts_from_the_manifest_when_there_is_one(tmp_path):
+	directory = make_dir(tmp_path, ["a.wav", "b.wav"])
+	m = manifest.Manifest(directory).load()
+	m.sync(["a.wav", "b.wav"])
+	m.close()
+	os.remove(os.path.join(directory, "b.wav"))
+	index = recordings.RecordingsIndex(directory, manifest=manifest.Manifest(directory))
+	try:
+		assert index.names == ["a.wav", "b.wav"]	# from the manifest, not the disk
+		index.rescan()
+		assert index.names == ["a.wav"]
+		assert index.manifest.names() == ["a.wav"]
+	finally:
+		index.close()
+
+def test_without_manifest_lists_the_directory(tmp_path):
+	directory = make_dir(tmp_path, ["2.wav", "1.wav"])
+	index = recordings.RecordingsIndex(directory)
+	assert index.names == ["1.wav", "2.wav"]
+	assert index.at(0) == "2.wav"
+
+def test_add_and_discard_keep_the_list_sorted(tmp_path):
+	directory = make_dir(tmp_path, ["1.wav", "3.wav"])
+	index = recordings.RecordingsIndex(directory)
+	events = []
+	index.listeners.append(lambda kind, name: events.append((kind, name)))
+	index.add(os.path.join(directory, "2.wav"))
+	index.add("2.wav")
+	index.discard("3.wav")
+	assert index.names == ["1.wav", "2.wav"]
+	assert events == [("add", "2.wav"), ("discard", "3.wav")]
+
+def test_unchanged_rescan_is_not_announced(tmp_path):
+	directory = make_dir(tmp_path, ["1.wav"])
+	index = recordings.RecordingsIndex(directory)
+	events = []
+	index.listeners.append(lambda kind, name: events.append(kind))
+	index.rescan(changed_only=True)
+	assert events == [] and index.unchanged_rescans == 1
+	write_wav(os.path.join(directory, "2.wav"))
+	index.rescan(changed_only=True)
+	assert events == ["rescan"] and index.names == ["1.wav", "2.wav"]
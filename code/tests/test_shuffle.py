@@ -0,0 +1,56 @@
+import random
+import recordings, shuffle
+
+def make_bag(tmp_path, count, **kwargs):
+	for i in range(count):
+		open(str(tmp_path / ("%03d.wav" % i)), "w").close()
+	index = recordings.RecordingsIndex(str(tmp_path))
+	return index, shuffle.ShuffleBag(index, rng=random.Random(7), **kwargs)
+
+def test_every_recording_plays_once_per_round(tmp_path):
+	index, bag = make_bag(tmp_path, 20)
+	for round in range(3):
+		picks = [bag.pick() for i in range(20)]
+		assert sorted(picks) == index.names
+	assert bag.rounds == 3
+
+def test_empty_index_picks_nothing(tmp_path):
+	index, bag = make_bag(tmp_path, 0)
+	assert bag.pick() is None
+
+def test_new_recordings_join_the_current_round(tmp_path):
+	index, bag = make_bag(tmp_path, 3)
+	first = bag.pick()
+	index.add("100.wav")
+	picks = [bag.pick() for i in range(3)]
+	assert sorted([first] + picks) == ["000.wav", "001.wav", "002.wav", "100.wav"]
+	assert bag.rounds == 1
+
+def test_deleted_recordings_leave_the_round(tmp_path):
+	index, bag = make_bag(tmp_path, 5)
+	played = bag.pick()
+	gone = next(name for name in index.names if name != played)
+	index.delete(gone)
+	picks = [bag.pick() for i in range(3)]
+	assert gone not in picks
+	assert sorted([played] + picks) == index.names
+	assert bag.rounds == 1
+
+def test_rescan_keeps_the_round(tmp_path):
+	index, bag = make_bag(tmp_path, 4)
+	played = [bag.pick(), bag.pick()]
+	open(str(tmp_path / "200.wav"), "w").close()
+	index.rescan()
+	rest = [bag.pick() for i in range(3)]
+	assert not set(played) & set(rest)
+	assert sorted(played + rest) == index.names
+	assert bag.rounds == 1
+
+def test_recency_weight_favours_newer_recordings(tmp_path):
+	index, bag = make_bag(tmp_path, 10, recency_weight=1.0)
+	firsts = []
+	for i in range(200):
+		bag.bag = []			# start a fresh round every time
+		firsts.append(bag.pick())
+	newer = sum(1 for name in firsts if name >= "005.wav")
+	assert newer > 130		# 150 expected (the newer of two draws), 100 without the weight
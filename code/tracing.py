@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+# Hot-path tracing for the Wonderphone.
+# Spans time the things a visitor waits on (ADC reads, key decoding, menu moves,
+# audio starting and stopping, file-system work) into fixed-bucket latency
+# histograms kept in memory, and a background thread writes them all to one small
+# JSON file every EXPORT_INTERVAL seconds (atomically, so a reader or a power cut
+# never sees half a file). The histograms are cumulative since start.
+#
+# Tracing is on when WONDERPHONE_TRACE names the export file. When it is off,
+# timed() and wrap() hand back the function itself and span() a shared no-op, so an
+# instrumented call costs nothing (or one global lookup for a guarded record()).
+#
+#   python3 tracing.py show FILE		p50/p95/p99 per span from an export
+#   python3 tracing.py bench [-n N]		per-call cost of each way of tracing, off and on
+
+import os, sys, json, time, argparse, threading, functools, logging
+from bisect import bisect_left
+
+logger = logging.getLogger('logwonderphone')
+
+EXPORT_PATH 	= os.environ.get("WONDERPHONE_TRACE") or None
+ENABLED 		= EXPORT_PATH is not None
+EXPORT_INTERVAL = 60.0		# seconds between exports
+# bucket upper bounds in microseconds; one more bucket past the last holds everything slower
+BOUNDS_US = (5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000,
+	100000, 200000, 500000, 1000000, 2000000, 5000000)
+
+class Histogram:
+	__slots__ = ("counts", "count", "total", "max")
+
+	def __init__(self):
+		self.counts = [0] * (len(BOUNDS_US) + 1)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, us):
+		self.counts[bisect_left(BOUNDS_US, us)] += 1
+		self.count += 1
+		self.total += us
+		if us > self.max:
+			self.max = us
+
+HISTOGRAMS = {}
+_lock = threading.Lock()
+_started = time.time()
+_exporter = None
+_stop = threading.Event()
+
+# record: add one duration, in seconds, to a span's histogram
+def record(name, seconds):
+	with _lock:
+		h = HISTOGRAMS.get(name)
+		if h is None:
+			h = HISTOGRAMS[name] = Histogram()
+		h.add(seconds * 1e6)
+
+class _Span:
+	__slots__ = ("name", "start")
+
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		record(self.name, time.perf_counter() - self.start)
+
+class _NullSpan:
+	__slots__ = ()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		pass
+
+NULL_SPAN = _NullSpan()
+
+# span: a context manager timing its block under name
+def span(name):
+	if not ENABLED:
+		return NULL_SPAN
+	return _Span(name)
+
+# timed: decorator timing every call under name; decided when the function is defined
+def timed(name):
+	def decorate(function):
+		if not ENABLED:
+			return function
+		@functools.wraps(function)
+		def traced(*args, **kwargs):
+			start = time.perf_counter()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				record(name, time.perf_counter() - start)
+		return traced
+	return decorate
+
+# wrap: a function (e.g. a bound method another module hands us) timed under name
+def wrap(name, function):
+	return timed(name)(function)
+
+# snapshot: every histogram, in the export format
+def snapshot():
+	with _lock:
+		spans = dict((name, {"n": h.count, "total_us": round(h.total), "max_us": round(h.max), "counts": list(h.counts)})
+			for name, h in HISTOGRAMS.items())
+	return {"time": round(time.time(), 1), "uptime": round(time.time() - _started, 1), "bounds_us": list(BOUNDS_US), "spans": spans}
+
+def export(path=None):
+	path = path or EXPORT_PATH
+	tmp = path + ".part"
+	with open(tmp, "w") as f:
+		json.dump(snapshot(), f, separators=(",", ":"))
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmp, path)
+
+# start: export every interval seconds on a background thread (nothing when tracing is off)
+def start(interval=EXPORT_INTERVAL):
+	global _exporter
+	if not ENABLED or _exporter is not None:
+		return
+	_stop.clear()
+	_exporter = threading.Thread(target=_export_run, args=(interval,), name="trace-export", daemon=True)
+	_exporter.start()
+
+# close: stop exporting and write the final numbers
+def close():
+	global _exporter
+	if _exporter is None:
+		return
+	_stop.set()
+	_exporter.join()
+	_exporter = None
+	export()
+
+def _export_run(interval):
+	while not _stop.wait(interval):
+		try:
+			export()
+		except OSError as e:
+			logger.debug("tracing: export to %s failed (%s)", EXPORT_PATH, e)
+
+# quantile: upper bound (us) of the bucket holding fraction q of a span's calls; None past the last bound
+def quantile(counts, q, bounds=BOUNDS_US):
+	total = sum(counts)
+	if total == 0:
+		return None
+	seen = 0
+	for i, c in enumerate(counts):
+		seen += c
+		if seen >= q * total:
+			return bounds[i] if i < len(bounds) else None
+	return None
+
+#------------------------------------------ TOOLS ------------------------------------------
+
+def show(path):
+	with open(path) as f:
+		data = json.load(f)
+	bounds = data["bounds_us"]
+	def fmt(us):
+		return ">%d" % bounds[-1] if us is None else "<=%d" % us
+	print("uptime %.0f s, exported %s" % (data["uptime"], time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(data["time"]))))
+	print("%-24s %9s %10s %10s %10s %10s %10s" % ("span", "n", "mean us", "p50 us", "p95 us", "p99 us", "max us"))
+	for name, s in sorted(data["spans"].items()):
+		mean = s["total_us"] / float(s["n"]) if s["n"] else 0
+		print("%-24s %9d %10.1f %10s %10s %10s %10d" % (name, s["n"], mean, fmt(quantile(s["counts"], 0.5, bounds)),
+			fmt(quantile(s["counts"], 0.95, bounds)), fmt(quantile(s["counts"], 0.99, bounds)), s["max_us"]))
+
+# bench: ns per call of a trivial function bare, decorated, and inside a span, with tracing off and on
+def bench(n):
+	global ENABLED
+	def work():
+		return None
+	def per_call(function):
+		start = time.perf_counter()
+		for i in range(n):
+			function()
+		return 1e9 * (time.perf_counter() - start) / n
+	def in_span():
+		with span("bench.span"):
+			work()
+	was = ENABLED
+	results = {"bare": per_call(work)}
+	try:
+		for ENABLED in (False, True):
+			state = "on" if ENABLED else "off"
+			results["timed, " + state] = per_call(timed("bench.timed")(work))
+			results["span, " + state] = per_call(in_span)
+	finally:
+		ENABLED = was
+		HISTOGRAMS.pop("bench.timed", None)
+		HISTOGRAMS.pop("bench.span", None)
+	return results
+
+def main():
+	parser = argparse.ArgumentParser(description="Wonderphone tracing tools")
+	sub = parser.add_subparsers(dest="command")
+	s = sub.add_parser("show", help="print the span histograms in an export file")
+	s.add_argument("file", nargs="?", default=EXPORT_PATH)
+	b = sub.add_parser("bench", help="cost of tracing a call, off and on")
+	b.add_argument("-n", "--calls", type=int, default=1000000)
+	args = parser.parse_args()
+	if args.command == "show" and args.file:
+		show(args.file)
+		return 0
+	if args.command == "bench":
+		for name, ns in bench(args.calls).items():
+			print("%-12s %8.0f ns/call" % (name, ns))
+		return 0
+	parser.print_help()
+	return 1
+
+if __name__ == "__main__":
+	sys.exit(main())
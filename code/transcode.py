@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# Compact storage format for Wonderphone recordings.
+# A voice message from a telephone handset doesn't need 44.1 kHz stereo; mono 16 kHz
+# 16-bit PCM is about a fifth of the bytes. New takes are captured in that format
+# directly (CAPTURE_RATE / CAPTURE_CHANNELS in the phone scripts); this module converts
+# the recordings that were made before, in a pool of worker processes at low priority.
+# Files stay .wav, so playback (audio.stream_wav) reads old and new ones the same way.
+# Each file is rewritten to a temp file and renamed over the original (rewrite.py).
+#
+#   python3 transcode.py DIR [DIR ...] [--rate 16000] [--channels 1] [-j WORKERS] [--decode-cost]
+# prints bytes saved, files/s and, with --decode-cost, the playback conversion cost per
+# second of audio before and after.
+
+import os, sys, time, wave, argparse, logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import audio, rewrite
+
+logger = logging.getLogger('logwonderphone')
+
+TARGET_RATE 	= 16000
+TARGET_CHANNELS = 1
+WORKERS 		= 2		# leave the other cores to audio and the keypad
+FILTER_TAPS 	= 63	# low-pass applied before downsampling, so the resampler doesn't alias
+
+# format_string: the manifest's format field for a (rate, channels) target
+def format_string(rate, channels):
+	return "%d/%d/16" % (rate, channels)
+
+# lowpass: windowed-sinc FIR over int16 frames, cutting just below the new Nyquist rate
+def lowpass(frames, src_rate, rate, taps=FILTER_TAPS):
+	cutoff = 0.45 * rate / src_rate
+	n = np.arange(taps) - (taps - 1) / 2.0
+	kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+	kernel /= kernel.sum()
+	out = np.empty(frames.shape)
+	for c in range(frames.shape[1]):
+		out[:, c] = np.convolve(frames[:, c], kernel, mode="same")
+	return np.clip(np.rint(out), -32768, 32767).astype('<i2')
+
+# convert: raw pcm in params -> 16-bit pcm bytes at (rate, channels)
+def convert(data, params, rate, channels):
+	src_channels, src_width, src_rate = params
+	# channels (and sample width) first, at the source rate, so the filter runs on as few channels as possible
+	data = audio.ChunkConverter(params, channels, src_rate).convert(data)
+	if src_rate > rate:
+		frames = np.frombuffer(data, dtype='<i2').reshape(-1, channels)
+		data = lowpass(frames, src_rate, rate).tobytes()
+	return audio.ChunkConverter((channels, 2, src_rate), channels, rate).convert(data)
+
+# decode_seconds: cpu time to turn pcm into device format for playback
+def decode_seconds(data, params):
+	start = time.perf_counter()
+	audio.to_device_format(data, params)
+	return time.perf_counter() - start
+
+# transcode_file: rewrite one recording in the target format; runs in a worker process
+def transcode_file(path, rate=TARGET_RATE, channels=TARGET_CHANNELS, decode_cost=False):
+	start = time.perf_counter()
+	params, data = audio.read_wav(path)
+	src_channels, src_width, src_rate = params
+	result = {
+		"path": path,
+		"bytes_before": os.path.getsize(path),
+		"audio_seconds": len(data) / float(src_channels * src_width * src_rate),
+		"converted": False,
+	}
+	result["bytes_after"] = result["bytes_before"]
+	if decode_cost:
+		result["decode_before"] = decode_seconds(data, params)
+	if params != (channels, 2, rate):
+		out = convert(data, params, rate, channels)
+		if not rewrite.replace_wav(path, out, channels, rate):
+			return result
+		result["converted"] = True
+		result["bytes_after"] = os.path.getsize(path)
+		data, params = out, (channels, 2, rate)
+	if decode_cost:
+		result["decode_after"] = decode_seconds(data, params)
+	result["seconds"] = time.perf_counter() - start
+	return result
+
+# Transcoder: background pool for the phone scripts; on_done(path) runs after a file is rewritten.
+# pool: a rewrite.pool() made before the script's threads started (see rewrite.py); one is made now without it
+class Transcoder:
+	def __init__(self, rate=TARGET_RATE, channels=TARGET_CHANNELS, workers=WORKERS, on_done=None, pool=None):
+		self.rate = rate
+		self.channels = channels
+		self.on_done = on_done
+		self.pool = pool if pool is not None else rewrite.pool(workers)
+		self.converted = 0
+		self.failed = 0
+		self.bytes_saved = 0
+
+	def submit(self, path):
+		future = self.pool.submit(transcode_file, path, self.rate, self.channels)
+		future.add_done_callback(self._done)
+		return future
+
+	# submit_backlog: queue every recording in an index whose manifest entry isn't in the target format
+	def submit_backlog(self, index):
+		target = format_string(self.rate, self.channels)
+		count = 0
+		for name in list(index.names):
+			info = index.info(name)
+			if info is not None and info.get("format") == target:
+				continue
+			self.submit(index.path(name))
+			count += 1
+		return count
+
+	def _done(self, future):
+		if future.cancelled():
+			return			# shut down before it ran; picked up again by the next backlog pass
+		try:
+			result = future.result()
+		except Exception as e:
+			self.failed += 1
+			logger.debug("transcoder: %s", e)
+			return
+		if result["converted"]:
+			self.converted += 1
+			self.bytes_saved += result["bytes_before"] - result["bytes_after"]
+			if self.on_done is not None:
+				self.on_done(result["path"])
+
+	def stats(self):
+		return {"converted": self.converted, "failed": self.failed, "bytes_saved": self.bytes_saved}
+
+	def close(self):
+		self.pool.shutdown(wait=True, cancel_futures=True)
+
+#------------------------------------------ BATCH ------------------------------------------
+
+def main():
+	parser = argparse.ArgumentParser(description="Convert Wonderphone recordings to a compact format")
+	parser.add_argument("directories", nargs="+")
+	parser.add_argument("--rate", type=int, default=TARGET_RATE)
+	parser.add_argument("--channels", type=int, default=TARGET_CHANNELS)
+	parser.add_argument("-j", "--workers", type=int, default=os.cpu_count())
+	parser.add_argument("--decode-cost", action="store_true", help="also time playback conversion before and after")
+	args = parser.parse_args()
+
+	paths = []
+	for directory in args.directories:
+		paths.extend(os.path.join(directory, n) for n in sorted(os.listdir(directory))
+			if n.endswith(".wav") and not n.startswith("."))
+	start = time.perf_counter()
+	results = []
+	with ProcessPoolExecutor(args.workers) as pool:
+		futures = [pool.submit(transcode_file, p, args.rate, args.channels, args.decode_cost) for p in paths]
+		for future in futures:
+			try:
+				results.append(future.result())
+			except (OSError, wave.Error, EOFError, ValueError) as e:
+				print("failed: %s" % e)
+	elapsed = time.perf_counter() - start
+
+	converted = [r for r in results if r["converted"]]
+	before = sum(r["bytes_before"] for r in results)
+	after = sum(r["bytes_after"] for r in results)
+	print("%d files, %d converted, %d already compact, %.1f files/s" % (len(results), len(converted),
+		len(results) - len(converted), len(results) / elapsed if elapsed else 0))
+	print("bytes: %d -> %d, saved %d (%.0f%%)" % (before, after, before - after, 100.0 * (before - after) / before if before else 0))
+	if args.decode_cost and converted:
+		audio_seconds = sum(r["audio_seconds"] for r in converted)
+		print("decode cost per audio second: %.2f ms before, %.2f ms after" % (
+			1000 * sum(r["decode_before"] for r in converted) / audio_seconds,
+			1000 * sum(r["decode_after"] for r in converted) / audio_seconds))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+# Silence trimming for Wonderphone recordings.
+# Most takes start with the pause before the caller speaks (katies_payphone.py waits
+# two seconds before it even reads keys) and end with the walk back to the keypad.
+# The trim pass measures the level of every short window at once with numpy, keeps
+# the span from the first to the last window above THRESHOLD_DBFS (plus PAD_SECONDS
+# either side) and rewrites the file atomically (rewrite.py). A recording with less than
+# MIN_SPEECH_SECONDS above the threshold is left alone and flagged empty in the
+# manifest instead (manifest.py list shows it), so staff can review or cull it.
+# The phone scripts trim each take after it is saved; for the archive:
+#
+#   python3 trim.py DIR [DIR ...] [--threshold -45] [--pad 0.25] [--min-speech 0.5] [-j WORKERS] [--dry-run] [--cull]
+# prints seconds of playback removed, empty recordings and files/s. Run it with the phone
+# stopped: it updates the same manifest the phone appends to.
+
+import os, sys, time, wave, argparse, logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import audio, manifest, rewrite
+
+logger = logging.getLogger('logwonderphone')
+
+THRESHOLD_DBFS 		= -45.0	# a window quieter than this is silence
+WINDOW_SECONDS 		= 0.02
+PAD_SECONDS 		= 0.25	# silence kept before the first and after the last sound, so words aren't clipped
+MIN_SPEECH_SECONDS 	= 0.5	# less sound than this and the recording counts as empty
+WORKERS 			= 1
+
+# window_levels: rms level of each window in dBFS, over all channels
+def window_levels(frames, window):
+	count = len(frames) // window
+	if count == 0:
+		return np.empty(0)
+	power = np.square(frames[:count * window].astype(np.float32)).mean(axis=1)
+	power = power.reshape(count, window).mean(axis=1)
+	return 10 * np.log10(power / (32768.0 * 32768.0) + 1e-12)
+
+# speech_bounds: (first frame, end frame, seconds above the threshold) of 16-bit frames
+def speech_bounds(frames, rate, threshold=THRESHOLD_DBFS, pad=PAD_SECONDS, window_seconds=WINDOW_SECONDS):
+	window = max(1, int(rate * window_seconds))
+	loud = np.flatnonzero(window_levels(frames, window) > threshold)
+	speech = len(loud) * window / float(rate)
+	if len(loud) == 0:
+		return 0, len(frames), speech
+	pad_frames = int(rate * pad)
+	start = max(0, int(loud[0]) * window - pad_frames)
+	end = min(len(frames), (int(loud[-1]) + 1) * window + pad_frames)
+	return start, end, speech
+
+# trim_file: trim one recording in place; runs in a worker process
+def trim_file(path, threshold=THRESHOLD_DBFS, pad=PAD_SECONDS, min_speech=MIN_SPEECH_SECONDS, dry_run=False):
+	start_time = time.perf_counter()
+	params, data = audio.read_wav(path)
+	channels, width, rate = params
+	if width != 2:
+		data = audio.ChunkConverter(params, channels, rate).convert(data)
+	frames = np.frombuffer(data, dtype='<i2').reshape(-1, channels)
+	start, end, speech = speech_bounds(frames, rate, threshold, pad)
+	result = {
+		"path": path,
+		"seconds_before": len(frames) / float(rate),
+		"seconds_after": len(frames) / float(rate),
+		"speech": speech,
+		"empty": speech < min_speech,
+		"trimmed": False,
+	}
+	if not result["empty"] and (start > 0 or end < len(frames)):
+		result["seconds_after"] = (end - start) / float(rate)
+		if not dry_run and not rewrite.replace_wav(path, frames[start:end].tobytes(), channels, rate):
+			result["seconds_after"] = result["seconds_before"]
+			return result
+		result["trimmed"] = True
+	result["seconds"] = time.perf_counter() - start_time
+	return result
+
+# Trimmer: background pool for the phone scripts; on_done(result) runs after each file is checked.
+# pool: a rewrite.pool() made before the script's threads started (see rewrite.py); one is made now without it
+class Trimmer:
+	def __init__(self, threshold=THRESHOLD_DBFS, pad=PAD_SECONDS, min_speech=MIN_SPEECH_SECONDS, workers=WORKERS, on_done=None, pool=None):
+		self.threshold = threshold
+		self.pad = pad
+		self.min_speech = min_speech
+		self.on_done = on_done
+		self.pool = pool if pool is not None else rewrite.pool(workers)
+		self.trimmed = 0
+		self.empty = 0
+		self.failed = 0
+		self.seconds_removed = 0.0
+
+	def submit(self, path):
+		future = self.pool.submit(trim_file, path, self.threshold, self.pad, self.min_speech)
+		future.add_done_callback(self._done)
+		return future
+
+	def _done(self, future):
+		if future.cancelled():
+			return
+		try:
+			result = future.result()
+		except Exception as e:
+			self.failed += 1
+			logger.debug("trimmer: %s", e)
+			return
+		if result["trimmed"]:
+			self.trimmed += 1
+			self.seconds_removed += result["seconds_before"] - result["seconds_after"]
+		if result["empty"]:
+			self.empty += 1
+		if self.on_done is not None:
+			self.on_done(result)
+
+	def stats(self):
+		return {"trimmed": self.trimmed, "empty": self.empty, "failed": self.failed,
+			"seconds_removed": round(self.seconds_removed, 1)}
+
+	def close(self):
+		self.pool.shutdown(wait=True, cancel_futures=True)
+
+#------------------------------------------ BATCH ------------------------------------------
+
+def main():
+	parser = argparse.ArgumentParser(description="Trim silence from Wonderphone recordings and flag empty ones")
+	parser.add_argument("directories", nargs="+")
+	parser.add_argument("--threshold", type=float, default=THRESHOLD_DBFS, help="dBFS below which a window is silence")
+	parser.add_argument("--pad", type=float, default=PAD_SECONDS, help="seconds of silence kept around the sound")
+	parser.add_argument("--min-speech", type=float, default=MIN_SPEECH_SECONDS, help="seconds of sound below which a recording is empty")
+	parser.add_argument("-j", "--workers", type=int, default=os.cpu_count())
+	parser.add_argument("--dry-run", action="store_true", help="report what would change without writing anything")
+	parser.add_argument("--cull", action="store_true", help="delete empty recordings instead of flagging them")
+	args = parser.parse_args()
+
+	jobs = []
+	for directory in args.directories:
+		jobs.extend((directory, n) for n in sorted(manifest.list_wavs(directory)))
+	start = time.perf_counter()
+	results = []
+	with ProcessPoolExecutor(args.workers) as pool:
+		futures = [(directory, pool.submit(trim_file, os.path.join(directory, name), args.threshold, args.pad,
+			args.min_speech, args.dry_run)) for directory, name in jobs]
+		for directory, future in futures:
+			try:
+				results.append((directory, future.result()))
+			except (OSError, wave.Error, EOFError, ValueError) as e:
+				print("failed: %s" % e)
+	elapsed = time.perf_counter() - start
+
+	# manifests: update sizes and durations, flag (or drop) the empty recordings
+	culled = 0
+	if not args.dry_run:
+		for directory in args.directories:
+			m = None
+			if os.path.exists(manifest.default_path(directory)):
+				m = manifest.Manifest(directory).load()
+			try:
+				for d, r in results:
+					name = os.path.basename(r["path"])
+					if d != directory or not (r["trimmed"] or r["empty"]):
+						continue
+					if r["empty"] and args.cull:
+						os.remove(r["path"])
+						culled += 1
+						if m is not None:
+							m.mark_deleted(name)
+					elif m is not None:
+						m.update(name)
+						if r["empty"]:
+							m.flag(name, empty=True)
+			finally:
+				if m is not None:
+					m.close()
+
+	results = [r for d, r in results]
+	trimmed = [r for r in results if r["trimmed"]]
+	empty = [r for r in results if r["empty"]]
+	before = sum(r["seconds_before"] for r in results)
+	after = sum(r["seconds_after"] for r in results)
+	for r in empty:
+		print("empty: %s (%.1f s, %.2f s of sound)" % (r["path"], r["seconds_before"], r["speech"]))
+	print("%d files, %d trimmed, %d empty%s, %.1f files/s%s" % (len(results), len(trimmed), len(empty),
+		" (%d deleted)" % culled if args.cull else "", len(results) / elapsed if elapsed else 0,
+		" (dry run)" if args.dry_run else ""))
+	print("playback: %.1f s -> %.1f s, removed %.1f s (%.0f%%)" % (before, after, before - after,
+		100.0 * (before - after) / before if before else 0))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# Usage counters for the Wonderphone.
+# The phone scripts count what visitors do: pickups, call durations, every menu
+# selection (by state and language), recordings saved, discarded and played.
+# Counters live in memory; every SNAPSHOT_INTERVAL seconds the day's totals are
+# written to DIR/<phone>-YYYY-MM-DD.json (temp file, fsync, rename, fsync of the
+# directory), so a power cut loses at most one interval, and a restart on the same
+# day carries on from the last snapshot. Counts made in the first interval after
+# midnight can land on the day before.
+#
+#   python3 usage.py daily  [DIR] [--phone katies] [--days 7]
+#   python3 usage.py weekly [DIR] [--phone katies] [--weeks 4] [--top 10]
+# print rollups straight from the snapshots: no log parsing.
+
+import os, sys, json, time, glob, argparse, datetime, threading, logging
+from collections import defaultdict
+
+logger = logging.getLogger('logwonderphone')
+
+DIRECTORY 			= "/home/pi/Desktop/wonderphone-usage"
+SNAPSHOT_INTERVAL 	= 60.0
+CALL_BOUNDS 		= (10, 30, 60, 120, 300, 600, 1200, 1800)	# call length buckets, seconds; one more for longer calls
+MENU_KEYS 			= ("1", "2", "3", "4", "5", "6", "7", "8", "9", "*", "0", "#")
+
+def empty_day(phone, day):
+	return {"phone": phone, "day": day, "counters": {}, "selections": {},
+		"calls": {"n": 0, "seconds": 0.0, "max": 0.0, "buckets": [0] * (len(CALL_BOUNDS) + 1)}}
+
+def day_path(directory, phone, day):
+	return os.path.join(directory, "%s-%s.json" % (phone, day))
+
+class Usage:
+	# language: optional function of a menu state name -> language, for the selections
+	def __init__(self, directory, phone, language=None, interval=SNAPSHOT_INTERVAL):
+		self.directory = directory
+		self.phone = phone
+		self.language = language
+		self.interval = interval
+		self.lock = threading.Lock()
+		self.picked_up = None			# monotonic time of the pickup while a call is on
+		self.dirty = False
+		self.stop = threading.Event()
+		self.thread = None
+		self.day = datetime.date.today().isoformat()
+		self.data = self._load(self.day)
+
+	# attach: count the menu's key selections
+	def attach(self, menu):
+		names = menu.names
+		def moved(state, event, transition):
+			if event in MENU_KEYS:
+				self.select(names[state], event, names[transition.target], transition.label)
+		menu.listeners.append(moved)
+
+	def select(self, state, event, target, label=None):
+		key = "%s %s" % (state, event)
+		with self.lock:
+			entry = self.data["selections"].get(key)
+			if entry is None:
+				entry = self.data["selections"][key] = {"to": target, "label": label,
+					"lang": self.language(target) if self.language else None, "n": 0}
+			entry["n"] += 1
+			self.dirty = True
+
+	# hook: the handset went up (off_hook True) or down; counts pickups and call lengths
+	def hook(self, off_hook):
+		now = time.monotonic()
+		with self.lock:
+			if off_hook and self.picked_up is None:
+				self.picked_up = now
+				self._bump("pickups")
+			elif not off_hook and self.picked_up is not None:
+				seconds = now - self.picked_up
+				self.picked_up = None
+				calls = self.data["calls"]
+				calls["n"] += 1
+				calls["seconds"] = round(calls["seconds"] + seconds, 1)
+				calls["max"] = round(max(calls["max"], seconds), 1)
+				calls["buckets"][bucket(seconds)] += 1
+				self.dirty = True
+
+	def count(self, name, n=1):
+		with self.lock:
+			self._bump(name, n)
+
+	def _bump(self, name, n=1):
+		counters = self.data["counters"]
+		counters[name] = counters.get(name, 0) + n
+		self.dirty = True
+
+	# save: write today's snapshot if anything changed; starts a new day after midnight
+	def save(self):
+		today = datetime.date.today().isoformat()
+		with self.lock:
+			if not self.dirty and today == self.day:
+				return
+			data = json.dumps(dict(self.data, updated=round(time.time())), separators=(",", ":"), sort_keys=True)
+			day = self.day
+			if today != self.day:
+				self.day = today
+				self.data = empty_day(self.phone, today)
+			self.dirty = False
+		write_atomic(day_path(self.directory, self.phone, day), data)
+
+	def start(self):
+		self.thread = threading.Thread(target=self._run, name="usage", daemon=True)
+		self.thread.start()
+
+	def close(self):
+		if self.thread is not None:
+			self.stop.set()
+			self.thread.join()
+			self.thread = None
+		self._save_logged()
+
+	def _run(self):
+		while not self.stop.wait(self.interval):
+			self._save_logged()
+
+	def _save_logged(self):
+		try:
+			self.save()
+		except OSError as e:
+			logger.debug("usage: could not write the snapshot to %s (%s)", self.directory, e)
+
+	def _load(self, day):
+		try:
+			with open(day_path(self.directory, self.phone, day)) as f:
+				data = json.load(f)
+			data.pop("updated", None)
+			return data
+		except (OSError, ValueError):
+			return empty_day(self.phone, day)
+
+def bucket(seconds):
+	for i, bound in enumerate(CALL_BOUNDS):
+		if seconds <= bound:
+			return i
+	return len(CALL_BOUNDS)
+
+# write_atomic: replace path with text so that a power cut leaves the old or the new file, never half of one
+def write_atomic(path, text):
+	directory = os.path.dirname(path)
+	os.makedirs(directory, exist_ok=True)
+	tmp = path + ".part"
+	with open(tmp, "w") as f:
+		f.write(text)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmp, path)
+	fd = os.open(directory, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+#------------------------------------------ ROLLUPS ------------------------------------------
+
+# load_days: {(phone, day): snapshot} for every snapshot in a directory
+def load_days(directory, phone=None):
+	days = {}
+	for path in glob.glob(os.path.join(directory, "*-????-??-??.json")):
+		try:
+			with open(path) as f:
+				data = json.load(f)
+		except (OSError, ValueError) as e:
+			print("skipping %s (%s)" % (path, e))
+			continue
+		if phone is None or data.get("phone") == phone:
+			days[(data["phone"], data["day"])] = data
+	return days
+
+# merge: add one day's snapshot into a running total
+def merge(total, data):
+	for name, n in data["counters"].items():
+		total["counters"][name] = total["counters"].get(name, 0) + n
+	for key, entry in data["selections"].items():
+		t = total["selections"].setdefault(key, dict(entry, n=0))
+		t["n"] += entry["n"]
+	calls, c = total["calls"], data["calls"]
+	calls["n"] += c["n"]
+	calls["seconds"] += c["seconds"]
+	calls["max"] = max(calls["max"], c["max"])
+	calls["buckets"] = [a + b for a, b in zip(calls["buckets"], c["buckets"])]
+	return total
+
+# median_bucket: the call length bucket holding the median call, as text
+def median_bucket(buckets):
+	total = sum(buckets)
+	if total == 0:
+		return "-"
+	seen = 0
+	for i, n in enumerate(buckets):
+		seen += n
+		if seen * 2 >= total:
+			return "<=%ds" % CALL_BOUNDS[i] if i < len(CALL_BOUNDS) else ">%ds" % CALL_BOUNDS[-1]
+
+def print_rollup(title, total, top):
+	counters = total["counters"]
+	calls = total["calls"]
+	mean = calls["seconds"] / calls["n"] if calls["n"] else 0
+	others = ", ".join("%s %d" % (name, n) for name, n in sorted(counters.items()) if name != "pickups")
+	print("%-26s pickups %5d  calls %5d  mean %6.1fs  median %7s  max %6.1fs  %s" % (title, counters.get("pickups", 0),
+		calls["n"], mean, median_bucket(calls["buckets"]), calls["max"], others))
+	if top:
+		by_choice = defaultdict(int)
+		for key, entry in total["selections"].items():
+			name = entry["label"] or "%s -> %s" % (key, entry["to"])
+			by_choice[(entry["lang"] or "", name)] += entry["n"]
+		for (lang, name), n in sorted(by_choice.items(), key=lambda kv: -kv[1])[:top]:
+			print("    %6d  %-3s %s" % (n, lang, name))
+
+def main():
+	parser = argparse.ArgumentParser(description="Wonderphone usage rollups")
+	sub = parser.add_subparsers(dest="command")
+	d = sub.add_parser("daily", help="one line per phone and day")
+	d.add_argument("--days", type=int, default=7)
+	w = sub.add_parser("weekly", help="totals per phone and ISO week, with the most chosen menu options")
+	w.add_argument("--weeks", type=int, default=4)
+	for p in (d, w):
+		p.add_argument("directory", nargs="?", default=os.environ.get("WONDERPHONE_USAGE", DIRECTORY))
+		p.add_argument("--phone")
+		p.add_argument("--top", type=int, default=10 if p is w else 0, help="menu options to list per rollup")
+	args = parser.parse_args()
+	if args.command not in ("daily", "weekly"):
+		parser.print_help()
+		return 1
+
+	days = load_days(args.directory, args.phone)
+	if not days:
+		print("no usage snapshots in " + args.directory)
+		return 1
+	rollups = {}
+	for (phone, day), data in sorted(days.items()):
+		if args.command == "daily":
+			period = day
+		else:
+			year, week, _ = datetime.date.fromisoformat(day).isocalendar()
+			period = "%d-W%02d" % (year, week)
+		total = rollups.setdefault((phone, period), empty_day(phone, period))
+		merge(total, data)
+	limit = args.days if args.command == "daily" else args.weeks
+	for phone in sorted(set(p for p, period in rollups)):
+		periods = sorted(period for p, period in rollups if p == phone)[-limit:]
+		for period in periods:
+			print_rollup("%s %s" % (phone, period), rollups[(phone, period)], args.top)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())